@@ -0,0 +1,61 @@
+import pegpy
+from pegpy import vm
+from pegpy.nez import cbase
+import json
+import sys
+import time
+
+# Compare the pure-Python tpeg2 engine with the bytecode VM (pegpy.vm) and
+# pegpy.nez.cbase on the bundled grammars. Each grammar parses all its
+# examples; json also parses a larger generated document and a deeply
+# nested one, which only the VM parses without a RecursionError.
+#   python bench.py [grammar ...]
+
+grammars = sys.argv[1:] or ['math.tpeg', 'json.tpeg', 'chibi.tpeg', 'puppy.tpeg', 'js.tpeg']
+print('cbase is', 'compiled' if cbase.compiled else 'interpreted (falls back to tpeg2)')
+
+
+def inputs(peg, file):
+    cases = [(name, doc.inputs_[doc.spos_:doc.epos_]) for name, doc in peg['@@example'] if name in peg]
+    if file == 'json.tpeg':
+        doc = [{'id': i, 'name': f'item{i}', 'tags': ['a', 'b'], 'price': i * 1.5, 'ok': True} for i in range(2000)]
+        cases.append((peg.start(), json.dumps(doc, indent=1)))
+    return cases
+
+
+def measure(generate, peg, cases, n=5):
+    parsers = {}
+    for name, _ in cases:
+        if name not in parsers:
+            parsers[name] = generate(peg, start=name)
+    start_time = time.perf_counter()
+    for _ in range(n):
+        for name, s in cases:
+            parsers[name](s)
+    return time.perf_counter() - start_time
+
+
+for file in grammars:
+    peg = pegpy.grammar(file)
+    cases = inputs(peg, file)
+    t0 = measure(pegpy.generate, peg, cases)
+    t1 = measure(vm.generate, peg, cases)
+    t2 = measure(cbase.cgenerate, peg, cases)
+    print(f'{file:12} tpeg2: {t0:.4f} vm: {t1:.4f} x{t0 / t1:.1f} cbase: {t2:.4f} x{t0 / t2:.1f}')
+
+
+def nested(generate, peg, s):
+    try:
+        start_time = time.perf_counter()
+        t = generate(peg)(s)
+        return f'{time.perf_counter() - start_time:.4f} #{t.tag_}'
+    except RecursionError:
+        return 'RecursionError'
+
+
+peg = pegpy.grammar('json.tpeg')
+for depth in [100, 1000, 100000]:
+    s = '[' * depth + ']' * depth
+    results = [f'{name}: {nested(g, peg, s)}' for name, g in
+               [('tpeg2', pegpy.generate), ('vm', vm.generate), ('cbase', cbase.cgenerate)]]
+    print(f'depth {depth:<6}', ' '.join(results))
@@ -0,0 +1,44 @@
+import pegpy
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Parse throughput of tpeg2 parsers shared by several threads. Every
+# thread builds its parser (lazily) from the same grammar, so compiling
+# and parsing run concurrently. Throughput only scales on a free-threaded
+# interpreter (python3.13t); with the GIL it should stay flat.
+#   python bench_threads.py [grammar] [threads ...]
+
+file = sys.argv[1] if len(sys.argv) > 1 else 'json.tpeg'
+threads = [int(n) for n in sys.argv[2:]] or [1, 2, 4, 8]
+gil = sys._is_gil_enabled() if hasattr(sys, '_is_gil_enabled') else True
+print(f'{file} on Python {sys.version.split()[0]}, GIL', 'enabled' if gil else 'disabled')
+
+peg = pegpy.grammar(file)
+cases = [(name, doc.inputs_[doc.spos_:doc.epos_]) for name, doc in peg['@@example'] if name in peg]
+if file == 'json.tpeg':
+    doc = [{'id': i, 'name': f'item{i}', 'tags': ['a', 'b'], 'price': i * 1.5} for i in range(200)]
+    cases.append((peg.start(), json.dumps(doc)))
+expected = [repr(pegpy.generate(peg, start=name)(s)) for name, s in cases]
+
+
+def work(n):
+    parsers = {}
+    for _ in range(n):
+        for (name, s), t in zip(cases, expected):
+            if name not in parsers:
+                parsers[name] = pegpy.generate(peg, start=name, lazy=True)
+            assert repr(parsers[name](s)) == t
+    return n * len(cases)
+
+
+base = None
+for n in threads:
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(n) as pool:
+        parsed = sum(pool.map(work, [20] * n))
+    execution_time = time.perf_counter() - start_time
+    throughput = parsed / execution_time
+    base = base or throughput
+    print(f'threads={n} parses/s: {throughput:.1f} x{throughput / base:.2f}')
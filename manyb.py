@@ -1,12 +1,10 @@
 from pegpy.gparser.cython_gpeg import cgpeg
-from pegpy.tpeg import grammar
+from pegpy.tpeg0 import grammar
 from pathlib import Path
+import sys
 import time
 import pstats, cProfile
 
-import pyximport
-pyximport.install()
-
 manyb = grammar('manyb.gpeg')
 print(manyb)
 parser = cgpeg(manyb)
@@ -16,10 +14,33 @@ bs = 'b' * 100
 cProfile.runctx("parser(bs)", globals(), locals(), "Profile.prof")
 
 s = pstats.Stats("Profile.prof")
-s.strip_dirs().sort_stats("time").print_stats()
+s.strip_dirs().sort_stats("time").print_stats(10)
 
 start_time = time.perf_counter()
 ast = parser(bs)
 execution_time = time.perf_counter() - start_time
 print(f'time: {execution_time}')
 # print(f'ast: {ast}')
+
+# scaling over input length; with a shared forest both the time and the
+# number of forest nodes should grow polynomially (cubic for manyb)
+lengths = [int(n) for n in sys.argv[1:]] or [10, 20, 40, 80, 160]
+prev = None
+for n in lengths:
+    start_time = time.perf_counter()
+    ast = parser('b' * n)
+    execution_time = time.perf_counter() - start_time
+    size = ast.size()
+    ratio = '' if prev is None else f'x{execution_time / prev:.1f}'
+    print(f'n={n} time: {execution_time:.4f} {ratio} forest: {size}')
+    prev = execution_time
+
+# terminals after an ambiguous prefix; '+' is tested against every end
+# position of the preceding Many at once
+sep = cgpeg(grammar('manybsep.gpeg'))
+for n in lengths:
+    s = '+'.join(['b' * (n // 4)] * 4)
+    start_time = time.perf_counter()
+    ast = sep(s)
+    execution_time = time.perf_counter() - start_time
+    print(f'sep n={n} time: {execution_time:.4f} forest: {ast.size()}')
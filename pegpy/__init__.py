@@ -1 +1 @@
-from pegpy.tpeg2 import grammar, generate, ParseTree
+from pegpy.tpeg2 import grammar, generate, ParseTree, Parser, ParseTimeout
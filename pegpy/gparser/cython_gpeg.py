@@ -1,25 +1,35 @@
 # cython: profile=True
 
-from pegpy.tpeg0 import Ref, Char, Seq, Ore, Alt, Node, Edge, Grammar
+from pegpy.tpeg0 import Empty, Char, Range, Any, Seq, Ore, Alt, And, Not, Many, Many1, Ref
+from pegpy.tpeg0 import Node, Edge, Fold, Abs, Action, Grammar
 
 import cython
+import gc
+from heapq import heapify, heappush, heappop
 import pickle as cPickle
 
-from copy import copy
-
 
 emp = bytes('', 'utf-8')
 err = bytes('err', 'utf-8')
 amb = bytes('?', 'utf-8')
 
+# Shared Packed Parse Forest (SPPF)
+#   Tree   symbol node; GMemo shares one per (rule, spos, epos)
+#   Link   family of children (reversed list, the tail is shared),
+#          each child optionally labeled by an edge
+#   Amb    packed node; alternative families for the same span
+# Forest nodes only point to older nodes, so they never form a cycle
+# and are kept out of the cyclic garbage collector.
+
 
+@cython.no_gc
 @cython.cclass
 class Tree:
-    tag: object
-    inputs: object
-    spos: cython.int
-    epos: cython.int
-    child: object
+    tag = cython.declare(object, visibility='public')
+    inputs = cython.declare(object, visibility='public')
+    spos = cython.declare(cython.int, visibility='public')
+    epos = cython.declare(cython.int, visibility='public')
+    child = cython.declare(object, visibility='public')
 
     def __init__(self, tag: object, inputs: object, spos: cython.int, epos: cython.int, child: object):
         self.tag = tag
@@ -32,17 +42,32 @@ class Tree:
         if self.child:
             return f'[#{self.tag.decode("utf-8")} {str(self.child)}]'
         else:
-            return self.inputs.decode('utf-8')[self.spos:self.epos]
+            return self.inputs[self.spos:self.epos].decode('utf-8')
+
+    def size(self):
+        return forest_size(self, set())
+
+    def count(self, epos=None):
+        return count_forest(self, {}, epos)
+
+    def trees(self, epos=None):
+        return iter_forest(self, {}, epos)
 
+    def best(self, score, epos=None):
+        return best_forest(self, score, {}, epos)[1]
 
+
+@cython.no_gc
 @cython.cclass
 class Link:
-    inner: object
-    prev: object
+    inner = cython.declare(object, visibility='public')
+    prev = cython.declare(object, visibility='public')
+    label = cython.declare(object, visibility='public')
 
-    def __init__(self, inner: object, prev: object):
+    def __init__(self, inner: object, prev: object, label: object = emp):
         self.inner = inner
         self.prev = prev
+        self.label = label
 
     def __str__(self):
         sb = self.strOut([])
@@ -51,9 +76,177 @@ class Link:
     def strOut(self, sb):
         if self.prev:
             sb = self.prev.strOut(sb)
+        if self.label:
+            sb.append(self.label.decode('utf-8') + '=')
         sb.append(str(self.inner))
         return sb
 
+    def count(self):
+        return count_forest(self, {})
+
+    def trees(self):
+        return iter_forest(self, {})
+
+    def best(self, score):
+        return best_forest(self, score, {})[1]
+
+
+@cython.no_gc
+@cython.cclass
+class Amb:
+    alts = cython.declare(list, visibility='public')
+    sealed = cython.declare(cython.bint, visibility='public')
+
+    def __init__(self, alts: list):
+        self.alts = alts
+        self.sealed = False
+
+    def __str__(self):
+        return '[#? ' + ' '.join(map(str, self.alts)) + ']'
+
+    def strOut(self, sb):
+        sb.append(str(self))
+        return sb
+
+    def count(self):
+        return count_forest(self, {})
+
+    def trees(self):
+        return iter_forest(self, {})
+
+    def best(self, score):
+        return best_forest(self, score, {})[1]
+
+
+@cython.cfunc
+@cython.locals(a=Amb)
+@cython.returns(object)
+def pack(ast: object, ast2: object) -> object:
+    # an unsealed Amb is still owned by the running merge, so we can
+    # append to it in place instead of copying its alternatives
+    if ast is ast2:
+        return ast
+    if isinstance(ast, Amb) and not ast.sealed:
+        a = ast
+        a.alts.append(ast2)
+        return a
+    return Amb([ast, ast2])
+
+
+@cython.cfunc
+@cython.locals(ast=object)
+def seal(pos2ast: dict):
+    for ast in pos2ast.values():
+        if isinstance(ast, Amb):
+            ast.sealed = True
+
+
+def forest_size(node, visited):
+    if node is None or id(node) in visited:
+        return 0
+    visited.add(id(node))
+    if isinstance(node, Tree):
+        return 1 + forest_size(node.child, visited)
+    if isinstance(node, Link):
+        return 1 + forest_size(node.inner, visited) + forest_size(node.prev, visited)
+    if isinstance(node, Amb):
+        return 1 + sum([forest_size(a, visited) for a in node.alts])
+    return 0
+
+
+# Lazy views of a forest
+#  count_forest  number of derivations, without expanding them
+#  iter_forest   derivations one by one, in the order of the alternatives
+#  best_forest   the derivation with the highest sum of score(Tree)
+# The top-level '?' result holds one reading per end position; only the
+# readings ending at epos (a byte offset, by default the end of the
+# inputs) are counted.
+
+
+def results(t, epos=None):
+    if epos is None:
+        epos = len(t.inputs)
+    rs = []
+    cur = t.child
+    while cur is not None:
+        r = cur.inner
+        if r.epos == epos:
+            rs.append(r if r.child is None else r.child)
+        cur = cur.prev
+    return rs[::-1]
+
+
+def count_forest(node, memo, epos=None):
+    if node is None:
+        return 1
+    key = id(node)
+    if key in memo:
+        return memo[key]
+    if isinstance(node, Tree):
+        if node.tag == amb:
+            c = sum([count_forest(r, memo) for r in results(node, epos)])
+        else:
+            c = count_forest(node.child, memo)
+    elif isinstance(node, Link):
+        c = count_forest(node.inner, memo) * count_forest(node.prev, memo)
+    elif isinstance(node, Amb):
+        c = sum([count_forest(a, memo) for a in node.alts])
+    else:
+        c = 1
+    memo[key] = c
+    return c
+
+
+def iter_forest(node, memo, epos=None):
+    if isinstance(node, Tree) and node.tag == amb:
+        for r in results(node, epos):
+            yield from iter_forest(r, memo)
+    elif count_forest(node, memo) == 1:
+        # nothing to unpack; share the subtree as it is
+        yield node
+    elif isinstance(node, Amb):
+        for a in node.alts:
+            yield from iter_forest(a, memo)
+    elif isinstance(node, Link):
+        for prev in iter_forest(node.prev, memo):
+            for inner in iter_forest(node.inner, memo):
+                yield Link(inner, prev, node.label)
+    else:
+        for child in iter_forest(node.child, memo):
+            yield Tree(node.tag, node.inputs, node.spos, node.epos, child)
+
+
+def best_forest(node, score, memo, epos=None):
+    if node is None:
+        return 0, None
+    key = id(node)
+    if key in memo:
+        return memo[key]
+    if isinstance(node, Amb) or (isinstance(node, Tree) and node.tag == amb):
+        res = None
+        for a in (node.alts if isinstance(node, Amb) else results(node, epos)):
+            s, t = best_forest(a, score, memo)
+            if res is None or s > res[0]:
+                res = (s, t)
+        if res is None:
+            res = (0, None)
+    elif isinstance(node, Link):
+        s, inner = best_forest(node.inner, score, memo)
+        s2, prev = best_forest(node.prev, score, memo)
+        if inner is node.inner and prev is node.prev:
+            res = (s + s2, node)
+        else:
+            res = (s + s2, Link(inner, prev, node.label))
+    else:
+        s, child = best_forest(node.child, score, memo)
+        s += score(node)
+        if child is node.child:
+            res = (s, node)
+        else:
+            res = (s, Tree(node.tag, node.inputs, node.spos, node.epos, child))
+    memo[key] = res
+    return res
+
 
 @cython.cclass
 class GParserContext:
@@ -62,16 +255,21 @@ class GParserContext:
     length: cython.int
     headpos: cython.int
     pos2ast: dict
-    memo: dict
+    memo: list
+    occ: dict
 
-    def __init__(self, inputs: object, pos: cython.int, slen: cython.int):
+    def __init__(self, inputs: object, pos: cython.int, slen: cython.int, nrules: cython.int = 0):
         # s = bytes(inputs, 'utf-8') if isinstance(inputs, str) else bytes(inputs)
         s = inputs
         # self.inputs, self.pos, self.length = u.encsrc(urn, inputs, pos, slen)
         self.inputs, self.length = s, len(s)
         self.headpos = 0
         self.pos2ast = {pos: None}
-        self.memo = {}
+        # memo[rule id][pos] is None (not yet parsed) or a tuple of Trees,
+        # one per end position; tables are allocated on first use
+        self.memo = [None] * nrules
+        # occ[terminal] is the set of positions where the terminal matches
+        self.occ = {}
 
 
 @cython.cfunc
@@ -80,22 +278,49 @@ def check_empty(px: GParserContext, new_pos2ast: dict) -> cython.bint:
     if len(new_pos2ast) == 0:
         return False
     else:
+        seal(new_pos2ast)
         px.pos2ast = new_pos2ast
         return True
 
 
 @cython.cfunc
-@cython.locals(new_set=object, prev_set=object)
+def add(pos2ast: dict, pos: object, ast: object):
+    if pos in pos2ast:
+        pos2ast[pos] = pack(pos2ast[pos], ast)
+    else:
+        pos2ast[pos] = ast
+
+
+@cython.cfunc
+@cython.locals(pos=object, ast=object)
 @cython.returns(dict)
 def merge(new_pos2ast: dict, pos2ast: dict) -> dict:
-    new_set = new_pos2ast.keys()
-    prev_set = pos2ast.keys()
-    for i in new_set & prev_set:
-        new_pos2ast[i] = Link(pos2ast[i], Link(new_pos2ast[i], None))
-    for i in prev_set - new_set:
-        new_pos2ast[i] = pos2ast[i]
+    for pos, ast in pos2ast.items():
+        if pos in new_pos2ast:
+            new_pos2ast[pos] = pack(new_pos2ast[pos], ast)
+        else:
+            new_pos2ast[pos] = ast
     return new_pos2ast
 
+# Terminals over a set of positions
+#   A terminal tested against many live positions scans the inputs once
+#   per parse for its occurrences; positions that cannot match are then
+#   dropped by a set lookup, and a terminal that occurs at none of them
+#   fails with a single isdisjoint.
+
+BULK = 4
+
+
+@cython.cfunc
+@cython.returns(frozenset)
+def occurrences(px: GParserContext, f: object) -> frozenset:
+    occ = px.occ.get(f)
+    if occ is None:
+        occ = f.scan(px.inputs)
+        px.occ[f] = occ
+    return occ
+
+
 # ParseFunc
 
 # Empty
@@ -122,12 +347,31 @@ class GChar(ParseFunc):
         self.blen = blen
         self.bs = bs
 
+    def scan(self, inputs):
+        occ = []
+        pos = inputs.find(self.bs)
+        while pos != -1:
+            occ.append(pos)
+            pos = inputs.find(self.bs, pos + 1)
+        return frozenset(occ)
+
     @cython.cfunc
-    @cython.locals(new_pos2ast=dict, pos=cython.int, ast=object)
+    @cython.locals(new_pos2ast=dict, pos2ast=dict, occ=frozenset, pos=cython.int, ast=object)
     def p(self, px: GParserContext) -> cython.bint:
         new_pos2ast = {}
-        for pos, ast in px.pos2ast.items():
-            if px.inputs[pos:pos + self.blen] == self.bs:
+        pos2ast = px.pos2ast
+        if len(pos2ast) >= BULK:
+            occ = occurrences(px, self)
+            if occ.isdisjoint(pos2ast):
+                return False
+            for pos, ast in pos2ast.items():
+                if pos in occ:
+                    new_pos2ast[pos + self.blen] = Link(
+                        Tree(emp, px.inputs, pos, pos + self.blen, None), ast)
+                    px.headpos = max(pos, px.headpos)
+            return check_empty(px, new_pos2ast)
+        for pos, ast in pos2ast.items():
+            if px.inputs.startswith(self.bs, pos):
                 new_pos2ast[pos + self.blen] = Link(
                     Tree(emp, px.inputs, pos, pos + self.blen, None), ast)
                 px.headpos = max(pos, px.headpos)
@@ -138,6 +382,134 @@ def gen_GChar(pe: Char, **option):
     return GChar(bytes(pe.text, 'UTF-8'), len(bytes(pe.text, 'UTF-8')))
 
 
+# Any and Range consume one utf-8 character
+
+@cython.cfunc
+@cython.returns(cython.int)
+def utf8_len(b: cython.int) -> cython.int:
+    if b < 0x80:
+        return 1
+    if b < 0xE0:
+        return 2
+    if b < 0xF0:
+        return 3
+    return 4
+
+
+@cython.cclass
+class GAny(ParseFunc):
+
+    @cython.cfunc
+    @cython.locals(new_pos2ast=dict, pos=cython.int, epos=cython.int, ast=object)
+    def p(self, px: GParserContext) -> cython.bint:
+        new_pos2ast = {}
+        for pos, ast in px.pos2ast.items():
+            if pos < px.length:
+                epos = pos + utf8_len(px.inputs[pos])
+                new_pos2ast[epos] = Link(
+                    Tree(emp, px.inputs, pos, epos, None), ast)
+                px.headpos = max(pos, px.headpos)
+        return check_empty(px, new_pos2ast)
+
+
+def gen_GAny(pe: Any, **option):
+    return GAny()
+
+
+@cython.cclass
+class GRange(ParseFunc):
+    # ascii is tested by a table lookup on the byte itself; wider
+    # characters are decoded and looked up in chars or ranges.
+    # bitmap marks the ascii members with 1 and utf-8 lead bytes with 2.
+    bitmap: bytes
+    chars: frozenset
+    ranges: tuple
+
+    def __init__(self, bitmap: bytes, chars: frozenset, ranges: tuple):
+        self.bitmap = bitmap
+        self.chars = chars
+        self.ranges = ranges
+
+    @cython.cfunc
+    @cython.locals(c=cython.int, lo=cython.int, hi=cython.int)
+    @cython.returns(cython.bint)
+    def wide(self, c: cython.int) -> cython.bint:
+        if c in self.chars:
+            return True
+        for lo, hi in self.ranges:
+            if lo <= c <= hi:
+                return True
+        return False
+
+    def scan(self, inputs):
+        marks = inputs.translate(self.bitmap)
+        occ = []
+        pos = marks.find(1)
+        while pos != -1:
+            occ.append(pos)
+            pos = marks.find(1, pos + 1)
+        pos = marks.find(2)
+        while pos != -1:
+            epos = pos + utf8_len(inputs[pos])
+            if self.wide(ord(inputs[pos:epos].decode('utf-8', 'replace')[0])):
+                occ.append(pos)
+            pos = marks.find(2, pos + 1)
+        return frozenset(occ)
+
+    @cython.cfunc
+    @cython.locals(new_pos2ast=dict, pos2ast=dict, occ=frozenset, pos=cython.int,
+                   epos=cython.int, ast=object, b=cython.int)
+    def p(self, px: GParserContext) -> cython.bint:
+        new_pos2ast = {}
+        pos2ast = px.pos2ast
+        if len(pos2ast) >= BULK:
+            occ = occurrences(px, self)
+            if occ.isdisjoint(pos2ast):
+                return False
+            for pos, ast in pos2ast.items():
+                if pos in occ:
+                    epos = pos + utf8_len(px.inputs[pos])
+                    new_pos2ast[epos] = Link(
+                        Tree(emp, px.inputs, pos, epos, None), ast)
+                    px.headpos = max(pos, px.headpos)
+            return check_empty(px, new_pos2ast)
+        for pos, ast in pos2ast.items():
+            if pos < px.length:
+                b = px.inputs[pos]
+                if b < 0x80:
+                    if not self.bitmap[b]:
+                        continue
+                    epos = pos + 1
+                else:
+                    epos = pos + utf8_len(b)
+                    if not self.wide(ord(px.inputs[pos:epos].decode('utf-8', 'replace')[0])):
+                        continue
+                new_pos2ast[epos] = Link(
+                    Tree(emp, px.inputs, pos, epos, None), ast)
+                px.headpos = max(pos, px.headpos)
+        return check_empty(px, new_pos2ast)
+
+
+def gen_GRange(pe: Range, **option):
+    bitmap = bytearray(0x100)
+    chars = set()
+    ranges = []
+    for c in pe.chars:
+        if ord(c) < 0x80:
+            bitmap[ord(c)] = 1
+        else:
+            chars.add(ord(c))
+    for c, c2 in pe.ranges:
+        lo, hi = ord(c), ord(c2)
+        for b in range(lo, min(hi + 1, 0x80)):
+            bitmap[b] = 1
+        if hi >= 0x80:
+            ranges.append((max(lo, 0x80), hi))
+    if chars or ranges:
+        bitmap[0xC0:] = b'\x02' * 0x40
+    return GRange(bytes(bitmap), frozenset(chars), tuple(ranges))
+
+
 # Seq
 @cython.cclass
 class GSeq(ParseFunc):
@@ -149,17 +521,10 @@ class GSeq(ParseFunc):
         self.right = right
 
     @cython.cfunc
-    @cython.locals(new_pos2ast=dict)
     def p(self, px: GParserContext) -> cython.bint:
-        new_pos2ast = {}
-        for pos, ast in copy(px.pos2ast).items():
-            px.pos2ast = {pos: ast}
-            if self.left.p(px):
-                for pos, ast in copy(px.pos2ast).items():
-                    px.pos2ast = {pos: ast}
-                    if self.right.p(px):
-                        new_pos2ast = merge(new_pos2ast, px.pos2ast)
-        return check_empty(px, new_pos2ast)
+        # both sides take the whole set of positions, so terminals on the
+        # right see every position the left can reach at once
+        return self.left.p(px) and self.right.p(px)
 
 
 def gen_GSeq(pe: Seq, **option):
@@ -177,10 +542,11 @@ class GOre(ParseFunc):
         self.right = right
 
     @cython.cfunc
-    @cython.locals(new_pos2ast=dict)
+    @cython.locals(new_pos2ast=dict, pos2ast=dict)
     def p(self, px: GParserContext) -> cython.bint:
         new_pos2ast = {}
-        for pos, ast in copy(px.pos2ast).items():
+        pos2ast = px.pos2ast
+        for pos, ast in pos2ast.items():
             px.pos2ast = {pos: ast}
             if self.left.p(px):
                 new_pos2ast = merge(new_pos2ast, px.pos2ast)
@@ -205,20 +571,17 @@ class GAlt(ParseFunc):
         self.right = right
 
     @cython.cfunc
-    @cython.locals(new_pos2ast=dict)
+    @cython.locals(new_pos2ast=dict, pos2ast=dict)
     def p(self, px: GParserContext) -> cython.bint:
+        # unlike Ore, both sides are tried at every position, so the whole
+        # set goes to each side and the results are merged
         new_pos2ast = {}
-        for pos, ast in copy(px.pos2ast).items():
-            px.pos2ast = {pos: ast}
-            if self.left.p(px):
-                new_pos2ast = merge(new_pos2ast, px.pos2ast)
-                px.pos2ast = {pos: ast}
-                if self.right.p(px):
-                    new_pos2ast = merge(new_pos2ast, px.pos2ast)
-            else:
-                px.pos2ast = {pos: ast}
-                if self.right.p(px):
-                    new_pos2ast = merge(new_pos2ast, px.pos2ast)
+        pos2ast = px.pos2ast
+        if self.left.p(px):
+            new_pos2ast = merge(new_pos2ast, px.pos2ast)
+        px.pos2ast = pos2ast
+        if self.right.p(px):
+            new_pos2ast = merge(new_pos2ast, px.pos2ast)
         return check_empty(px, new_pos2ast)
 
 
@@ -226,6 +589,104 @@ def gen_GAlt(pe: Alt, **option):
     return GAlt(pe.left.gen(**option), pe.right.gen(**option))
 
 
+# And, Not
+@cython.cclass
+class GAnd(ParseFunc):
+    inner: ParseFunc
+
+    def __init__(self, inner: ParseFunc):
+        self.inner = inner
+
+    @cython.cfunc
+    @cython.locals(new_pos2ast=dict, pos2ast=dict)
+    def p(self, px: GParserContext) -> cython.bint:
+        new_pos2ast = {}
+        pos2ast = px.pos2ast
+        for pos, ast in pos2ast.items():
+            px.pos2ast = {pos: None}
+            if self.inner.p(px):
+                new_pos2ast[pos] = ast
+        return check_empty(px, new_pos2ast)
+
+
+def gen_GAnd(pe: And, **option):
+    return GAnd(pe.inner.gen(**option))
+
+
+@cython.cclass
+class GNot(ParseFunc):
+    inner: ParseFunc
+
+    def __init__(self, inner: ParseFunc):
+        self.inner = inner
+
+    @cython.cfunc
+    @cython.locals(new_pos2ast=dict, pos2ast=dict)
+    def p(self, px: GParserContext) -> cython.bint:
+        new_pos2ast = {}
+        pos2ast = px.pos2ast
+        for pos, ast in pos2ast.items():
+            px.pos2ast = {pos: None}
+            if not self.inner.p(px):
+                new_pos2ast[pos] = ast
+        return check_empty(px, new_pos2ast)
+
+
+def gen_GNot(pe: Not, **option):
+    return GNot(pe.inner.gen(**option))
+
+
+# Many
+@cython.cclass
+class GMany(ParseFunc):
+    # Positions only grow inside a repetition, so the live positions are
+    # visited in increasing order and each one is expanded once, after
+    # every path reaching it has been packed.
+    inner: ParseFunc
+
+    def __init__(self, inner: ParseFunc):
+        self.inner = inner
+
+    @cython.cfunc
+    @cython.locals(new_pos2ast=dict, pending=dict, heap=list, pos=cython.int,
+                   ast=object, npos=cython.int, nast=object, progress=cython.bint)
+    def p(self, px: GParserContext) -> cython.bint:
+        new_pos2ast = {}
+        pending = dict(px.pos2ast)
+        heap = list(pending)
+        heapify(heap)
+        while heap:
+            pos = heappop(heap)
+            ast = pending.pop(pos)
+            px.pos2ast = {pos: ast}
+            progress = False
+            if self.inner.p(px):
+                for npos, nast in px.pos2ast.items():
+                    if npos > pos:
+                        progress = True
+                        if npos in pending:
+                            pending[npos] = pack(pending[npos], nast)
+                        else:
+                            pending[npos] = nast
+                            heappush(heap, npos)
+            if not progress:
+                add(new_pos2ast, pos, ast)
+        return check_empty(px, new_pos2ast)
+
+
+def gen_GMany(pe: Many, **option):
+    return GMany(pe.inner.gen(**option))
+
+
+def gen_GMany1(pe: Many1, **option):
+    inner = pe.inner.gen(**option)
+    return GSeq(inner, GMany(inner))
+
+
+def gen_GEmpty(pe: Empty, **option):
+    return ParseFunc()
+
+
 memo = {}
 
 # RecRef
@@ -251,37 +712,36 @@ class RecRef(ParseFunc):
 class GMemo(ParseFunc):
 
     name: object
+    rid: cython.int
     inner: ParseFunc
 
-    def __init__(self, name: object, inner: ParseFunc):
+    def __init__(self, name: object, rid: cython.int, inner: ParseFunc):
         self.name = name
+        self.rid = rid
         self.inner = inner
 
     @cython.cfunc
-    @cython.locals(pos=cython.int, epos=cython.int, ast=object, east=object, new_pos2ast=dict)
+    @cython.locals(pos=cython.int, ast=object, epos=object, east=object, t=Tree,
+                   table=list, trees=tuple, new_pos2ast=dict, pos2ast=dict)
     def p(self, px: GParserContext) -> cython.bint:
         new_pos2ast = {}
-        for pos, ast in px.pos2ast.items():
-            entry = (pos, self.name)
-            if entry in px.memo:
-                memo = px.memo[entry]
-                if memo:
-                    linked_memo = {}
-                    for epos, east in memo.items():
-                        linked_memo[epos] = Link(east, ast)
-                    new_pos2ast = merge(new_pos2ast, linked_memo)
-            else:
+        table = px.memo[self.rid]
+        if table is None:
+            table = [None] * (px.length + 1)
+            px.memo[self.rid] = table
+        pos2ast = px.pos2ast
+        for pos, ast in pos2ast.items():
+            trees = table[pos]
+            if trees is None:
                 px.pos2ast = {pos: None}
                 if self.inner.p(px):
-                    memo = {}
-                    for epos, east in px.pos2ast.items():
-                        memo[epos] = Tree(
-                            self.name, px.inputs, pos, epos, east)
-                        px.pos2ast[epos] = Link(memo[epos], ast)
-                    px.memo[entry] = memo
-                    new_pos2ast = merge(new_pos2ast, px.pos2ast)
+                    trees = tuple([Tree(self.name, px.inputs, pos, epos, east)
+                                   for epos, east in px.pos2ast.items()])
                 else:
-                    px.memo[entry] = None
+                    trees = ()
+                table[pos] = trees
+            for t in trees:
+                add(new_pos2ast, t.epos, Link(t, ast))
         return check_empty(px, new_pos2ast)
 
 
@@ -290,9 +750,16 @@ def emit_GRef(ref: Ref, **option):
     key = ref.uname()
     generated = option['generated']
     if not key in generated:
+        rules = option['rules']
+        rid = len(rules)
+        rules.append(key)
         generated[key] = RecRef(key, generated)
-        generated[key] = GMemo(bytes(ref.name, 'utf-8'),
-                               ref.deref().gen(**option))
+        pe = ref.deref()
+        name = ref.name
+        if isinstance(pe, Node):
+            # the symbol node of the rule carries the tag of its top node
+            pe, name = pe.inner, pe.node or name
+        generated[key] = GMemo(bytes(name, 'utf-8'), rid, pe.gen(**option))
     return generated[key]
 
 
@@ -311,22 +778,21 @@ class GNode(ParseFunc):
         self.node = node
 
     @cython.cfunc
-    @cython.locals(spos=cython.int, epos=cython.int, sast=object, east=object, new_pos2ast=dict)
+    @cython.locals(spos=cython.int, sast=object, east=object, new_pos2ast=dict, pos2ast=dict)
     def p(self, px: GParserContext) -> cython.bint:
         new_pos2ast = {}
-        for spos, sast in copy(px.pos2ast).items():
-            px.pos2ast = {spos: sast}
+        pos2ast = px.pos2ast
+        for spos, sast in pos2ast.items():
+            px.pos2ast = {spos: None}
             if self.inner.p(px):
-                for epos, east in copy(px.pos2ast).items():
-                    px.pos2ast[epos] = Link(
-                        Tree(self.node, px.inputs, spos, epos, east), None)
-                new_pos2ast = merge(new_pos2ast, px.pos2ast)
+                for epos, east in px.pos2ast.items():
+                    add(new_pos2ast, epos, Link(
+                        Tree(self.node, px.inputs, spos, epos, east), sast))
         return check_empty(px, new_pos2ast)
 
 
 def gen_GNode(pe: Node, **option):
-    # GNode(pe.inner.gen(**option), pe.node)
-    return pe.inner.gen(**option)
+    return GNode(pe.inner.gen(**option), bytes(pe.node, 'utf-8'))
 
 
 # Edge
@@ -340,29 +806,125 @@ class GEdge(ParseFunc):
         self.edge = edge
 
     @cython.cfunc
+    @cython.locals(spos=cython.int, sast=object, east=object, child=object, new_pos2ast=dict, pos2ast=dict)
+    def p(self, px: GParserContext) -> cython.bint:
+        new_pos2ast = {}
+        pos2ast = px.pos2ast
+        for spos, sast in pos2ast.items():
+            px.pos2ast = {spos: None}
+            if self.inner.p(px):
+                for epos, east in px.pos2ast.items():
+                    if isinstance(east, Link) and east.prev is None:
+                        child = east.inner
+                    else:
+                        child = Tree(emp, px.inputs, spos, epos, east)
+                    add(new_pos2ast, epos, Link(child, sast, self.edge))
+        return check_empty(px, new_pos2ast)
+
+
+def gen_GEdge(pe: Edge, **option):
+    if pe.edge == '':
+        # an unlabeled edge adds nothing to the family
+        return pe.inner.gen(**option)
+    return GEdge(pe.inner.gen(**option), bytes(pe.edge, 'utf-8'))
+
+
+# Fold
+def splits(ast):
+    # (prev, last child) for each family packed in ast
+    if isinstance(ast, Link):
+        return [(ast.prev, ast.inner)]
+    if isinstance(ast, Amb):
+        return [s for a in ast.alts for s in splits(a)]
+    return [(None, None)]
+
+
+@cython.cclass
+class GFold(ParseFunc):
+    inner: ParseFunc
+    edge: object
+    node: object
+
+    def __init__(self, inner: ParseFunc, edge: object, node: object):
+        self.inner = inner
+        self.edge = edge
+        self.node = node
+
+    @cython.cfunc
+    @cython.locals(spos=cython.int, lpos=cython.int, sast=object, east=object, prev=object,
+                   left=object, new_pos2ast=dict, pos2ast=dict)
     def p(self, px: GParserContext) -> cython.bint:
-        return self.inner.p(px)
+        new_pos2ast = {}
+        pos2ast = px.pos2ast
+        for spos, sast in pos2ast.items():
+            for prev, left in splits(sast):
+                lpos = left.spos if isinstance(left, Tree) else spos
+                px.pos2ast = {spos: None if left is None else Link(left, None, self.edge)}
+                if self.inner.p(px):
+                    for epos, east in px.pos2ast.items():
+                        add(new_pos2ast, epos, Link(
+                            Tree(self.node, px.inputs, lpos, epos, east), prev))
+        return check_empty(px, new_pos2ast)
+
+
+def gen_GFold(pe: Fold, **option):
+    return GFold(pe.inner.gen(**option), bytes(pe.edge, 'utf-8'), bytes(pe.node, 'utf-8'))
+
+
+# Abs
+@cython.cclass
+class GAbs(ParseFunc):
+    inner: ParseFunc
+
+    def __init__(self, inner: ParseFunc):
+        self.inner = inner
+
+    @cython.cfunc
+    @cython.locals(new_pos2ast=dict, pos2ast=dict)
+    def p(self, px: GParserContext) -> cython.bint:
+        new_pos2ast = {}
+        pos2ast = px.pos2ast
+        for pos, ast in pos2ast.items():
+            px.pos2ast = {pos: ast}
+            if self.inner.p(px):
+                for epos in px.pos2ast:
+                    add(new_pos2ast, epos, ast)
+        return check_empty(px, new_pos2ast)
+
+
+def gen_GAbs(pe: Abs, **option):
+    return GAbs(pe.inner.gen(**option))
 
 
-def gen_GEdge(pe, **option):
-    # return GEdge(pe.inner.gen(**option), pe.edge)
+def gen_GAction(pe: Action, **option):
+    # symbol tables and other actions are not generalized yet
     return pe.inner.gen(**option)
 
 
+Empty.gen = gen_GEmpty
 Ref.gen = gen_GRef
 Char.gen = gen_GChar
+Range.gen = gen_GRange
+Any.gen = gen_GAny
 Seq.gen = gen_GSeq
 Ore.gen = gen_GOre
 Alt.gen = gen_GAlt
+And.gen = gen_GAnd
+Not.gen = gen_GNot
+Many.gen = gen_GMany
+Many1.gen = gen_GMany1
 Node.gen = gen_GNode
 Edge.gen = gen_GEdge
+Fold.gen = gen_GFold
+Abs.gen = gen_GAbs
+Action.gen = gen_GAction
 
 
 def collect_amb(s, urn, pos, result):
     is_first = True
     for result_pos, r in result.items():
-        if r == None:
-            r = Tree(emp, s, pos, result_pos, None)
+        # each reading keeps its end position
+        r = Tree(emp, s, pos, result_pos, r)
         if is_first:
             prev = Link(r, None)
             is_first = False
@@ -380,15 +942,26 @@ def cgpeg(peg, **option):
     name = option.get('start', peg.start())
     option['peg'] = peg
     option['generated'] = {}
+    option['rules'] = []
     f = gen_GRef(Ref(name, peg, {}), **option)
+    rules = option['rules']
 
     def parse(inputs, urn='(unknown)', pos=0, epos=None):
         if not epos:
             epos = len(inputs)
-        px = GParserContext(bytes(inputs, 'UTF-8'), pos, epos)
-        if not call_p(f, px):
-            return Tree(err, px.inputs, px.headpos, epos, None)
-        elif len(px.pos2ast) == 1:
+        # positions are byte offsets into the utf-8 encoded inputs
+        s = bytes(inputs[:epos], 'UTF-8')
+        pos, epos = len(bytes(inputs[:pos], 'UTF-8')), len(s)
+        px = GParserContext(s, pos, epos, len(rules))
+        gcenabled = gc.isenabled()
+        gc.disable()
+        try:
+            if not call_p(f, px):
+                return Tree(err, px.inputs, px.headpos, epos, None)
+        finally:
+            if gcenabled:
+                gc.enable()
+        if len(px.pos2ast) == 1:
             (result_pos, result_ast) = list(px.pos2ast.items())[0]
             if result_ast == None:
                 return Tree(emp, px.inputs, pos, result_pos, None)
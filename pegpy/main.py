@@ -90,6 +90,8 @@ def parse_options(argv):
         'parser': ['-p', '--parser'],
         'output': ['-o', '--output'],
         'verbose': ['--verbose'],
+        'watchdog': ['--watchdog'],
+        'optimize': ['-O', '--optimize'],
     }
 
     def parse_each(a, d):
@@ -121,7 +123,10 @@ def usage():
     print("Usage: pegpy <command> options inputs")
     print("  -g | --grammar <file>      specify a grammar file")
     print("  -s | --start <NAME>        specify a starting rule")
+    print("  -p | --parser <module>     specify a parser engine (e.g. pegpy.vm)")
     print("  -o | --output <file>       specify an output file")
+    print("  --watchdog <N>             warn about rules evaluated N times at one position (0: off)")
+    print("  -O | --optimize 1          run the grammar optimizer passes before parsing")
     print("  -D                         specify an optional value")
     print()
 
@@ -134,6 +139,8 @@ def usage():
     print("The most commonly used nez commands are:")
     print(" parse      run an interactive parser")
     print(" function   generate a parser combinator function")
+    print(" optimize   show what each grammar optimizer pass rewrites")
+    print(" lint       list costly grammar constructs, most costly first")
     print(" example    test all examples")
     print(" update     update pegpy (via pip)")
 
@@ -145,14 +152,22 @@ def load_grammar(options, default=None):
     if file == 'stdin.tpeg':
         data = sys.stdin.read()
         options['basepath'] = file
-        return pegpy.grammar(data, **options)
-    return pegpy.grammar(file, **options)
+        peg = pegpy.grammar(data, **options)
+    else:
+        peg = pegpy.grammar(file, **options)
+    if int(options.get('optimize', 0)):
+        from pegpy.optimizer import optimize
+        peg = optimize(peg, **options)
+    return peg
 
 
 def generator(options):
     if 'parser' in options:
-        m = importlib.import_module(options['parser'])
-        return m.generate
+        try:
+            m = importlib.import_module(options['parser'])
+            return m.generate
+        except ImportError as e:
+            log('warning', None, f'{e}; using the default parser')
     return pegpy.generate
 
 
@@ -161,8 +176,10 @@ def generator(options):
 
 def parse(options, conv=None):
     peg = load_grammar(options)
-    parser = generator(options)(peg, **options)
     inputs = options['inputs']
+    # a few inputs exercise a few rules; compile them on first use
+    options.setdefault('lazy', len(inputs) <= 1)
+    parser = generator(options)(peg, **options)
     if len(inputs) == 0:  # Interactive Mode
         try:
             while True:
@@ -199,13 +216,14 @@ def example(options):
     peg = load_grammar(options)
     if '@@example' not in peg:
         return
+    generate = generator(options)
     parsers = {}
     for testcase in peg['@@example']:
         name, doc = testcase
         if not name in peg:
             continue
         if not name in parsers:
-            parsers[name] = generator(options)(peg, start=name)
+            parsers[name] = generate(peg, start=name)
         res = parsers[name](doc.inputs_, doc.urn_, doc.spos_, doc.epos_)
         print(bold(f'parsing {name}'))
         ok = doc.inputs_[doc.spos_:res.epos_]
@@ -216,16 +234,17 @@ def example(options):
 
 def test(options):
     peg = load_grammar(options)
+    generate = generator(options)
     parsers = {}
     test = 0
     ok = 0
     for testcase in peg['@@example']:
-        name, pos4 = testcase
+        name, doc = testcase
         if not name in peg:
             continue
         if not name in parsers:
-            parsers[name] = generator(options)(peg, start=name)
-        res = parsers[name](pos4.inputs, pos4.urn, pos4.spos, pos4.epos)
+            parsers[name] = generate(peg, start=name)
+        res = parsers[name](doc.inputs_, doc.urn_, doc.spos_, doc.epos_)
         if res == 'err':
             log('error', res, name)
         else:
@@ -243,9 +262,38 @@ def peg(options):
 def function(options):
     from pegpy.nezcc import nezcc
     inputs = options['inputs']
-    file = 'pegpy.json' if len(inputs) == 0 else f[0]
+    file = 'pegpy.json' if len(inputs) == 0 else inputs[0]
     peg = load_grammar(options)
-    nezcc(inputs[0], peg, **options)
+    nezcc(file, peg, **options)
+
+
+def lint(options):
+    from pegpy.tpeg import grammar, lint
+    file = options.get('grammar', None)
+    if file is None:
+        raise CommandUsageError()
+    errors = []
+
+    def logger(type, pos, *msg):
+        if type.endswith('error'):
+            errors.append(msg)
+        log(type, pos, *msg)
+    peg = grammar(file, logger=logger)
+    if len(errors) > 0:
+        print(f'{file}: not linted; the grammar has {len(errors)} error(s)')
+        sys.exit(1)
+    findings = lint(peg)
+    for cost, name, msg in findings:
+        print(f'{cost:>6}  {bold(name)}: {msg}')
+    print(len(findings), 'findings')
+
+
+def optimize(options):
+    from pegpy.optimizer import PassManager
+    peg = load_grammar(dict(options, optimize=0))
+    pm = PassManager(**options)
+    pm.run(peg)
+    pm.report()
 
 
 '''
@@ -1,59 +1,60 @@
-#cython: langauge_level=3
+#cython: language_level=3
 import cython
-# from libc.string cimport memcmp
+from pegpy import tpeg2
+from pegpy.tpeg2 import Ref, Char, Range, Node, Fold, Action, Tuple, Unary, State
+from pegpy.tpeg2 import inline, unique_range, PTree2ParseTree
 
-if cython.compiled:
-    print("Yep, I'm compiled.")
-else:
-    print("Just a lowly interpreted script.")
+# Deterministic PEG parse functions over tpeg2 grammars.
+# The parse tree is built as a reversed list of Tree (the same layout as
+# tpeg2.PTree), so PTree2ParseTree turns it into a ParseTree.
 
 
 @cython.cclass
 class ParserContext:
-    #__slots__ = ['inputs', 'length', 'pos', 'headpos', 'ast', 'state', 'dict', 'memo']
-    inputs: cython.p_char
-    length: cython.int
+    inputs: str
     pos: cython.int
+    epos: cython.int
     headpos: cython.int
     ast: object
+    state: object
+    memos = cython.declare(list, visibility='readonly')
+    dicts: dict
 
-    def __init__(self, inputs: cython.p_char, pos: cython.int, slen: cython.int):
+    def __init__(self, inputs: str, pos: cython.int, epos: cython.int, nmemos: cython.int = 0):
         self.inputs = inputs
         self.pos = pos
-        self.length = slen
-        self.headpos = self.pos
+        self.epos = epos
+        self.headpos = pos
         self.ast = None
-        #self.ast = None
-        # #self.state = None
-        # #self.dict = {}
-        # #self.memo = {}
+        self.state = None
+        # memos[memo id] maps a position to a parsed result
+        self.memos = [{} for _ in range(nmemos)]
+        # dicts[name] is a symbol dictionary built by @def
+        self.dicts = {}
 
 
 @cython.cclass
 class Tree:
-    #__slots__ = ['inputs', 'length', 'pos', 'headpos', 'ast', 'state', 'dict', 'memo']
+    prev = cython.declare(object, visibility='public')
     tag = cython.declare(object, visibility='public')
     spos = cython.declare(cython.int, visibility='public')
     epos = cython.declare(cython.int, visibility='public')
     child = cython.declare(object, visibility='public')
 
-    def __init__(self, tag: object, spos: cython.int, epos: cython.int, child: object):
+    def __init__(self, prev: object, tag: object, spos: cython.int, epos: cython.int, child: object):
+        self.prev = prev
         self.tag = tag
         self.spos = spos
         self.epos = epos
         self.child = child
 
+    def isEdge(self):
+        return self.epos < 0
 
-@cython.cclass
-class Link:
-    label = cython.declare(object, visibility='public')
-    child = cython.declare(object, visibility='public')
-    prev = cython.declare(object, visibility='public')
 
-    def __init__(self, label: object, child: object, prev: object):
-        self.label = label
-        self.child = child
-        self.prev = prev
+@cython.cfunc
+def max2(a: cython.int, b: cython.int) -> cython.int:
+    return a if a > b else b
 
 # Empty
 
@@ -70,49 +71,93 @@ class ParseFunc:
 
 # Char
 @cython.cclass
-class Char(ParseFunc):
-    bs: cython.p_char
-    blen: cython.int
+class Char1(ParseFunc):
+    c: cython.long
 
-    def __init__(self, chars: bytes, blen: int):
-        self.bs = chars
-        self.len = blen
+    def __init__(self, text: str):
+        self.c = ord(text)
 
     @cython.cfunc
     def p(self, px: ParserContext) -> cython.bint:
-        if memcmp(px.inputs + px.pos, self.bs, self.blen) == 0:
-            px.pos += self.blen
+        if px.pos < px.epos and ord(px.inputs[px.pos]) == self.c:
+            px.pos += 1
+            return 1
+        return 0
+
+
+@cython.cclass
+class CharN(ParseFunc):
+    text: str
+    clen: cython.int
+
+    def __init__(self, text: str):
+        self.text = text
+        self.clen = len(text)
+
+    @cython.cfunc
+    def p(self, px: ParserContext) -> cython.bint:
+        if px.inputs.startswith(self.text, px.pos, px.epos):
+            px.pos += self.clen
             return 1
         return 0
 
 
 def gen_Char(pe, **option):
-    return Char(pe.a, len(pe.a))
+    if len(pe.text) == 0:
+        return ParseFunc()
+    if len(pe.text) == 1:
+        return Char1(pe.text)
+    return CharN(pe.text)
 
 # Any
 
 
 @cython.cclass
-class Any(ParseFunc):
-
-    def __init__(self):
-        pass
+class Any1(ParseFunc):
 
     @cython.cfunc
     def p(self, px: ParserContext) -> cython.bint:
-        if px.pos < px.length:
+        if px.pos < px.epos:
             px.pos += 1
             return 1
         return 0
 
 
 def gen_Any(pe, **option):
-    return Any(pe.a, len(pe.a))
+    return Any1()
 
+# Range
 
-@cython.cfunc
-def max2(a: cython.int, b: cython.int) -> cython.bint:
-    return a if a > b else b
+
+@cython.cclass
+class Range1(ParseFunc):
+    # ascii is looked up in a table, wider characters in a bitset
+    table: bytes
+    bitset: object
+
+    def __init__(self, table: bytes, bitset: object):
+        self.table = table
+        self.bitset = bitset
+
+    @cython.cfunc
+    @cython.locals(c=cython.long)
+    def p(self, px: ParserContext) -> cython.bint:
+        if px.pos < px.epos:
+            c = ord(px.inputs[px.pos])
+            if c < 128:
+                if self.table[c]:
+                    px.pos += 1
+                    return 1
+            elif (self.bitset >> c) & 1:
+                px.pos += 1
+                return 1
+        return 0
+
+
+def gen_Range(pe, **option):
+    bitset = unique_range(pe.chars, pe.ranges)
+    table = bytes([(bitset >> c) & 1 for c in range(128)])
+    return Range1(table, bitset)
 
 # And
 
@@ -138,7 +183,7 @@ class And(ParseFunc):
 
 
 def gen_And(pe, **option):
-    pf = option['emit'](pe.inner, **option)
+    pf = option['emit'](pe.e, **option)
     return And(pf)
 
 # Not
@@ -165,7 +210,7 @@ class Not(ParseFunc):
 
 
 def gen_Not(pe, **option):
-    pf = option['emit'](pe.inner, **option)
+    pf = option['emit'](pe.e, **option)
     return Not(pf)
 
 # Many
@@ -183,7 +228,7 @@ class Many(ParseFunc):
     def p(self, px: ParserContext) -> cython.bint:
         pos = px.pos
         ast = px.ast
-        while self.f0.p(px):
+        while self.f0.p(px) and pos < px.pos:
             pos = px.pos
             ast = px.ast
         px.headpos = max2(px.pos, px.headpos)
@@ -193,10 +238,10 @@ class Many(ParseFunc):
 
 
 def gen_Many(pe, **option):
-    pf = option['emit'](pe.inner, **option)
+    pf = option['emit'](pe.e, **option)
     return Many(pf)
 
-# Many
+# Many1
 
 
 @cython.cclass
@@ -212,7 +257,7 @@ class Many1(ParseFunc):
         if self.f0.p(px):
             pos = px.pos
             ast = px.ast
-            while self.f0.p(px):
+            while self.f0.p(px) and pos < px.pos:
                 pos = px.pos
                 ast = px.ast
             px.headpos = max2(px.pos, px.headpos)
@@ -223,9 +268,35 @@ class Many1(ParseFunc):
 
 
 def gen_Many1(pe, **option):
-    pf = option['emit'](pe.inner, **option)
+    pf = option['emit'](pe.e, **option)
     return Many1(pf)
 
+# Option
+
+
+@cython.cclass
+class Option(ParseFunc):
+    f0: ParseFunc
+
+    def __init__(self, f0: ParseFunc):
+        self.f0 = f0
+
+    @cython.cfunc
+    @cython.locals(pos=cython.int, ast=object)
+    def p(self, px: ParserContext) -> cython.bint:
+        pos = px.pos
+        ast = px.ast
+        if not self.f0.p(px):
+            px.headpos = max2(px.pos, px.headpos)
+            px.pos = pos
+            px.ast = ast
+        return 1
+
+
+def gen_Option(pe, **option):
+    pf = option['emit'](pe.e, **option)
+    return Option(pf)
+
 # Seq
 
 
@@ -244,9 +315,11 @@ class Seq2(ParseFunc):
 
 
 def gen_Seq(pe, **option):
-    f0 = option['emit'](pe.left, **option)
-    f1 = option['emit'](pe.right, **option)
-    return Seq2(f0, f1)
+    pfs = [option['emit'](e, **option) for e in pe]
+    pf = pfs[-1]
+    for f0 in reversed(pfs[:-1]):
+        pf = Seq2(f0, pf)
+    return pf
 
 # Ore
 
@@ -261,6 +334,7 @@ class Ore2(ParseFunc):
         self.f1 = f1
 
     @cython.cfunc
+    @cython.locals(pos=cython.int, ast=object)
     def p(self, px: ParserContext) -> cython.bint:
         pos = px.pos
         ast = px.ast
@@ -272,16 +346,145 @@ class Ore2(ParseFunc):
         return self.f1.p(px)
 
 
+@cython.cclass
+class Dict(ParseFunc):
+    # a choice of strings; the first character selects the candidates,
+    # which are then tried in the order of the choice
+    dic: dict
+    empty: cython.bint
+
+    def __init__(self, dic: dict, empty: cython.bint):
+        self.dic = dic
+        self.empty = empty
+
+    @cython.cfunc
+    @cython.locals(ss=tuple, s=str)
+    def p(self, px: ParserContext) -> cython.bint:
+        if px.pos < px.epos:
+            ss = self.dic.get(px.inputs[px.pos])
+            if ss is not None:
+                for s in ss:
+                    if px.inputs.startswith(s, px.pos, px.epos):
+                        px.pos += len(s)
+                        return 1
+        return self.empty
+
+
 def gen_Ore(pe, **option):
-    f0 = option['emit'](pe.left, **option)
-    f1 = option['emit'](pe.right, **option)
-    return Ore2(f0, f1)
+    if pe.isDict():
+        dic = {}
+        texts = [e.text for e in pe]
+        for s in pe.listDict():
+            dic.setdefault(s[0], []).append(s)
+        return Dict({c: tuple(ss) for c, ss in dic.items()}, '' in texts)
+    pfs = [option['emit'](e, **option) for e in pe]
+    pf = pfs[-1]
+    for f0 in reversed(pfs[:-1]):
+        pf = Ore2(f0, pf)
+    return pf
 
 
 def gen_Alt(pe, **option):
-    f0 = option['emit'](pe.left, **option)
-    f1 = option['emit'](pe.right, **option)
-    return Ore2(f0, f1)
+    # deterministic; the first alternative that matches wins
+    return gen_Ore(pe, **option)
+
+# Ref
+
+
+@cython.cclass
+class RecRef(ParseFunc):
+    # stands for a rule that is still being generated
+    f0 = cython.declare(ParseFunc, visibility='public')
+
+    @cython.cfunc
+    def p(self, px: ParserContext) -> cython.bint:
+        return self.f0.p(px)
+
+
+@cython.cfunc
+def attach(prev: object, ast: object) -> object:
+    # copies a memoized list of nodes onto the current one
+    if ast is None:
+        return prev
+    return Tree(attach(prev, ast.prev), ast.tag, ast.spos, ast.epos, ast.child)
+
+
+@cython.cclass
+class Memo(ParseFunc):
+    # memo entries are (state, end position or -1, nodes, state after)
+    mid: cython.int
+    f0: ParseFunc
+
+    def __init__(self, mid: cython.int, f0: ParseFunc):
+        self.mid = mid
+        self.f0 = f0
+
+    @cython.cfunc
+    @cython.locals(table=dict, m=tuple, key=cython.int, prev=object, state=object, ast=object)
+    def p(self, px: ParserContext) -> cython.bint:
+        table = px.memos[self.mid]
+        key = px.pos
+        m = table.get(key)
+        if m is not None and m[0] is px.state:
+            if m[1] < 0:
+                return 0
+            px.pos = m[1]
+            px.ast = attach(px.ast, m[2])
+            px.state = m[3]
+            return 1
+        prev = px.ast
+        state = px.state
+        px.ast = None
+        if self.f0.p(px):
+            ast = px.ast
+            table[key] = (state, px.pos, ast, px.state)
+            px.ast = attach(prev, ast)
+            return 1
+        table[key] = (state, -1, None, None)
+        px.ast = prev
+        return 0
+
+
+def folding(pe):
+    # True if pe may fold the node made before it
+    if isinstance(pe, Fold):
+        return True
+    if isinstance(pe, Node) or isinstance(pe, Ref):
+        return False
+    if isinstance(pe, Unary) or isinstance(pe, Tuple):
+        return any(folding(e) for e in pe)
+    return False
+
+
+def calling(pe):
+    # True if pe calls another rule
+    if isinstance(pe, Ref):
+        return not isinstance(inline(pe), (Char, Range))
+    if isinstance(pe, Unary) or isinstance(pe, Tuple):
+        return any(calling(e) for e in pe)
+    return False
+
+
+def gen_Ref(pe, **option):
+    pe2 = inline(pe)
+    if pe2 is not pe:
+        return option['emit'](pe2, **option)
+    key = pe.uname()
+    generated = option['generated']
+    if key not in generated:
+        ref = RecRef()
+        generated[key] = ref
+        body = pe.deref()
+        pf = option['emit'](body, **option)
+        # lexical rules are cheap to parse again; folding rules depend
+        # on the node before them
+        if option.get('memo', True) and calling(body) and not folding(body):
+            memos = option['memos']
+            pf = Memo(len(memos), pf)
+            memos.append(key)
+        ref.f0 = pf
+        generated[key] = pf
+    return generated[key]
 
 # Tree
 
@@ -296,20 +499,20 @@ class TreeAs(ParseFunc):
         self.tag = tag
 
     @cython.cfunc
-    @cython.locals(pos=cython.int)
+    @cython.locals(pos=cython.int, prev=object)
     def p(self, px: ParserContext) -> cython.bint:
         pos = px.pos
+        prev = px.ast
         px.ast = None
         if self.f0.p(px):
-            px.ast = Tree(self.tag, px.source, pos, px.pos, px.ast)
+            px.ast = Tree(prev, self.tag, pos, px.pos, px.ast)
             return 1
         return 0
 
 
-def gen_TreeAs(pe, **option):
-    tag = pe.name
-    pf = option['emit'](pe.inner, **option)
-    return TreeAs(pf, tag)
+def gen_Node(pe, **option):
+    pf = option['emit'](pe.e, **option)
+    return TreeAs(pf, pe.tag)
 
 
 @cython.cclass
@@ -322,19 +525,20 @@ class LinkAs(ParseFunc):
         self.label = label
 
     @cython.cfunc
-    @cython.locals(ast=object)
+    @cython.locals(pos=cython.int, prev=object)
     def p(self, px: ParserContext) -> cython.bint:
-        ast = px.ast
+        pos = px.pos
+        prev = px.ast
+        px.ast = None
         if self.f0.p(px):
-            px.ast = Link(self.label, px.ast, ast)
+            px.ast = Tree(prev, self.label, pos, -px.pos, px.ast)
             return 1
         return 0
 
 
-def gen_LinkAs(pe, **option):
-    label = pe.name
-    pf = option['emit'](pe.inner, **option)
-    return LinkAs(label, pf)
+def gen_Edge(pe, **option):
+    pf = option['emit'](pe.e, **option)
+    return LinkAs(pe.edge, pf)
 
 
 @cython.cclass
@@ -349,21 +553,22 @@ class FoldAs(ParseFunc):
         self.tag = tag
 
     @cython.cfunc
-    @cython.locals(ast=object, pos=cython.int)
+    @cython.locals(pos=cython.int, prev=object, pt=object)
     def p(self, px: ParserContext) -> cython.bint:
         pos = px.pos
-        ast = Link(self.label, px.ast, None)
+        prev, pt = None, px.ast
+        if pt is not None and pt.prev is not None:
+            prev, pt = pt.prev, Tree(None, pt.tag, pt.spos, pt.epos, pt.child)
+        px.ast = pt if self.label == '' else Tree(None, self.label, 0, -pos, pt)
         if self.f0.p(px):
-            px.ast = Tree(self.tag, px.source, pos, px.pos, px.ast)
+            px.ast = Tree(prev, self.tag, pos, px.pos, px.ast)
             return 1
         return 0
 
 
-def gen_FoldAs(pe, **option):
-    label = pe.left
-    tag = pe.name
-    pf = option['emit'](pe.inner, **option)
-    return FoldAs(label, pf, tag)
+def gen_Fold(pe, **option):
+    pf = option['emit'](pe.e, **option)
+    return FoldAs(pe.edge, pf, pe.tag)
 
 
 @cython.cclass
@@ -383,6 +588,258 @@ class Detree(ParseFunc):
         return 0
 
 
-def gen_Detree(pe, **option):
-    pf = option['emit'](pe.inner, **option)
+def gen_Abs(pe, **option):
+    pf = option['emit'](pe.e, **option)
     return Detree(pf)
+
+# Actions (SPEG symbol tables)
+
+
+@cython.cfunc
+def getstate(state: object, sid: object) -> object:
+    while state is not None:
+        if state.sid == sid:
+            return state
+        state = state.prev
+    return None
+
+
+def getsid(name, **option):
+    sids = option['sids']
+    if name not in sids:
+        sids[name] = len(sids)
+    return sids[name]
+
+
+def gen_Lazy(pe, **option):  # @lazy(A)
+    return option['emit'](pe.e, **option)
+
+
+@cython.cclass
+class Skip(ParseFunc):
+
+    @cython.cfunc
+    def p(self, px: ParserContext) -> cython.bint:
+        px.pos = min(px.headpos, px.epos)
+        return 1
+
+
+def gen_Skip(pe, **option):  # @skip()
+    return Skip()
+
+
+@cython.cclass
+class Commit(ParseFunc):
+    # nothing before px.pos will be parsed again
+
+    @cython.cfunc
+    @cython.locals(table=dict)
+    def p(self, px: ParserContext) -> cython.bint:
+        for table in px.memos:
+            for key in [key for key in table if key < px.pos]:
+                del table[key]
+        return 1
+
+
+def gen_Commit(pe, **option):  # @commit()
+    return Commit()
+
+
+@cython.cclass
+class Symbol(ParseFunc):
+    f0: ParseFunc
+    sid: object
+
+    def __init__(self, f0: ParseFunc, sid: object):
+        self.f0 = f0
+        self.sid = sid
+
+    @cython.cfunc
+    @cython.locals(pos=cython.int)
+    def p(self, px: ParserContext) -> cython.bint:
+        pos = px.pos
+        if self.f0.p(px):
+            px.state = State(self.sid, px.inputs[pos:px.pos], px.state)
+            return 1
+        return 0
+
+
+def gen_Symbol(pe, **option):  # @symbol(A)
+    pf = option['emit'](pe.e, **option)
+    return Symbol(pf, getsid(str(pe.params[0]), **option))
+
+
+@cython.cclass
+class Scope(ParseFunc):
+    f0: ParseFunc
+
+    def __init__(self, f0: ParseFunc):
+        self.f0 = f0
+
+    @cython.cfunc
+    @cython.locals(state=object, res=cython.bint)
+    def p(self, px: ParserContext) -> cython.bint:
+        state = px.state
+        res = self.f0.p(px)
+        px.state = state
+        return res
+
+
+def gen_Scope(pe, **option):  # @scope(e)
+    pf = option['emit'](pe.e, **option)
+    return Scope(pf)
+
+
+@cython.cclass
+class Exists(ParseFunc):
+    sid: object
+
+    def __init__(self, sid: object):
+        self.sid = sid
+
+    @cython.cfunc
+    def p(self, px: ParserContext) -> cython.bint:
+        return getstate(px.state, self.sid) is not None
+
+
+def gen_Exists(pe, **option):  # @exists(A)
+    return Exists(getsid(str(pe.params[0]), **option))
+
+
+@cython.cclass
+class Match(ParseFunc):
+    sid: object
+
+    def __init__(self, sid: object):
+        self.sid = sid
+
+    @cython.cfunc
+    @cython.locals(state=object)
+    def p(self, px: ParserContext) -> cython.bint:
+        state = getstate(px.state, self.sid)
+        if state is not None and px.inputs.startswith(state.val, px.pos, px.epos):
+            px.pos += len(state.val)
+            return 1
+        return 0
+
+
+def gen_Match(pe, **option):  # @match(A)
+    return Match(getsid(str(pe.params[0]), **option))
+
+
+@cython.cclass
+class Def(ParseFunc):
+    f0: ParseFunc
+    name: object
+
+    def __init__(self, f0: ParseFunc, name: object):
+        self.f0 = f0
+        self.name = name
+
+    @cython.cfunc
+    @cython.locals(pos=cython.int, s=str, d=dict, l=list, i=cython.int)
+    def p(self, px: ParserContext) -> cython.bint:
+        pos = px.pos
+        if self.f0.p(px):
+            s = px.inputs[pos:px.pos]
+            if len(s) == 0:
+                return 1
+            d = px.dicts.setdefault(self.name, {})
+            l = d.setdefault(s[0], [])
+            # longest first
+            for i in range(len(l)):
+                if len(s) > len(l[i]):
+                    l.insert(i, s)
+                    return 1
+            l.append(s)
+            return 1
+        return 0
+
+
+def gen_Def(pe, **option):  # @def(NAME, e)
+    pf = option['emit'](pe.e, **option)
+    return Def(pf, str(pe.params[0]))
+
+
+@cython.cclass
+class In(ParseFunc):
+    name: object
+
+    def __init__(self, name: object):
+        self.name = name
+
+    @cython.cfunc
+    @cython.locals(d=dict, s=str)
+    def p(self, px: ParserContext) -> cython.bint:
+        d = px.dicts.get(self.name)
+        if d is not None and px.pos < px.epos:
+            for s in d.get(px.inputs[px.pos], ()):
+                if px.inputs.startswith(s, px.pos, px.epos):
+                    px.pos += len(s)
+                    return 1
+        return 0
+
+
+def gen_In(pe, **option):  # @in(NAME)
+    return In(str(pe.params[0]))
+
+
+GEN = {
+    'Char': gen_Char, 'Any': gen_Any, 'Range': gen_Range,
+    'And': gen_And, 'Not': gen_Not, 'Many': gen_Many, 'Many1': gen_Many1,
+    'Option': gen_Option, 'Seq': gen_Seq, 'Ore': gen_Ore, 'Alt': gen_Alt,
+    'Ref': gen_Ref, 'Node': gen_Node, 'Edge': gen_Edge, 'Fold': gen_Fold,
+    'Abs': gen_Abs,
+    'Lazy': gen_Lazy, 'Skip': gen_Skip, 'Commit': gen_Commit, 'Symbol': gen_Symbol,
+    'Scope': gen_Scope, 'Exists': gen_Exists, 'Match': gen_Match,
+    'Def': gen_Def, 'In': gen_In,
+}
+
+
+def emit(pe, **option):
+    if isinstance(pe, Action):
+        cname = pe.func.capitalize()
+    else:
+        cname = pe.__class__.__name__
+    if cname in GEN:
+        return GEN[cname](pe, **option)
+    raise NotImplementedError(f'cbase does not support {cname}: {pe}')
+
+
+@cython.ccall
+def call_p(f: ParseFunc, px: ParserContext):
+    return f.p(px)
+
+
+def cgenerate(peg, **option):
+    # generated rules and memo ids are shared by all start symbols
+    key = ('cbase', option.get('memo', True))
+    with peg.lock:
+        if key not in peg.compiled:
+            peg.compiled[key] = {'generated': {}, 'memos': [], 'sids': {}}
+        option.update(peg.compiled[key])
+        name = option.get('start', peg.start())
+        option['emit'] = emit
+        f = emit(peg.newRef(name), **option)
+        nmemos = len(option['memos'])
+
+    def parse(inputs, urn='(unknown source)', pos=0, epos=None, conv=PTree2ParseTree):
+        if epos is None:
+            epos = len(inputs)
+        px = ParserContext(inputs, pos, epos, nmemos)
+        if not call_p(f, px):
+            result = Tree(None, 'err', px.headpos, px.headpos, None)
+        else:
+            result = px.ast if px.ast is not None else Tree(None, '', pos, px.pos, None)
+        return conv(result, urn, inputs)
+    return parse
+
+
+compiled = cython.compiled
+
+
+def generate(peg, **option):
+    # the pure-Python engine is used until this module is compiled
+    if compiled:
+        return cgenerate(peg, **option)
+    return tpeg2.generate(peg, **option)
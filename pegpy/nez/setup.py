@@ -0,0 +1,9 @@
+from distutils.core import setup, Extension
+from Cython.Build import cythonize
+
+cbase = Extension("cbase", sources=["cbase.py"])
+
+setup(
+  name='cbase',
+  ext_modules=cythonize([cbase])
+)
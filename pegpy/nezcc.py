@@ -2,7 +2,11 @@ from pathlib import Path
 import json
 import os
 import sys
-from pegpy.tpeg2 import grammar, Ref, Unary, Tuple, Char, Range
+from pegpy.tpeg2 import grammar, Ref, Unary, Tuple, Char, Range, Seq, Ore, Alt, And, Not
+from pegpy.tpeg2 import Many, Many1, Node, Edge, Fold, Abs, Action, inline
+from pegpy.tpeg2 import Any, EMPTY
+from pegpy.optimizer import Pass, PassManager, defaultPasses, Negate, MakeTrie
+from pegpy.optimizer import Complement, Trie, listRefs, reachable
 
 # NezCC
 
@@ -23,34 +27,51 @@ def makeNonterminalList(peg, pe, ns: list, es):
 
 class Combinator(object):
     ESCTBL = str.maketrans(
-        {'\n': '\\n', '\t': '\\t', '\r': '\\r', '\v': '\\v', '\f': '\\f',
+        {'\n': '\\n', '\t': '\\t', '\r': '\\r', '\v': '\\u000b', '\f': '\\f',
          '\\': '\\\\', "'": "\\'", '"': "\\\""})
 
     def __init__(self, options={}):
-        print(options)
         self.SIDs = {}
         self.apply = options.get('apply', '{}({})')
         self.delim = options.get('delim', ',')
         self.prefix = options.get('prefix', 'p')
         self.rule = options.get('rule', 'peg[{}] = {}')
+        self.array = options.get('array', '[{}]')
+        self.example = options.get('example')
         self.useArray = options.get('useArray', True)
         self.domains = []
         self.funcs = set(options.get('supported', []))
+        self.options = options
 
     def has(self, funcname):
         #print(funcname, funcname in self.funcs)
         return funcname in self.funcs
 
     def emitAll(self, peg, start=None):
-        ns = [peg.start() if start is None else start]
-        es = {ns[0]: peg[ns[0]]}
-        makeNonterminalList(peg, peg[ns[0]], ns, es)
+        start = peg.start() if start is None else start
+        peg, ns, es, memo = optimizeRules(peg, start, self.options)
+        self.peg = peg
         ns.reverse()
         if self.useArray:
             self.domains = ns
-        for n in ns[-5:]:
+        self.names = set(ns)
+        lines = []
+        for n in ns:
             ref = self.getref(n)
-            print(self.rule.format(ref, self.emit(es[n])))
+            e = self.emit(es[n])
+            if memo is not None and n in memo.memos and self.has('Memo'):
+                e = self.emitApply('Memo', e, str(ns.index(n)))
+            lines.append(self.rule.format(ref, e))
+        return '\n'.join(lines)
+
+    def emitExamples(self, peg):
+        lines = []
+        if self.example is not None:
+            for name, doc in peg['@@example']:
+                if name in self.names:
+                    text = doc.inputs_[doc.spos_:doc.epos_]
+                    lines.append(self.example.format(self.quote(name), self.quote(text)))
+        return '\n'.join(lines)
 
     def emitApply(self, name, *args):
         name = f'{self.prefix}{name}'
@@ -62,14 +83,12 @@ class Combinator(object):
             return self.apply.format(name, self.delim.join(args))
 
     def quote(self, s):
-        if isinstance(s, tuple) or isinstance(s, list):
-            sb = []
-            for r in s:
-                sb.append(r[0]+r[1])
-            s = ''.join(sb)
-        '"' + s.translate(Combinator.ESCTBL) + '"'
         return '"' + s.translate(Combinator.ESCTBL) + '"'
 
+    def quoteRanges(self, r):
+        # 'az09' => ["az", "09"]
+        return self.array.format(self.delim.join(self.quote(r[i:i+2]) for i in range(0, len(r) - 1, 2)))
+
     def getref(self, name):
         if len(self.domains) > 0:
             return str(self.domains.index(name))
@@ -86,7 +105,7 @@ class Combinator(object):
             return self.Undefined(pe)
 
     def Undefined(self, pe):
-        return f'TODO({pe})'
+        raise NotImplementedError(f'nezcc cannot generate {pe}')
 
     def Char(self, pe):
         if len(pe.text) == 0:
@@ -94,7 +113,7 @@ class Combinator(object):
         return self.emitApply('Char', self.quote(pe.text))
 
     def Range(self, pe):
-        return self.emitApply('Range', self.quote(pe.chars), self.quote(pe.ranges))
+        return self.emitApply('Range', self.quote(pe.chars), self.quoteRanges(pe.ranges))
 
     def Any(self, pe):
         return self.emitApply('Any')
@@ -103,7 +122,7 @@ class Combinator(object):
         if isinstance(pe, Char):
             return (self.quote(pe.text),)
         if isinstance(pe, Range):
-            return (self.quote(pe.chars), self.quote(pe.ranges))
+            return (self.quote(pe.chars), self.quoteRanges(pe.ranges))
         return ()
 
     def And(self, pe):
@@ -171,8 +190,18 @@ class Combinator(object):
     def Alt(self, pe):
         return self.Ore(pe)
 
+    def Trie(self, pe):
+        if self.has('Dict'):
+            return self.emitApply('Dict', *[self.quote(e.text) for e in pe])
+        return self.Ore(pe)
+
+    def Complement(self, pe):
+        if self.has('Complement'):
+            return self.emitApply('Complement', *self.param(pe.e))
+        return self.emitApply('Seq2', self.Not(Not(pe.e)), self.Any(pe))
+
     def Ref(self, pe):
-        ref = self.getref(pe.name)
+        ref = self.getref(refname(self.peg, pe))
         return self.emitApply('Ref', 'peg', ref)
 
     def Node(self, pe):
@@ -191,18 +220,15 @@ class Combinator(object):
         e = self.emit(pe.e)
         return self.emitApply('Abs', e)
 
-    '''
     def Lazy(self, pe):
-        params = pe.params
-        name = pe.e.name
-        peg = option.get('peg')
-        fname = pe.func
-        params = pe.params
-        return self.Undefined(pe)
-    '''
+        return self.emit(pe.e)
 
     def Skip(self, pe):
-        return self.emitApply('pSkipErr')
+        return self.emitApply('SkipErr')
+
+    def Commit(self, pe):
+        # memo tables have a fixed number of slots; nothing to drop
+        return self.emitApply('Empty')
 
     def getsid(self, name):
         if not name in self.SIDs:
@@ -212,15 +238,15 @@ class Combinator(object):
     def Symbol(self, pe):
         sid = self.getsid(str(pe.params[0]))
         e = self.emit(pe.e)
-        return self.emitApply('Symbol', sid, e)
+        return self.emitApply('Symbol', str(sid), e)
 
     def Exists(self, pe):
         sid = self.getsid(str(pe.params[0]))
-        return self.emitApply('Exists', sid)
+        return self.emitApply('Exists', str(sid))
 
     def Match(self, pe):
         sid = self.getsid(str(pe.params[0]))
-        return self.emitApply('Match', sid)
+        return self.emitApply('Match', str(sid))
 
     def Scope(self, pe):
         e = self.emit(pe.e)
@@ -236,6 +262,461 @@ class Combinator(object):
     #         print(indent + self.apply('example', repr(name), repr(text)))
 
 
+# Python
+
+def firstChars(pe, visited=None):
+    # the characters a non-empty match of pe can start with, or None
+    # if pe may match empty or we cannot tell
+    if visited is None:
+        visited = set()
+    if isinstance(pe, Char):
+        return frozenset(pe.text[0]) if len(pe.text) > 0 else None
+    if isinstance(pe, Range):
+        cs = set(pe.chars)
+        r = pe.ranges
+        while len(r) > 1:
+            if ord(r[1]) - ord(r[0]) > 256:
+                return None
+            cs |= {chr(c) for c in range(ord(r[0]), ord(r[1])+1)}
+            r = r[2:]
+        return frozenset(cs)
+    if isinstance(pe, Ref):
+        if pe.uname() in visited:
+            return None
+        visited.add(pe.uname())
+        return firstChars(pe.deref(), visited)
+    if isinstance(pe, Seq):
+        for e in pe:
+            if isinstance(e, (And, Not)):
+                continue
+            return firstChars(e, visited)
+        return None
+    if isinstance(pe, Ore) or isinstance(pe, Alt):
+        cs = set()
+        for e in pe:
+            fs = firstChars(e, visited)
+            if fs is None:
+                return None
+            cs |= fs
+        return frozenset(cs)
+    if isinstance(pe, (Many1, Node, Edge, Fold, Abs)):
+        return firstChars(pe.e, visited)
+    if isinstance(pe, Action) and pe.func in ('symbol', 'scope', 'def', 'lazy'):
+        return firstChars(pe.e, visited)
+    return None
+
+
+def isCalling(pe):
+    if isinstance(pe, Ref):
+        return not isinstance(inline(pe), (Char, Range))
+    if isinstance(pe, Unary) or isinstance(pe, Tuple):
+        return any(isCalling(e) for e in pe)
+    return False
+
+
+def isFolding(pe):
+    # a fold outside of any node folds the node made before the rule
+    if isinstance(pe, Fold):
+        return True
+    if isinstance(pe, Node) or isinstance(pe, Ref):
+        return False
+    if isinstance(pe, Unary) or isinstance(pe, Tuple):
+        return any(isFolding(e) for e in pe)
+    return False
+
+
+# Optimizer
+
+def refname(peg, pe):
+    return pe.uname() if pe.peg != peg else pe.name
+
+
+class Memoize(Pass):
+    # A rule called from a single place in a memoized rule is parsed
+    # at most once per position, so its own memo only costs time.
+    # memos lists the rules that keep their memo.
+    name = 'unmemo'
+
+    def __init__(self, start):
+        super().__init__()
+        self.start = start
+        self.memos = set()
+
+    def run(self, peg):
+        ns, rules = [self.start], {self.start: peg[self.start]}
+        makeNonterminalList(peg, peg[self.start], ns, rules)
+        sites = {}
+        for n in ns:
+            for ref in listRefs(peg, rules[n], [], True):
+                sites.setdefault(ref, []).append(n)
+        memos = {}
+
+        def needs(n):
+            if n not in memos:
+                pe = rules[n]
+                memos[n] = False
+                if isCalling(pe) and not isFolding(pe):
+                    callers = sites.get(n, [])
+                    if n == self.start or len(callers) != 1 \
+                            or n in reachable(peg, listRefs(peg, pe, [], True), rules):
+                        memos[n] = True
+                    else:
+                        memos[n] = not needs(callers[0])
+                        if not memos[n]:
+                            self.rewrites += 1
+            return memos[n]
+        self.memos = {n for n in ns if needs(n)}
+
+
+def optimizeRules(peg, start, options):
+    # returns the rules to emit and the Memoize pass, or None when
+    # the grammar is emitted as written
+    memo = None
+    if int(options.get('optimize', 1)):
+        memo = Memoize(start)
+        passes = defaultPasses(**dict(options, start=start))
+        pm = PassManager(passes + [Negate(), MakeTrie(int(options.get('trie', 2))), memo])
+        peg = pm.run(peg)
+        pm.report(file=sys.stderr)
+    ns, es = [start], {start: peg[start]}
+    makeNonterminalList(peg, peg[start], ns, es)
+    return peg, ns, es, memo
+
+
+class PythonGenerator(object):
+    # Each rule becomes a function p_<name>(px) -> bool. Sequences are
+    # inlined as 'and' chains; other operators get a helper function e<n>.
+
+    def __init__(self, options={}):
+        self.memo = options.get('memo', True)
+        self.options = options
+        self.memoize = None
+        self.SIDs = {}
+        self.lines = []
+        self.consts = {}
+        self.funcs = 0
+        self.names = {}
+        self.memos = []
+
+    def emitAll(self, peg, start=None):
+        start = peg.start() if start is None else start
+        peg, ns, es, self.memoize = optimizeRules(peg, start, self.options)
+        self.peg = peg
+        for n in ns:
+            self.names[n] = self.funcname(n)
+        rules = []
+        for n in ns:
+            pe = es[n]
+            name = self.names[n]
+            code = self.emit(pe)
+            self.lines.append('')
+            if self.needsMemo(n, pe):
+                # m<...> parses, p<...> looks up the memo first
+                body = 'm' + name[1:]
+                self.lines.append(f'def {name}(px):')
+                self.lines.append(f'    return memo(px, {len(self.memos)}, {body})')
+                self.lines.append('')
+                self.memos.append(n)
+                name = body
+            self.lines.append(f'def {name}(px):  # {n}')
+            self.lines.append(f'    return {code}')
+            rules.append(f'    {repr(n)}: {self.names[n]},')
+        sb = [f'{name} = {value}' for value, name in self.consts.items()]
+        sb += self.lines
+        sb.append('')
+        sb.append('')
+        sb.append('RULES = {')
+        sb += rules
+        sb.append('}')
+        sb.append(f'START = {repr(start)}')
+        sb.append(f'NMEMO = {len(self.memos)}')
+        return '\n'.join(sb)
+
+    def needsMemo(self, name, pe):
+        # lexical rules are cheap to parse again; folding rules depend
+        # on the node before them
+        if self.memoize is not None:
+            return self.memo and name in self.memoize.memos
+        return self.memo and isCalling(pe) and not isFolding(pe)
+
+    def emitExamples(self, peg):
+        sb = ['EXAMPLES = [']
+        for name, doc in peg['@@example']:
+            if name in self.names:
+                text = doc.inputs_[doc.spos_:doc.epos_]
+                sb.append(f'    ({repr(name)}, {repr(text)}),')
+        sb.append(']')
+        return '\n'.join(sb)
+
+    def funcname(self, name):
+        if name.isidentifier() and name.isascii():
+            return f'p_{name}'
+        return f'p{len(self.names)}'
+
+    def charset(self, cs):
+        return self.const(f'frozenset({repr("".join(sorted(cs)))})')
+
+    def const(self, value):
+        if value not in self.consts:
+            self.consts[value] = f'C{len(self.consts)}'
+        return self.consts[value]
+
+    def defun(self, body):
+        # body returns True/False; it may refer to px
+        self.funcs += 1
+        name = f'e{self.funcs}'
+        self.lines.append('')
+        self.lines.append(f'def {name}(px):')
+        for line in body:
+            self.lines.append('    ' + line)
+        return f'{name}(px)'
+
+    def emit(self, pe):
+        tag = pe.__class__.__name__
+        if tag == 'Action':
+            tag = pe.func.capitalize()
+        if hasattr(self, tag):
+            f = getattr(self, tag)
+            return f(pe)
+        return self.Undefined(pe)
+
+    def Undefined(self, pe):
+        raise NotImplementedError(f'nezcc cannot generate {pe}')
+
+    def Char(self, pe):
+        if len(pe.text) == 0:
+            return 'True'
+        return f'char(px, {repr(pe.text)})'
+
+    def Range(self, pe):
+        cs = firstChars(pe)
+        if cs is not None:
+            return f'charset(px, {self.charset(cs)})'
+        bs = 0
+        for c in pe.chars:
+            bs |= 1 << ord(c)
+        r = pe.ranges
+        while len(r) > 1:
+            bs |= ((1 << (ord(r[1]) + 1)) - 1) ^ ((1 << ord(r[0])) - 1)
+            r = r[2:]
+        return f'bitset(px, {self.const(hex(bs))})'
+
+    def Any(self, pe):
+        return 'anychar(px)'
+
+    def And(self, pe):
+        return self.defun([
+            'pos, ast = px.pos, px.ast',
+            f'if {self.emit(pe.e)}:',
+            '    px.headpos = max(px.pos, px.headpos)',
+            '    px.pos, px.ast = pos, ast',
+            '    return True',
+            'return False'])
+
+    def Not(self, pe):
+        return self.defun([
+            'pos, ast = px.pos, px.ast',
+            f'if {self.emit(pe.e)}:',
+            '    return False',
+            'px.headpos = max(px.pos, px.headpos)',
+            'px.pos, px.ast = pos, ast',
+            'return True'])
+
+    def Many(self, pe):
+        if isinstance(inline(pe.e), Range):
+            cs = firstChars(inline(pe.e))
+            if cs is not None:
+                # a tight loop over a character class
+                return self.defun([
+                    f'cs, inputs, pos = {self.charset(cs)}, px.inputs, px.pos',
+                    'while pos < px.epos and inputs[pos] in cs:',
+                    '    pos += 1',
+                    'px.pos = pos',
+                    'return True'])
+        if isinstance(pe.e, Complement):
+            cs = firstChars(pe.e.e)
+            if cs is not None:
+                return self.defun([
+                    f'cs, inputs, pos = {self.charset(cs)}, px.inputs, px.pos',
+                    'while pos < px.epos and inputs[pos] not in cs:',
+                    '    pos += 1',
+                    'px.pos = pos',
+                    'return True'])
+        return self.defun([
+            'pos, ast = px.pos, px.ast',
+            f'while {self.emit(pe.e)} and pos < px.pos:',
+            '    pos, ast = px.pos, px.ast',
+            'px.headpos = max(px.pos, px.headpos)',
+            'px.pos, px.ast = pos, ast',
+            'return True'])
+
+    def Many1(self, pe):
+        e = self.emit(pe.e)
+        return f'({e} and {self.Many(pe)})'
+
+    def Option(self, pe):
+        return self.defun([
+            'pos, ast = px.pos, px.ast',
+            f'if not {self.emit(pe.e)}:',
+            '    px.headpos = max(px.pos, px.headpos)',
+            '    px.pos, px.ast = pos, ast',
+            'return True'])
+
+    def Seq(self, pe):
+        return '(' + ' and '.join([self.emit(e) for e in pe]) + ')'
+
+    def Ore(self, pe):
+        if isinstance(pe, Ore) and pe.isDict():
+            dic = {}
+            for s in pe.listDict():
+                dic.setdefault(s[0], []).append(s)
+            dic = {c: tuple(ss) for c, ss in dic.items()}
+            empty = any(e.text == '' for e in pe)
+            return f'choice(px, {self.const(repr(dic))}, {empty})'
+        body = ['pos, ast = px.pos, px.ast',
+                "c = px.inputs[pos] if pos < px.epos else ''"]
+        for e in pe:
+            cs = firstChars(e)
+            # the first character skips the choices that cannot match
+            guard = '' if cs is None else f'c in {self.charset(cs)} and '
+            body.append(f'if {guard}{self.emit(e)}:')
+            body.append('    return True')
+            body.append('px.headpos = max(px.pos, px.headpos)')
+            body.append('px.pos, px.ast = pos, ast')
+        body.append('return False')
+        return self.defun(body)
+
+    def Alt(self, pe):
+        return self.Ore(pe)
+
+    def Trie(self, pe):
+        return self.Ore(pe)
+
+    def Complement(self, pe):
+        cs = firstChars(pe.e)
+        if cs is None:
+            return f'({self.Not(Not(pe.e))} and anychar(px))'
+        return f'complement(px, {self.charset(cs)})'
+
+    def Ref(self, pe):
+        pe2 = inline(pe)
+        if pe2 is not pe:
+            return self.emit(pe2)
+        return f'{self.names[pe.uname() if pe.peg != self.peg else pe.name]}(px)'
+
+    def Node(self, pe):
+        return self.defun([
+            'pos, prev = px.pos, px.ast',
+            'px.ast = None',
+            f'if {self.emit(pe.e)}:',
+            f'    px.ast = PTree(prev, {repr(pe.tag)}, pos, px.pos, px.ast)',
+            '    return True',
+            'return False'])
+
+    def Edge(self, pe):
+        return self.defun([
+            'pos, prev = px.pos, px.ast',
+            'px.ast = None',
+            f'if {self.emit(pe.e)}:',
+            f'    px.ast = PTree(prev, {repr(pe.edge)}, pos, -px.pos, px.ast)',
+            '    return True',
+            'return False'])
+
+    def Fold(self, pe):
+        left = 'pt' if pe.edge == '' else f'PTree(None, {repr(pe.edge)}, 0, -pos, pt)'
+        return self.defun([
+            'pos, prev, pt = px.pos, None, px.ast',
+            'if pt is not None and pt.prev is not None:',
+            '    prev, pt = pt.prev, PTree(None, pt.tag, pt.spos, pt.epos, pt.child)',
+            f'px.ast = {left}',
+            f'if {self.emit(pe.e)}:',
+            f'    px.ast = PTree(prev, {repr(pe.tag)}, pos, px.pos, px.ast)',
+            '    return True',
+            'return False'])
+
+    def Abs(self, pe):
+        return self.defun([
+            'ast = px.ast',
+            f'if {self.emit(pe.e)}:',
+            '    px.ast = ast',
+            '    return True',
+            'return False'])
+
+    def getsid(self, name):
+        if not name in self.SIDs:
+            self.SIDs[name] = len(self.SIDs)
+        return self.SIDs[name]
+
+    def Lazy(self, pe):
+        return self.emit(pe.e)
+
+    def Skip(self, pe):
+        return 'skip(px)'
+
+    def Commit(self, pe):
+        return 'commit(px)'
+
+    def Symbol(self, pe):
+        sid = self.getsid(str(pe.params[0]))
+        return self.defun([
+            'pos = px.pos',
+            f'return {self.emit(pe.e)} and symbol(px, {sid}, pos)'])
+
+    def Scope(self, pe):
+        return self.defun([
+            'state = px.state',
+            f'res = {self.emit(pe.e)}',
+            'px.state = state',
+            'return res'])
+
+    def Exists(self, pe):
+        sid = self.getsid(str(pe.params[0]))
+        return f'(getstate(px.state, {sid}) is not None)'
+
+    def Match(self, pe):
+        sid = self.getsid(str(pe.params[0]))
+        return f'match(px, {sid})'
+
+    def Def(self, pe):
+        return self.defun([
+            'pos = px.pos',
+            f'return {self.emit(pe.e)} and define(px, {repr(str(pe.params[0]))}, pos)'])
+
+    def In(self, pe):
+        return f'indict(px, {repr(str(pe.params[0]))})'
+
+
+def expand(file, sections, **options):
+    # copies a template, replacing each marker line (#TPEG, //TPEG, ...)
+    # with the section of the same name at the marker's indentation
+    path = Path(file)
+    if not path.exists():
+        path = Path(__file__).resolve().parent / 'nezcc' / path.name
+    sb = []
+    with path.open() as f:
+        for line in f.readlines():
+            line = line.rstrip()
+            marker = line.strip().lstrip('#/').strip()
+            if marker in sections:
+                indent = line[:len(line) - len(line.lstrip())]
+                for s in sections[marker].split('\n'):
+                    sb.append(indent + s if len(s) > 0 else s)
+            else:
+                sb.append(line)
+    code = '\n'.join(sb) + '\n'
+    if 'output' in options:
+        with open(options['output'], 'w') as f:
+            f.write(code)
+    else:
+        print(code)
+
+
+def pycc(file, peg, **options):
+    g = PythonGenerator(options)
+    rules = g.emitAll(peg, options.get('start'))
+    expand(file, {'TPEG': rules, 'EXAMPLE': g.emitExamples(peg)}, **options)
+
+
 def show_filelist():
     path = Path(__file__).resolve().parent / 'nezcc'
     print('Settings:', ', '.join(
@@ -252,25 +733,23 @@ def load_options(file):
             return json.load(f)
     except FileNotFoundError:
         show_filelist()
-    # except:
 
 
 def nezcc(file, peg, **options):
-    c = Combinator(load_options(file))
-    c.emitAll(peg, **options)
-
-    # pegcc = NezCC(options)
-    # with path.open() as f:
-    #     for line in f.readlines():
-    #         line = line.rstrip()
-    #         if 'TPEG' in line:
-    #             setline(line, options)
-    #             generate(pegcc, g, **options)
-    #         elif 'EXAMPLE' in line and '@@example' in g:
-    #             setline(line, options)
-    #             pegcc.example(g, options)
-    #         else:
-    #             print(line)
+    if file.endswith('.py'):
+        return pycc(file, peg, **options)
+    if file.endswith('.json'):
+        settings = load_options(file)
+    else:
+        # a template such as parser.ts comes with the settings ts.json
+        settings = load_options(Path(file).suffix[1:] + '.json')
+        settings['template'] = file
+    c = Combinator(dict(settings, **options))
+    rules = c.emitAll(peg, options.get('start'))
+    if 'template' not in settings:
+        print(rules)
+        return
+    expand(settings['template'], {'TPEG': rules, 'EXAMPLE': c.emitExamples(peg)}, **options)
 
 
 if __name__ == '__main__':
@@ -1,7 +1,11 @@
 import java.util.ArrayList;
+import java.util.Collections;
 import java.util.HashMap;
+import java.util.List;
 import java.util.function.Function;
 
+// nodes are built as a reversed list; an edge has a negative epos
+
 class ParTree {
   public ParTree prev;
   public String label;
@@ -16,13 +20,101 @@ class ParTree {
     this.epos = epos;
     this.child = child;
   }
+
+  public static ParTree attach(ParTree prev, ParTree ast) {
+    if (ast == null) {
+      return prev;
+    }
+    return new ParTree(attach(prev, ast.prev), ast.label, ast.spos, ast.epos, ast.child);
+  }
+}
+
+class ParseTree {
+  public String tag;
+  public String inputs;
+  public int spos;
+  public int epos;
+  public ArrayList<String> edges = new ArrayList<>();
+  public ArrayList<ParseTree> nodes = new ArrayList<>();
+
+  public ParseTree(String tag, String inputs, int spos, int epos) {
+    this.tag = tag;
+    this.inputs = inputs;
+    this.spos = spos;
+    this.epos = epos;
+  }
+
+  public static ParseTree of(ParTree pt, String inputs) {
+    if (pt.prev != null) {
+      return of("", inputs, pt.spos, pt.epos, pt);
+    }
+    return of(pt.label, inputs, pt.spos, pt.epos, pt.child);
+  }
+
+  private static ParseTree of(String tag, String inputs, int spos, int epos, ParTree subnode) {
+    ParseTree t = new ParseTree(tag, inputs, spos, epos);
+    while (subnode != null) {
+      if (subnode.epos < 0) {
+        t.edges.add(subnode.label);
+        if (subnode.child == null) {
+          t.nodes.add(of("", inputs, subnode.spos, -subnode.epos, null));
+        } else {
+          t.nodes.add(of(subnode.child, inputs));
+        }
+      } else {
+        t.edges.add("");
+        t.nodes.add(of(subnode.label, inputs, subnode.spos, subnode.epos, subnode.child));
+      }
+      subnode = subnode.prev;
+    }
+    Collections.reverse(t.edges);
+    Collections.reverse(t.nodes);
+    return t;
+  }
+
+  public boolean isError() {
+    return this.tag.equals("err");
+  }
+
+  // the first child with a label keeps it
+  public ParseTree get(String edge) {
+    int index = this.edges.indexOf(edge);
+    return index == -1 ? null : this.nodes.get(index);
+  }
+
+  public String toString() {
+    StringBuilder sb = new StringBuilder();
+    this.strOut(sb);
+    return sb.toString();
+  }
+
+  private void strOut(StringBuilder sb) {
+    sb.append("[#").append(this.tag);
+    for (int i = 0; i < this.nodes.size(); i++) {
+      String edge = this.edges.get(i);
+      sb.append(edge.equals("") ? " " : " " + edge + "=");
+      this.nodes.get(i).strOut(sb);
+    }
+    if (this.nodes.size() == 0) {
+      sb.append(" '").append(this.inputs, this.spos, this.epos).append("'");
+    }
+    sb.append("]");
+  }
 }
 
 class Memo {
-  public long key;
+  public int key;
+  public int mid;
+  public State prevState;
+  public boolean result;
+  public int pos;
+  public int head;
+  public ParTree ast;
+  public State state;
 
   public Memo() {
     this.key = -1;
+    this.mid = -1;
   }
 }
 
@@ -156,6 +248,49 @@ class Parser {
     };
   }
 
+  public static ParseFunc pComplement(String chars, String[] ranges) {
+    ParseFunc match = pRange(chars, ranges);
+    return (px) -> {
+      if (px.pos < px.epos) {
+        int pos = px.pos;
+        if (match.apply(px)) {
+          px.pos = pos;
+          return false;
+        }
+        px.pos += 1;
+        return true;
+      }
+      return false;
+    };
+  }
+
+  public static ParseFunc pDict(String... texts) {
+    HashMap<Character, List<String>> dic = new HashMap<>();
+    boolean empty = false;
+    for (String text : texts) {
+      if (text.length() == 0) {
+        empty = true;
+        break;
+      }
+      dic.computeIfAbsent(text.charAt(0), (c) -> new ArrayList<>()).add(text);
+    }
+    final boolean matchEmpty = empty;
+    return (px) -> {
+      if (px.pos < px.epos) {
+        List<String> candidates = dic.get(px.inputs.charAt(px.pos));
+        if (candidates != null) {
+          for (String text : candidates) {
+            if (px.inputs.startsWith(text, px.pos)) {
+              px.pos += text.length();
+              return true;
+            }
+          }
+        }
+      }
+      return matchEmpty;
+    };
+  }
+
   public static ParseFunc pMany(ParseFunc match) {
     return (px) -> {
       int pos = px.pos;
@@ -201,16 +336,16 @@ class Parser {
     };
   }
 
-  public static ParseFunc pOr(ParseFunc match) {
+  public static ParseFunc pNot(ParseFunc match) {
     return (ParserContext px) -> {
       int pos = px.pos;
       ParTree ast = px.ast;
       if (match.apply(px)) {
-        px.head_pos = Math.max(px.pos, px.head_pos);
-        px.pos = pos;
-        px.ast = ast;
         return false;
       }
+      px.head_pos = Math.max(px.pos, px.head_pos);
+      px.pos = pos;
+      px.ast = ast;
       return true;
     };
   }
@@ -271,13 +406,19 @@ class Parser {
     return (ParserContext px) -> {
       int pos = px.pos;
       ParTree ast = px.ast;
-      if (!match.apply(px)) {
-        px.head_pos = Math.max(px.pos, px.head_pos);
-        px.pos = pos;
-        px.ast = ast;
-        return match2.apply(px);
+      if (match.apply(px)) {
+        return true;
       }
-      return true;
+      px.head_pos = Math.max(px.pos, px.head_pos);
+      px.pos = pos;
+      px.ast = ast;
+      if (match2.apply(px)) {
+        return true;
+      }
+      px.head_pos = Math.max(px.pos, px.head_pos);
+      px.pos = pos;
+      px.ast = ast;
+      return false;
     };
   }
 
@@ -290,12 +431,44 @@ class Parser {
     };
   }
 
+  // a result is reused at the same position and with the same state
+  public static ParseFunc pMemo(ParseFunc match, int mid) {
+    return (ParserContext px) -> {
+      int key = px.pos;
+      Memo m = px.memos[(int) (((long) key * 31 + mid) % px.memos.length)];
+      if (m.key == key && m.mid == mid && m.prevState == px.state) {
+        px.head_pos = Math.max(m.head, px.head_pos);
+        if (m.result) {
+          px.pos = m.pos;
+          px.ast = ParTree.attach(px.ast, m.ast);
+          px.state = m.state;
+        }
+        return m.result;
+      }
+      ParTree prev = px.ast;
+      State state = px.state;
+      px.ast = null;
+      boolean result = match.apply(px);
+      m.key = key;
+      m.mid = mid;
+      m.prevState = state;
+      m.result = result;
+      m.pos = px.pos;
+      m.head = px.head_pos;
+      m.ast = px.ast;
+      m.state = px.state;
+      px.ast = result ? ParTree.attach(prev, px.ast) : prev;
+      return result;
+    };
+  }
+
   public static ParseFunc pNode(ParseFunc match, String tag, int shift) {
     return (ParserContext px) -> {
       int pos = px.pos;
+      ParTree prev = px.ast;
       px.ast = null;
       if (match.apply(px)) {
-        px.ast = new ParTree(null, tag, pos + shift, px.pos, px.ast);
+        px.ast = new ParTree(prev, tag, pos + shift, px.pos, px.ast);
         return true;
       }
       return false;
@@ -304,9 +477,11 @@ class Parser {
 
   public static ParseFunc pEdge(String edge, ParseFunc match) {
     return (ParserContext px) -> {
-      ParTree ast = px.ast;
+      int pos = px.pos;
+      ParTree prev = px.ast;
+      px.ast = null;
       if (match.apply(px)) {
-        px.ast = new ParTree(ast, edge, -1, -1, px.ast);
+        px.ast = new ParTree(prev, edge, pos, -px.pos, px.ast);
         return true;
       }
       return false;
@@ -316,16 +491,22 @@ class Parser {
   public static ParseFunc pFold(String edge, ParseFunc match, String tag, int shift) {
     return (ParserContext px) -> {
       int pos = px.pos;
-      px.ast = new ParTree(null, edge, -1, -1, px.ast);
+      ParTree prev = null;
+      ParTree pt = px.ast;
+      if (pt != null && pt.prev != null) {
+        prev = pt.prev;
+        pt = new ParTree(null, pt.label, pt.spos, pt.epos, pt.child);
+      }
+      px.ast = edge.equals("") ? pt : new ParTree(null, edge, 0, -pos, pt);
       if (match.apply(px)) {
-        px.ast = new ParTree(null, tag, pos + shift, px.pos, px.ast);
+        px.ast = new ParTree(prev, tag, pos + shift, px.pos, px.ast);
         return true;
       }
       return false;
     };
   }
 
-  public static ParseFunc pAbs(String edge, ParseFunc match, String tag, int shift) {
+  public static ParseFunc pAbs(ParseFunc match) {
     return (ParserContext px) -> {
       ParTree ast = px.ast;
       if (match.apply(px)) {
@@ -354,13 +535,13 @@ class Parser {
     };
   }
 
-  public static ParseFunc pExists(int sid, ParseFunc match) {
+  public static ParseFunc pExists(int sid) {
     return (ParserContext px) -> {
       return State.get(px.state, sid) != null;
     };
   }
 
-  public static ParseFunc pMatch(int sid, ParseFunc match) {
+  public static ParseFunc pMatch(int sid) {
     return (ParserContext px) -> {
       State state = State.get(px.state, sid);
       if (state != null) {
@@ -386,13 +567,13 @@ class Parser {
 
   static ParseFunc grammar(String start) {
     if (peg == null) {
-      peg = new HashMap();
+      peg = new HashMap<>();
       // TPEG
     }
     return peg.get(start);
   }
 
-  public static Function<String, ParTree> generate(String start) {
+  public static Function<String, ParseTree> generate(String start) {
     ParseFunc match = grammar(start);
     if (match == null) {
       throw new RuntimeException("undefined " + start);
@@ -400,14 +581,13 @@ class Parser {
     return (String inputs) -> {
       int pos = 0;
       ParserContext px = new ParserContext(null, inputs, 0, inputs.length());
+      ParTree result;
       if (match.apply(px)) {
-        if (px.ast == null) {
-          px.ast = new ParTree(null, "", pos, px.pos, null);
-        }
+        result = px.ast != null ? px.ast : new ParTree(null, "", pos, px.pos, null);
       } else {
-        px.ast = new ParTree(null, "err", px.head_pos, px.head_pos + 1, null);
+        result = new ParTree(null, "err", px.head_pos, px.head_pos, null);
       }
-      return px.ast;
+      return ParseTree.of(result, inputs);
     };
   }
 }
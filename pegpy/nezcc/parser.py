@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# A parser generated by pegpy nezcc; it depends on nothing but Python.
+# pegpy function -g math.tpeg parser.py -o math.py
+import sys
+
+UNKNOWN_URN = '(unknown source)'
+
+
+def nop(s): return s
+
+
+class ParseTree(list):
+    def __init__(self, tag, inputs, spos=0, epos=None, urn=UNKNOWN_URN):
+        self.tag_ = tag
+        self.inputs_ = inputs
+        self.spos_ = spos
+        self.epos_ = epos if epos is not None else len(inputs)
+        self.urn_ = urn
+
+    def gettag(self):
+        return self.tag_
+
+    def decode(self):
+        inputs, spos, epos = self.inputs_, self.spos_, self.epos_
+        rows = inputs[:spos + (1 if len(inputs) > spos else 0)].split('\n')
+        linenum, column = len(rows), len(rows[-1])-1
+        begin = inputs.rfind('\n', 0, spos) + 1
+        end = inputs.find('\n', spos)
+        if end == -1:
+            end = len(inputs)
+        line = inputs[begin:end]
+        mark = []
+        endcolumn = column + (epos - spos)
+        for i, c in enumerate(line):
+            if column <= i and i <= endcolumn:
+                mark.append('^' if ord(c) < 256 else '^^')
+            else:
+                mark.append(' ' if ord(c) < 256 else '  ')
+        return (self.urn_, spos, linenum, column, line, ''.join(mark))
+
+    def showing(self, msg='Syntax Error'):
+        urn, pos, linenum, cols, line, mark = self.decode()
+        return '{} ({}:{}:{}+{})\n{}\n{}'.format(msg, urn, linenum, cols, pos, line, mark)
+
+    def __eq__(self, tag):
+        return self.tag_ == tag
+
+    def isSyntaxError(self):
+        return self.tag_ == 'err'
+
+    def __str__(self):
+        return self.inputs_[self.spos_:self.epos_]
+
+    def __repr__(self):
+        if self.isSyntaxError():
+            return self.showing('Syntax Error')
+        sb = []
+        self.strOut(sb)
+        return ''.join(sb)
+
+    def dump(self, indent='\n  ', tab='  ', tag=nop, edge=nop, token=nop):
+        if self.isSyntaxError():
+            print(self.showing('Syntax Error'))
+            return
+        sb = []
+        self.strOut(sb, indent, tab, tag, edge, token)
+        print(''.join(sb))
+
+    def strOut(self, sb, indent='\n  ', tab='  ', tag=nop, edge=nop, token=nop):
+        sb.append('[' + tag(f'#{self.tag_}'))
+        hasContent = False
+        next_indent = indent + tab
+        for child in self:
+            hasContent = True
+            sb.append(indent)
+            child.strOut(sb, next_indent, tab, tag, edge, token)
+        for key in self.__dict__:
+            v = self.__dict__[key]
+            if isinstance(v, ParseTree):
+                hasContent = True
+                sb.append(indent)
+                sb.append(edge(key) + ': ')
+                v.strOut(sb, next_indent, tab, tag, edge, token)
+        if not hasContent:
+            sb.append(' ' + token(repr(str(self))))
+        sb.append(']')
+
+
+# nodes are built as a reversed list; an edge has a negative epos
+
+class PTree(object):
+    __slots__ = ['prev', 'tag', 'spos', 'epos', 'child']
+
+    def __init__(self, prev, tag, spos, epos, child):
+        self.prev = prev
+        self.tag = tag
+        self.spos = spos
+        self.epos = epos
+        self.child = child
+
+
+def PTree2ParseTree(pt, urn, inputs):
+    if pt.prev is not None:
+        return PTree2ParseTreeImpl('', urn, inputs, pt.spos, pt.epos, pt)
+    return PTree2ParseTreeImpl(pt.tag, urn, inputs, pt.spos, pt.epos, pt.child)
+
+
+def PTree2ParseTreeImpl(tag, urn, inputs, spos, epos, subnode):
+    t = ParseTree(tag, inputs, spos, epos, urn)
+    while subnode is not None:
+        if subnode.epos < 0:
+            if subnode.child is None:
+                tt = PTree2ParseTreeImpl('', urn, inputs, subnode.spos, -subnode.epos, None)
+            else:
+                tt = PTree2ParseTree(subnode.child, urn, inputs)
+            if subnode.tag == '':
+                t.append(tt)
+            else:
+                setattr(t, subnode.tag, tt)
+        else:
+            t.append(PTree2ParseTreeImpl(subnode.tag, urn, inputs,
+                                         subnode.spos, subnode.epos, subnode.child))
+        subnode = subnode.prev
+    t.reverse()
+    return t
+
+
+class ParserContext(object):
+    __slots__ = ['inputs', 'pos', 'epos', 'headpos', 'ast', 'state', 'memo', 'dicts']
+
+    def __init__(self, inputs, spos, epos, nmemo):
+        self.inputs = inputs
+        self.pos = spos
+        self.epos = epos
+        self.headpos = spos
+        self.ast = None
+        self.state = None
+        self.memo = [{} for _ in range(nmemo)]
+        self.dicts = {}
+
+
+class State(object):
+    __slots__ = ['sid', 'val', 'prev']
+
+    def __init__(self, sid, val, prev):
+        self.sid = sid
+        self.val = val
+        self.prev = prev
+
+
+def getstate(state, sid):
+    while state is not None:
+        if state.sid == sid:
+            return state
+        state = state.prev
+    return None
+
+
+# terminals
+
+def char(px, s):
+    if px.inputs.startswith(s, px.pos, px.epos):
+        px.pos += len(s)
+        return True
+    return False
+
+
+def anychar(px):
+    if px.pos < px.epos:
+        px.pos += 1
+        return True
+    return False
+
+
+def charset(px, cs):
+    if px.pos < px.epos and px.inputs[px.pos] in cs:
+        px.pos += 1
+        return True
+    return False
+
+
+def complement(px, cs):
+    if px.pos < px.epos and px.inputs[px.pos] not in cs:
+        px.pos += 1
+        return True
+    return False
+
+
+def bitset(px, bs):
+    if px.pos < px.epos and (bs >> ord(px.inputs[px.pos])) & 1:
+        px.pos += 1
+        return True
+    return False
+
+
+def choice(px, dic, empty):
+    # strings of a choice grouped by their first character
+    if px.pos < px.epos:
+        for s in dic.get(px.inputs[px.pos], ()):
+            if px.inputs.startswith(s, px.pos, px.epos):
+                px.pos += len(s)
+                return True
+    return empty
+
+
+# memo entries are (state, end position or -1, nodes, state after)
+
+def attach(prev, ast):
+    if ast is None:
+        return prev
+    return PTree(attach(prev, ast.prev), ast.tag, ast.spos, ast.epos, ast.child)
+
+
+def memo(px, mid, f):
+    table = px.memo[mid]
+    key = px.pos
+    m = table.get(key)
+    if m is not None and m[0] is px.state:
+        if m[1] < 0:
+            return False
+        px.pos = m[1]
+        px.ast = attach(px.ast, m[2])
+        px.state = m[3]
+        return True
+    prev, state = px.ast, px.state
+    px.ast = None
+    if f(px):
+        ast = px.ast
+        table[key] = (state, px.pos, ast, px.state)
+        px.ast = attach(prev, ast)
+        return True
+    table[key] = (state, -1, None, None)
+    px.ast = prev
+    return False
+
+
+def commit(px):
+    # nothing before px.pos will be parsed again
+    for table in px.memo:
+        for key in [key for key in table if key < px.pos]:
+            del table[key]
+    return True
+
+
+# symbol tables
+
+def symbol(px, sid, pos):
+    px.state = State(sid, px.inputs[pos:px.pos], px.state)
+    return True
+
+
+def match(px, sid):
+    state = getstate(px.state, sid)
+    if state is not None and px.inputs.startswith(state.val, px.pos, px.epos):
+        px.pos += len(state.val)
+        return True
+    return False
+
+
+def define(px, name, pos):
+    s = px.inputs[pos:px.pos]
+    if len(s) > 0:
+        l = px.dicts.setdefault(name, {}).setdefault(s[0], [])
+        for i in range(len(l)):
+            if len(s) > len(l[i]):
+                l.insert(i, s)
+                return True
+        l.append(s)
+    return True
+
+
+def indict(px, name):
+    d = px.dicts.get(name)
+    if d is not None and px.pos < px.epos:
+        return choice(px, d, False)
+    return False
+
+
+def skip(px):
+    px.pos = min(px.headpos, px.epos)
+    return True
+
+#TPEG
+
+
+def generate(start=START):
+    f = RULES[start]
+
+    def parse(inputs, urn=UNKNOWN_URN, pos=0, epos=None):
+        if epos is None:
+            epos = len(inputs)
+        px = ParserContext(inputs, pos, epos, NMEMO)
+        if not f(px):
+            result = PTree(None, 'err', px.headpos, px.headpos, None)
+        else:
+            result = px.ast if px.ast is not None else PTree(None, '', pos, px.pos, None)
+        return PTree2ParseTree(result, urn, inputs)
+    return parse
+
+
+parse = generate()
+
+#EXAMPLE
+
+
+def main(argv):
+    if len(argv) == 0:
+        for name, s in EXAMPLES:
+            print(name, repr(s))
+            generate(name)(s).dump()
+    for s in argv:
+        try:
+            with open(s) as f:
+                s = f.read()
+        except OSError:
+            pass
+        parse(s).dump()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
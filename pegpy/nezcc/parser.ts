@@ -1,42 +1,27 @@
 export class ParseTree {
   public tag: string;
-  public urn: any;
+  public urn: string;
   public inputs: string;
   public spos: number;
   public epos: number;
   public nodes: [string, ParseTree][];
 
-  public constructor(tag: string, spos: number, epos: number, child: any) {
+  public constructor(tag: string, urn: string, inputs: string, spos: number, epos: number) {
     this.tag = tag;
-    this.urn = child;
-    this.inputs = '';
+    this.urn = urn;
+    this.inputs = inputs;
     this.spos = spos;
     this.epos = epos;
-    this.nodes = ParseTree.empties;
+    this.nodes = [];
   }
 
-  static empties: [string, ParseTree][] = []
-
-  protected setup(urn: string, inputs: string) {
-    if (this.urn !== null) {
-      const nodes: [string, ParseTree][] = [];
-      var entry: Merge = this.urn;
-      while (entry !== null) {
-        nodes.push([entry.edge, entry.child.setup(urn, inputs)])
-        entry = entry.prev;
-      }
-      this.nodes = nodes.reverse();
-    }
-    this.urn = urn;
-    this.inputs = inputs;
-    var t: any = this;
-    for (var i = 0; i < this.nodes.length; i += 1) {
-      t[i] = this.nodes[i][1];
-      if (this.nodes[i][0] !== '') {
-        t[this.nodes[i][0]] = this.nodes[i][1];
-      }
+  // the first child with a label keeps it
+  public add(edge: string, child: ParseTree) {
+    (this as any)[this.nodes.length] = child;
+    if (edge !== '' && !this.contains(edge)) {
+      (this as any)[edge] = child;
     }
-    return this;
+    this.nodes.push([edge, child]);
   }
 
   public is(tag: string) {
@@ -134,25 +119,66 @@ export class ParseTree {
 
 }
 
-class Merge {
-  public prev: any;
-  public edge: string;
-  public child: ParseTree;
+// nodes are built as a reversed list; an edge has a negative epos
 
-  public constructor(prev: any, edge: string, child: ParseTree) {
+class PTree {
+  public prev: PTree | null;
+  public tag: string;
+  public spos: number;
+  public epos: number;
+  public child: PTree | null;
+
+  public constructor(prev: PTree | null, tag: string, spos: number, epos: number, child: PTree | null) {
     this.prev = prev;
-    this.edge = edge;
+    this.tag = tag;
+    this.spos = spos;
+    this.epos = epos;
     this.child = child;
   }
 }
 
+const PTree2ParseTree = (pt: PTree, urn: string, inputs: string): ParseTree => {
+  if (pt.prev !== null) {
+    return PTree2ParseTreeImpl('', urn, inputs, pt.spos, pt.epos, pt);
+  }
+  return PTree2ParseTreeImpl(pt.tag, urn, inputs, pt.spos, pt.epos, pt.child);
+}
+
+const PTree2ParseTreeImpl = (tag: string, urn: string, inputs: string, spos: number, epos: number, subnode: PTree | null) => {
+  const nodes: [string, ParseTree][] = [];
+  while (subnode !== null) {
+    if (subnode.epos < 0) {
+      const child = subnode.child === null
+        ? PTree2ParseTreeImpl('', urn, inputs, subnode.spos, -subnode.epos, null)
+        : PTree2ParseTree(subnode.child, urn, inputs);
+      nodes.push([subnode.tag, child]);
+    }
+    else {
+      nodes.push(['', PTree2ParseTreeImpl(subnode.tag, urn, inputs, subnode.spos, subnode.epos, subnode.child)]);
+    }
+    subnode = subnode.prev;
+  }
+  const t = new ParseTree(tag, urn, inputs, spos, epos);
+  for (var i = nodes.length - 1; i >= 0; i -= 1) {
+    t.add(nodes[i][0], nodes[i][1]);
+  }
+  return t;
+}
+
+const attach = (prev: PTree | null, ast: PTree | null): PTree | null => {
+  if (ast === null) {
+    return prev;
+  }
+  return new PTree(attach(prev, ast.prev), ast.tag, ast.spos, ast.epos, ast.child);
+}
+
 class ParserContext {
   public urn: string;
   public inputs: String;
   public pos: number;
   public epos: number;
   public head_pos: number;
-  public ast: any;
+  public ast: PTree | null;
   public state: State | null;
   public memos: Memo[];
   public constructor(urn: string, inputs: string, pos: number, epos: number) {
@@ -250,6 +276,48 @@ const pRange = (chars: string, ranges: string[]) => {
   }
 }
 
+const pComplement = (chars: string, ranges: string[]) => {
+  const match = pRange(chars, ranges);
+  return (px: ParserContext) => {
+    if (px.pos < px.epos) {
+      const pos = px.pos;
+      if (match(px)) {
+        px.pos = pos;
+        return false;
+      }
+      px.pos += 1;
+      return true;
+    }
+    return false;
+  }
+}
+
+const pDict = (...texts: string[]) => {
+  const dic = new Map<string, string[]>();
+  for (const text of texts) {
+    if (text.length === 0) {
+      break;
+    }
+    const c = text.charAt(0);
+    if (!dic.has(c)) {
+      dic.set(c, []);
+    }
+    dic.get(c)!.push(text);
+  }
+  const empty = texts.indexOf('') !== -1;
+  return (px: ParserContext) => {
+    if (px.pos < px.epos) {
+      for (const text of dic.get(px.inputs.charAt(px.pos)) || []) {
+        if (px.inputs.startsWith(text, px.pos)) {
+          px.pos += text.length;
+          return true;
+        }
+      }
+    }
+    return empty;
+  }
+}
+
 const pMany = (match: (px: ParserContext) => boolean) => {
   return (px: ParserContext) => {
     var pos = px.pos;
@@ -371,7 +439,13 @@ const pOre2 = (match: (px: ParserContext) => boolean, match2: (px: ParserContext
     px.head_pos = Math.max(px.pos, px.head_pos);
     px.pos = pos;
     px.ast = ast;
-    return match2(px);
+    if (match2(px)) {
+      return true;
+    }
+    px.head_pos = Math.max(px.pos, px.head_pos);
+    px.pos = pos;
+    px.ast = ast;
+    return false;
   }
 }
 
@@ -387,31 +461,76 @@ const pRef = (peg: any, name: string) => {
 
 class Memo {
   public key: number;
+  public mid: number;
+  public prevState: State | null;
+  public result: boolean;
+  public pos: number;
+  public head: number;
+  public ast: PTree | null;
+  public state: State | null;
   public constructor() {
     this.key = -1;
+    this.mid = -1;
+    this.prevState = null;
+    this.result = false;
+    this.pos = 0;
+    this.head = 0;
+    this.ast = null;
+    this.state = null;
+  }
+}
+
+// a result is reused at the same position and with the same state
+const pMemo = (match: (px: ParserContext) => boolean, mid: number) => {
+  return (px: ParserContext) => {
+    const key = px.pos;
+    const m = px.memos[(key * 31 + mid) % px.memos.length];
+    if (m.key === key && m.mid === mid && m.prevState === px.state) {
+      px.head_pos = Math.max(m.head, px.head_pos);
+      if (m.result) {
+        px.pos = m.pos;
+        px.ast = attach(px.ast, m.ast);
+        px.state = m.state;
+      }
+      return m.result;
+    }
+    const prev = px.ast;
+    const state = px.state;
+    px.ast = null;
+    const result = match(px);
+    m.key = key;
+    m.mid = mid;
+    m.prevState = state;
+    m.result = result;
+    m.pos = px.pos;
+    m.head = px.head_pos;
+    m.ast = px.ast;
+    m.state = px.state;
+    px.ast = result ? attach(prev, px.ast) : prev;
+    return result;
   }
 }
 
 const pNode = (match: (px: ParserContext) => boolean, tag: string, shift: number) => {
   return (px: ParserContext) => {
-    const pos = px.pos
+    const pos = px.pos;
+    const prev = px.ast;
     px.ast = null;
     if (match(px)) {
-      px.ast = new ParseTree(tag, pos + shift, px.pos, px.ast);
+      px.ast = new PTree(prev, tag, pos + shift, px.pos, px.ast);
       return true;
     }
     return false;
   }
 }
 
-//def Merge(prev, edge, child):
-//return (prev, edge, child)
-
 const pEdge = (edge: string, match: (px: ParserContext) => boolean) => {
   return (px: ParserContext) => {
-    const ast = px.ast;
+    const pos = px.pos;
+    const prev = px.ast;
+    px.ast = null;
     if (match(px)) {
-      px.ast = new Merge(ast, edge, px.ast);
+      px.ast = new PTree(prev, edge, pos, -px.pos, px.ast);
       return true;
     }
     return false;
@@ -421,9 +540,15 @@ const pEdge = (edge: string, match: (px: ParserContext) => boolean) => {
 const pFold = (edge: string, match: (px: ParserContext) => boolean, tag: string, shift: number) => {
   return (px: ParserContext) => {
     const pos = px.pos;
-    px.ast = new Merge(null, edge, px.ast);
+    var prev: PTree | null = null;
+    var pt = px.ast;
+    if (pt !== null && pt.prev !== null) {
+      prev = pt.prev;
+      pt = new PTree(null, pt.tag, pt.spos, pt.epos, pt.child);
+    }
+    px.ast = edge === '' ? pt : new PTree(null, edge, 0, -pos, pt);
     if (match(px)) {
-      px.ast = new ParseTree(tag, pos + shift, px.pos, px.ast);
+      px.ast = new PTree(prev, tag, pos + shift, px.pos, px.ast);
       return true;
     }
     return false;
@@ -518,15 +643,14 @@ export const generate = (start: string) => {
     const op = (options === undefined) ? {} : options;
     const pos = 0;
     const px = new ParserContext(op['urn'] || '(unknown source)', inputs, 0, inputs.length);
+    var result: PTree;
     if (match(px)) {
-      if (px.ast === null) {
-        px.ast = new ParseTree('', pos, px.pos, null);
-      }
+      result = px.ast !== null ? px.ast : new PTree(null, '', pos, px.pos, null);
     }
     else {
-      px.ast = new ParseTree('err', px.head_pos, px.head_pos + 1, null);
+      result = new PTree(null, 'err', px.head_pos, px.head_pos, null);
     }
-    return px.ast.setup(px.urn, inputs);
+    return PTree2ParseTree(result, px.urn, inputs);
   }
 }
 
@@ -549,5 +673,5 @@ const example = (start: string, sample?: string) => {
 
 //EXAMPLE
 
-// pegpy nezcc -g math.tpeg parser.ts > math.ts
+// pegpy function -g math.tpeg parser.ts -o math.ts
 // npx ts-node math.ts 
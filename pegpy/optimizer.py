@@ -0,0 +1,347 @@
+import sys
+import time
+import copy
+from pegpy.tpeg2 import grammar, Grammar, Ref, Unary, Tuple, Char, Range, Seq, Ore, Alt
+from pegpy.tpeg2 import Not, Any, Option, Action, EMPTY, isSingleChar, mergeRange
+
+# Grammar Optimizer
+#   passes rewrite a copy of a loaded grammar before generate();
+#   the copy has its own gid, so generated functions are never shared.
+
+
+def size(pe):
+    if isinstance(pe, Unary) or isinstance(pe, Tuple):
+        return 1 + sum(size(e) for e in pe)
+    return 1
+
+
+def listRefs(peg, pe, refs, imported=False):
+    # imported rules are listed by their unique names
+    if isinstance(pe, Ref):
+        if pe.peg is peg:
+            refs.append(pe.name)
+        elif imported:
+            refs.append(pe.uname())
+    elif isinstance(pe, Unary) or isinstance(pe, Tuple):
+        for e in pe:
+            listRefs(peg, e, refs, imported)
+    return refs
+
+
+def reachable(peg, names, rules=None):
+    rules = peg if rules is None else rules
+    ns = []
+    stack = list(names)
+    while len(stack) > 0:
+        name = stack.pop()
+        if name not in ns and name in rules:
+            ns.append(name)
+            stack.extend(listRefs(peg, rules[name], [], rules is not peg))
+    return ns
+
+
+def rebind(pe, peg, g):
+    if isinstance(pe, Ref):
+        return g.newRef(pe.name) if pe.peg is peg else pe
+    if isinstance(pe, Tuple):
+        return pe.__class__(*[rebind(e, peg, g) for e in pe])
+    if isinstance(pe, Unary):
+        pe = copy.copy(pe)
+        pe.e = rebind(pe.e, peg, g)
+    return pe
+
+
+def copyGrammar(peg):
+    g = Grammar()
+    for name in peg.N:
+        g[name] = rebind(peg[name], peg, g)
+    g['@@example'].extend(peg['@@example'])
+    return g
+
+
+def leadingText(pe):
+    if isinstance(pe, Char):
+        return pe.text
+    if isinstance(pe, Seq) and isinstance(pe.es[0], Char):
+        return pe.es[0].text
+    return ''
+
+
+def commonPrefix(s, s2):
+    n = 0
+    while n < len(s) and n < len(s2) and s[n] == s2[n]:
+        n += 1
+    return s[:n]
+
+
+def dropPrefix(pe, n):
+    if isinstance(pe, Char):
+        return Char(pe.text[n:])
+    text = pe.es[0].text[n:]
+    es = pe.es[1:] if text == '' else [Char(text)] + pe.es[1:]
+    return es[0] if len(es) == 1 else Seq(*es)
+
+
+# Expressions made by the code generator passes; tpeg2 cannot run them
+
+class Complement(Unary):
+    # !X . for a character class X
+    def __repr__(self):
+        return f'!{self.e} .'
+
+
+class Trie(Ore):
+    # a choice of strings, dispatched on their first character
+    pass
+
+
+def isCharClass(pe):
+    if isinstance(pe, Char):
+        return len(pe.text) == 1
+    if isinstance(pe, Range):
+        return True
+    if isinstance(pe, Ore):
+        return all(isCharClass(e) for e in pe)
+    return False
+
+
+def toRange(pe):
+    if isinstance(pe, Ore):
+        r = toRange(pe.es[0])
+        for e in pe.es[1:]:
+            r = mergeRange(r, toRange(e))
+        return r
+    return pe if isinstance(pe, Range) else Range(pe.text, '')
+
+
+# Passes
+
+# annotations whose operand must stay a rule name, as in @lazy(A)
+NAMED = ('lazy',)
+
+
+class Pass(object):
+    name = 'pass'
+
+    def __init__(self):
+        self.rewrites = 0
+
+    def run(self, peg):
+        self.peg = peg
+        for name in peg.N:
+            peg[name] = self.visit(peg[name])
+
+    def visit(self, pe):
+        if isinstance(pe, Action) and pe.func in NAMED and isinstance(pe.e, Ref):
+            return self.rewrite(pe)
+        if isinstance(pe, Tuple):
+            es = [self.visit(e) for e in pe]
+            if any(e is not e2 for e, e2 in zip(es, pe)):
+                pe = pe.__class__(*es)
+        elif isinstance(pe, Unary):
+            e = self.visit(pe.e)
+            if e is not pe.e:
+                pe = copy.copy(pe)
+                pe.e = e
+        return self.rewrite(pe)
+
+    def rewrite(self, pe):
+        return pe
+
+
+class Inline(Pass):
+    # A = 'a' [0-9]  =>  references to A are replaced with its body
+    name = 'inline'
+
+    def __init__(self, maxsize=8):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def run(self, peg):
+        self.recursive = {name for name in peg.N
+                          if name in reachable(peg, listRefs(peg, peg[name], []))}
+        super().run(peg)
+
+    def rewrite(self, pe):
+        if isinstance(pe, Ref) and pe.peg is self.peg and pe.name not in self.recursive:
+            body = self.peg[pe.name]
+            if size(body) <= self.maxsize:
+                self.rewrites += 1
+                return self.visit(body)
+        return pe
+
+
+class Flatten(Pass):
+    # (a b) c  =>  a b c,  (a / b) / c  =>  a / b / c
+    name = 'flatten'
+
+    def rewrite(self, pe):
+        if isinstance(pe, Seq) or isinstance(pe, Ore) or isinstance(pe, Alt):
+            es = []
+            for e in pe:
+                if e.__class__ is pe.__class__:
+                    self.rewrites += 1
+                    es.extend(e)
+                else:
+                    es.append(e)
+            if len(es) > len(pe):
+                return pe.__class__(*es)
+        return pe
+
+
+class MergeChars(Pass):
+    # 'a' 'b'  =>  'ab',  'a' / [0-9]  =>  [a0-9]
+    name = 'merge'
+
+    def rewrite(self, pe):
+        if isinstance(pe, Seq):
+            es = []
+            for e in pe:
+                if isinstance(e, Char) and len(es) > 0 and isinstance(es[-1], Char):
+                    self.rewrites += 1
+                    es[-1] = Char(es[-1].text + e.text)
+                elif e is not EMPTY:
+                    es.append(e)
+            if len(es) < len(pe):
+                return EMPTY if len(es) == 0 else es[0] if len(es) == 1 else Seq(*es)
+        if isinstance(pe, Ore):
+            es = []
+            for e in pe:
+                if isSingleChar(e) and len(es) > 0 and isSingleChar(es[-1]):
+                    self.rewrites += 1
+                    es[-1] = mergeRange(es[-1], e)
+                else:
+                    es.append(e)
+            if len(es) < len(pe):
+                return es[0] if len(es) == 1 else Ore(*es)
+        return pe
+
+
+class Factor(Pass):
+    # 'ab' x / 'ac' y  =>  'a' ('b' x / 'c' y)
+    name = 'factor'
+
+    def rewrite(self, pe):
+        if not isinstance(pe, Ore) or pe.isDict():
+            return pe
+        ls = list(pe)
+        choices = []
+        while len(ls) > 0:
+            n = 1
+            prefix = leadingText(ls[0])
+            while n < len(ls) and len(prefix) > 0:
+                p = commonPrefix(prefix, leadingText(ls[n]))
+                if len(p) == 0:
+                    break
+                prefix = p
+                n += 1
+            if n > 1:
+                self.rewrites += 1
+                rest = self.choice([dropPrefix(e, len(prefix)) for e in ls[:n]])
+                choices.append(Seq(Char(prefix), rest) if rest is not EMPTY else Char(prefix))
+            else:
+                choices.append(ls[0])
+            ls = ls[n:]
+        return choices[0] if len(choices) == 1 else Ore(*choices)
+
+    def choice(self, es):
+        # alternatives after an empty one are never tried
+        for i, e in enumerate(es):
+            if isinstance(e, Char) and e.text == '':
+                if i == 0:
+                    return EMPTY
+                return Option(self.choice(es[:i]))
+        return es[0] if len(es) == 1 else self.rewrite(Ore(*es))
+
+
+class Unreachable(Pass):
+    # rules reached neither from the start nor from any example
+    name = 'unreachable'
+
+    def __init__(self, start=None):
+        super().__init__()
+        self.start = start
+
+    def run(self, peg):
+        names = [peg.start() if self.start is None else self.start]
+        names += [name for name, _ in peg['@@example']]
+        ns = reachable(peg, names)
+        for name in list(peg.N):
+            if name not in ns:
+                self.rewrites += 1
+                peg.N.remove(name)
+                del peg[name]
+
+
+class Negate(Pass):
+    # !'"' .  =>  a complement class
+    name = 'negate'
+
+    def rewrite(self, pe):
+        if isinstance(pe, Seq):
+            es = []
+            for e in pe:
+                if isinstance(e, Any) and len(es) > 0 and isinstance(es[-1], Not) \
+                        and isCharClass(es[-1].e):
+                    self.rewrites += 1
+                    es[-1] = Complement(toRange(es[-1].e))
+                else:
+                    es.append(e)
+            if len(es) < len(pe):
+                return es[0] if len(es) == 1 else Seq(*es)
+        return pe
+
+
+class MakeTrie(Pass):
+    # 'if' / 'in' / 'for'  =>  a trie dispatched on the first character
+    name = 'trie'
+
+    def __init__(self, minsize=2):
+        super().__init__()
+        self.minsize = minsize
+
+    def rewrite(self, pe):
+        if isinstance(pe, Ore) and not isinstance(pe, Trie) and pe.isDict() \
+                and len(pe) >= self.minsize:
+            self.rewrites += 1
+            return Trie(*pe)
+        return pe
+
+
+def defaultPasses(**options):
+    return [Inline(int(options.get('inline', 8))), Flatten(), MergeChars(),
+            Factor(), Unreachable(options.get('start'))]
+
+
+class PassManager(object):
+    def __init__(self, passes=None, **options):
+        self.passes = defaultPasses(**options) if passes is None else passes
+        self.stats = []
+
+    def run(self, peg):
+        g = copyGrammar(peg)
+        for p in self.passes:
+            rules, total = len(g.N), sum(size(g[name]) for name in g.N)
+            t = time.perf_counter()
+            p.run(g)
+            t = time.perf_counter() - t
+            self.stats.append((p.name, p.rewrites, rules, len(g.N),
+                               total, sum(size(g[name]) for name in g.N), t))
+        return g
+
+    def report(self, file=sys.stdout):
+        for name, rewrites, r, r2, s, s2, t in self.stats:
+            print(f'{name:<12} {rewrites:>5} rewrites  rules {r} -> {r2}  '
+                  f'size {s} -> {s2}  {t*1000:.2f}ms', file=file)
+
+
+def optimize(peg, passes=None, **options):
+    return PassManager(passes, **options).run(peg)
+
+
+if __name__ == '__main__':
+    for file in sys.argv[1:]:
+        print(file)
+        pm = PassManager()
+        pm.run(grammar(file))
+        pm.report()
@@ -0,0 +1,204 @@
+import os
+import mmap
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from pegpy.tpeg2 import grammar, generate, ParseTree, Node, Many
+from pegpy.optimizer import copyGrammar
+
+# Parallel Parsing
+#   a file that is a sequence of independent items (split_rule*) is cut
+#   into chunks at separators; workers parse the chunks and the items are
+#   stitched under one root with positions in the whole file.
+#
+#   Workers never receive text: each one maps the source file, decodes
+#   its own byte range and sends back a flat list of spans instead of a
+#   ParseTree, which would carry a copy of the input.
+
+CHUNK = 'Chunk'
+ITEM = 'ChunkItem'
+ChunkGrammars = {}
+
+
+def chunkGrammar(urn, split_rule):
+    # { split_rule* #Chunk } and { split_rule #Item } on a copy, so the
+    # loaded grammar is unchanged
+    key = (urn, split_rule)
+    if key not in ChunkGrammars:
+        peg = copyGrammar(grammar(urn))
+        peg[CHUNK] = Node(Many(peg.newRef(split_rule)), CHUNK)
+        peg[ITEM] = Node(peg.newRef(split_rule), ITEM)
+        ChunkGrammars[key] = peg
+    return ChunkGrammars[key]
+
+
+def chunkParser(urn, split_rule):
+    return generate(chunkGrammar(urn, split_rule), start=CHUNK)
+
+
+def itemParser(urn, split_rule):
+    # one item; the tree spans all the text it consumes
+    return generate(chunkGrammar(urn, split_rule), start=ITEM)
+
+
+def parseChunk(urn, split_rule, text, spos=0, epos=None):
+    return chunkParser(urn, split_rule)(text, urn, spos, epos)
+
+
+def readMapped(path, spos=0, epos=None):
+    # decodes a byte range of a file through a shared, read-only mapping
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[spos:epos].decode('utf-8')
+
+
+# spans are (label, tag, spos, epos, size) in preorder; size counts the
+# entries below, so the list needs no nesting and no text
+
+def flatten(t, label='', spans=None):
+    if spans is None:
+        spans = []
+    i = len(spans)
+    spans.append(None)
+    for child in t:
+        flatten(child, '', spans)
+    for key, v in t.__dict__.items():
+        if isinstance(v, ParseTree):
+            flatten(v, key, spans)
+    spans[i] = (label, t.tag_, t.spos_, t.epos_, len(spans) - i - 1)
+    return spans
+
+
+def unflatten(spans, inputs, shift, urn, i=0):
+    _, tag, spos, epos, size = spans[i]
+    t = ParseTree(tag, inputs, spos + shift, epos + shift, urn)
+    j = i + 1
+    while j <= i + size:
+        label = spans[j][0]
+        child = unflatten(spans, inputs, shift, urn, j)
+        if label == '':
+            t.append(child)
+        else:
+            setattr(t, label, child)
+        j += spans[j][4] + 1
+    return t
+
+
+def parseMapped(urn, start, path, spos=0, epos=None, chunk=False):
+    # (end or error position, decoded length, spans or None)
+    text = readMapped(path, spos, epos)
+    parser = chunkParser(urn, start) if chunk else generate(grammar(urn), start=start)
+    t = parser(text, str(path))
+    if t.isSyntaxError():
+        return t.spos_, len(text), None
+    return t.epos_, len(text), flatten(t)
+
+
+def boundaries(text, n, sep='\n'):
+    # cuts right after a separator near every n-th of the text
+    cuts = [0]
+    size = max(len(text) // n, 1)
+    for i in range(1, n):
+        pos = text.find(sep, max(cuts[-1], i * size))
+        if pos == -1:
+            break
+        cuts.append(pos + len(sep))
+    if cuts[-1] < len(text):
+        cuts.append(len(text))
+    return list(zip(cuts, cuts[1:]))
+
+
+def resolve(urn):
+    # workers load the grammar by an absolute path
+    path = Path(urn)
+    return str(path.resolve()) if '=' not in urn and path.exists() else urn
+
+
+def lastItem(spans):
+    # the start of the last top-level item, or None
+    i, last = 1, None
+    while i < len(spans):
+        last = spans[i][2]
+        i += spans[i][4] + 1
+    return last
+
+
+def parse_parallel(path, urn, split_rule=None, jobs=None, sep='\n', tag='', chunks=4):
+    '''
+    Parses a file of split_rule* with jobs worker processes.
+    Items are checked here against the whole file at every cut:
+    - when the items of a chunk stop before its end, the next item is
+      parsed; if it fails, that is the syntax error;
+    - otherwise the last item of the chunk is parsed, and it must end
+      at the cut.
+    A cut inside an item is merged with the next chunk and parsed again.
+    '''
+    urn = resolve(urn)
+    split_rule = split_rule or grammar(urn).start()
+    item = itemParser(urn, split_rule)
+    inputs = readMapped(path)
+    jobs = jobs or os.cpu_count() or 1
+    spans = []
+    if len(inputs) > 0:
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                spans = boundaries(mm, jobs * chunks, sep.encode('utf-8'))
+    root = ParseTree(tag, inputs, 0, len(inputs), str(path))
+    with ProcessPoolExecutor(jobs) as pool:
+        def submit(spos, epos):
+            return pool.submit(parseMapped, urn, split_rule, path, spos, epos, True)
+        futures = [submit(spos, epos) for spos, epos in spans]
+
+        def error(pos):
+            # queued chunks are not parsed for nothing
+            pool.shutdown(cancel_futures=True)
+            return ParseTree('err', inputs, pos, pos, str(path))
+
+        def endsAtCut(result, shift, cut):
+            start = lastItem(result)
+            if start is None:
+                return True
+            t = item(inputs, str(path), shift + start)
+            return not t.isSyntaxError() and t.epos_ == cut
+        i = shift = 0
+        while i < len(spans):
+            pos, length, result = futures[i].result()
+            if result is None:
+                return error(shift + pos)
+            if pos < length:
+                t = item(inputs, str(path), shift + pos)
+                if t.isSyntaxError():
+                    return error(t.spos_)
+                if i + 1 == len(spans):
+                    return error(shift + pos)
+            elif i + 1 == len(spans) or endsAtCut(result, shift, shift + length):
+                root.extend(unflatten(result, inputs, shift, str(path)))
+                shift += length
+                i += 1
+                continue
+            # the cut was inside an item
+            futures[i + 1].cancel()
+            spans[i:i+2] = [(spans[i][0], spans[i+1][1])]
+            futures[i:i+2] = [submit(*spans[i])]
+    return root
+
+
+def parse_files(paths, urn, start=None, jobs=None):
+    '''
+    Parses each file in a worker process; only spans cross the process
+    boundary and the trees refer to the text decoded here.
+    '''
+    urn = resolve(urn)
+    start = start or grammar(urn).start()
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(parseMapped, urn, start, path) for path in paths]
+        trees = []
+        for path, future in zip(paths, futures):
+            pos, _, result = future.result()
+            inputs = readMapped(path)
+            if result is None:
+                trees.append(ParseTree('err', inputs, pos, pos, str(path)))
+            else:
+                trees.append(unflatten(result, inputs, 0, str(path)))
+    return trees
@@ -413,7 +413,7 @@ def TPEG(g):
     rule(g, 'EdgeName', TreeAs('', c(('a', 'z'), '$'), many(
         c(('A', 'Z'), ('a', 'z'), ('0', '9'), '_'))))
     rule(g, 'Func', TreeAs('Func', '@', {'name': Identifier}, '(', __, {
-                       'params': ref('Params')}, ')'))
+                       'params': choice(ref('Params'), Empty)}, __, ')'))
     rule(g, 'Params', ListAs({'': Expression}, many(
         _, ',', __, {'': Expression}), __))
     # rule(g, 'Ref', TreeAs('Ref', ref('REF')))
@@ -681,6 +681,11 @@ class ParserContext:
     # setup parser
 
 
+# choices with this many alternatives that start with a literal are
+# dispatched by a DFA over those literals
+DISPATCH = 4
+
+
 def setup_generate():
     # def gen_Pexp0(pe, **option):
     #     try:
@@ -775,8 +780,78 @@ def setup_generate():
                 return True
             return False
 
+        keywords = keywordSet(pe.e)
+        if keywords is not None:
+            return gen_NotKeyword(keywords, match_not, **option)
         return match_not
 
+    def keywordSet(pe):
+        # 'kw' !X tail / 'kw2' !X tail2 / ... where X is [...] / E, the
+        # class holds every keyword character and the tails always succeed
+        pe = Ore2.expand(deref(pe))
+        if not isinstance(pe, Ore2):
+            return None
+        keywords, x = [], None
+        for e in pe:
+            e = deref(e)
+            if not isinstance(e, Seq2) or len(e) < 2 or not isinstance(e.es[1], Not):
+                return None
+            kw = deref(e.es[0])
+            if not isinstance(kw, Char) or kw.text == '' or deref(e.es[1].e) is not (x or deref(e.es[1].e)):
+                return None
+            x = deref(e.es[1].e)
+            if not all(isAlwaysSucceeded(t) for t in e.es[2:]):
+                return None
+            keywords.append((kw.text, e.es[2:]))
+        xs = Ore2.expand(x)
+        xs = list(xs) if isinstance(xs, Ore2) else [xs]
+        cs = deref(xs[0])
+        others = [literal(e) for e in xs[1:]]
+        if not isinstance(cs, Range) or '' in others:
+            return None
+        bits = first_range(cs)
+        if any((bits >> ord(c)) & 1 == 0 for kw, _ in keywords for c in kw):
+            return None
+        return keywords, bits, {text[0] for text in others}
+
+    def gen_NotKeyword(keywords, match_not, **option):
+        # !KEYWORD scans the word of class characters once and looks it up;
+        # headpos is raised as far as the keyword choice would have read.
+        # A word followed by the start of another X alternative is rare
+        # and left to match_not.
+        keywords, bits, others = keywords
+        table = {}
+        for i, (kw, tail) in enumerate(keywords):
+            if kw not in table:
+                # earlier keywords that are a prefix of kw read one more character
+                hp = max([len(kw)] + [len(k) + 1 for k, _ in keywords[:i] if k != kw and kw.startswith(k)])
+                pf = None if len(tail) == 0 else tail[0].gen(**option) if len(tail) == 1 else Seq2(*tail).gen(**option)
+                table[kw] = (hp, pf)
+        lengths = sorted({len(kw) for kw in table}, reverse=True)
+
+        def match_notkeyword(px):
+            inputs, pos, epos = px.inputs, px.pos, px.epos
+            end = pos
+            while end < epos and (bits >> ord(inputs[end])) & 1:
+                end += 1
+            word = inputs[pos:end]
+            if word in table:
+                if end < epos and inputs[end] in others:
+                    return match_not(px)
+                hp, tail = table[word]
+                px.headpos = max(pos + hp, px.headpos)
+                px.pos = end
+                if tail is not None:
+                    tail(px)
+                return False
+            for n in lengths:
+                if n < end - pos and word[:n] in table:
+                    px.headpos = max(pos + n + 1, px.headpos)
+                    break
+            px.headpos = max(pos, px.headpos)
+            return True
+        return match_notkeyword
+
     # Many
 
     def gen_Many(pe, **option):
@@ -860,38 +935,99 @@ def setup_generate():
 
         return match_ore
 
-    def trie(dic):
-        if '' in dic or len(dic) < 10:
-            return dic
-        d = {}
-        for s in dic:
-            s0, s = s[0], s[1:]
-            if s0 in d:
-                ss = d[s0]
-                if not s in ss: ss.append(s)
-            else:
-                d[s0] = [s]
-        for key in d:
-            d[key] = trie(d[key])
-        return d
-    
-    def match_trie(px, d):
-        if px.pos >= px.epos:
-            return False
-        if isinstance(d, dict):
-            c = px.inputs[px.pos]
-            if c in d:
-                px.pos += 1
-                return match_trie(px, d[c])
-            return False
-        pos = px.pos
-        inputs = px.inputs
-        for s in d:
-            if inputs.startswith(s, pos): 
-                px.pos += len(s)
-                return True
-        return False
+    # Literal choices
+    #   the literals that alternatives start with are compiled into a DFA;
+    #   states index flat tables and the walk stops at the longest literal
+    #   prefix of the input, so a choice costs one step per character
+    #   instead of one startswith() per alternative.
+
+    def literal(pe, depth=0):
+        # the literal that pe starts with ('' if not known)
+        pe = deref(pe)
+        if isinstance(pe, Char) or depth > 32:
+            return pe.text if isinstance(pe, Char) else ''
+        if isinstance(pe, Seq2):
+            return literal(pe.es[0], depth + 1)
+        if isinstance(pe, Node) or isinstance(pe, Edge2) or isinstance(pe, Fold2) or isinstance(pe, Abs):
+            return literal(pe.e, depth + 1)
+        return ''
+
+    def dfa(texts):
+        # trans[state] maps a character to the next state; paths[state]
+        # lists the texts (by index) that end on the way to state
+        trans, parents, ends = [{}], [0], [[]]
+        for i, text in enumerate(texts):
+            if text is None:
+                continue
+            state = 0
+            for c in text:
+                if c not in trans[state]:
+                    trans[state][c] = len(trans)
+                    trans.append({})
+                    parents.append(state)
+                    ends.append([])
+                state = trans[state][c]
+            ends[state].append(i)
+        paths = [ends[0]]
+        for state in range(1, len(trans)):
+            paths.append(paths[parents[state]] + ends[state])
+        return trans, paths
+
+    def gen_literals(texts):
+        # the first text (in order) that the input starts with
+        trans, paths = dfa(texts)
+        accept = [len(texts[min(p)]) if len(p) > 0 else -1 for p in paths]
+
+        def match_literals(px):
+            inputs, pos, epos = px.inputs, px.pos, px.epos
+            state = 0
+            while pos < epos:
+                s = trans[state].get(inputs[pos])
+                if s is None:
+                    break
+                state = s
+                pos += 1
+            n = accept[state]
+            if n < 0:
+                return False
+            px.pos += n
+            return True
+        return match_literals
 
+    def gen_dispatch(pe, prefixes, **option):
+        # only alternatives whose literal the input starts with (and those
+        # without one) are tried; skipping the first ones raises headpos
+        # as their failure would have
+        pfs = tuple(map(lambda e: e.gen(**option), pe))
+        unknown = [i for i, text in enumerate(prefixes) if text == '']
+        trans, paths = dfa([text if text != '' else None for text in prefixes])
+        cands = []
+        for path in paths:
+            ns = sorted(set(path) | set(unknown))
+            cands.append((tuple(pfs[n] for n in ns), len(ns) == 0 or ns[0] > 0))
+
+        def match_dispatch(px):
+            inputs, pos, epos = px.inputs, px.pos, px.epos
+            state = 0
+            while pos < epos:
+                s = trans[state].get(inputs[pos])
+                if s is None:
+                    break
+                state = s
+                pos += 1
+            ps, skipped = cands[state]
+            pos = px.pos
+            ast = px.ast
+            if skipped:
+                px.headpos = max(pos, px.headpos)
+            for pf in ps:
+                if pf(px):
+                    return True
+                px.headpos = max(px.pos, px.headpos)
+                px.pos = pos
+                px.ast = ast
+            return False
+        return match_dispatch
 
     def gen_Ore2(pe, **option):
         pe2 = Ore2.expand(pe)
@@ -899,12 +1035,11 @@ def setup_generate():
             #print('@not choice', pe, pe2)
             return pe2.gen(**option)
         pe = pe2
-        dic = [e.text for e in pe if isinstance(e, Char)]
-        #print('@choice', len(pe), len(dic))
-        if len(dic) == len(pe):
-            d = trie(dic)
-            return lambda px: match_trie(px, d)
-        #print('@choice', len(pe))
+        if all(isinstance(deref(e), Char) for e in pe):
+            return gen_literals([deref(e).text for e in pe])
+        prefixes = [literal(e) for e in pe]
+        if sum(1 for text in prefixes if text != '') >= DISPATCH:
+            return gen_dispatch(pe, prefixes, **option)
         return gen_Ore(pe, **option)
 
     # Ref
@@ -1067,6 +1202,19 @@ def setup_generate():
                 return True
             return skip
 
+        if fname == 'commit':  # @commit()
+            msize = max(len(option.get('memos', [])), 1)
+
+            def commit(px):
+                # nothing before px.pos will be parsed again
+                pos = px.pos
+                for m in px.memo:
+                    if m.key != -1 and m.key // msize < pos:
+                        m.key = -1
+                        m.ast = None
+                return True
+            return commit
+
         # SPEG
         if fname == 'symbol':   # @symbol(A)
             sid = getsid(str(params[0]))
@@ -1478,6 +1626,209 @@ def setup2():
 
 setup2()
 
+## Lint
+
+def isConsumed(pe, memo):
+    # isAlwaysConsumed() on a loaded grammar; Ref memoizes by rule name
+    if isinstance(pe, Ref):
+        if pe.name not in memo and pe.name in pe.peg:
+            memo[pe.name] = True  # left recursion
+            memo[pe.name] = isConsumed(pe.deref(), memo)
+        return memo.get(pe.name, True)
+    if isinstance(pe, Char):
+        return len(pe.text) > 0
+    if isinstance(pe, Any) or isinstance(pe, Range):
+        return True
+    if isinstance(pe, Seq2):
+        return any(isConsumed(e, memo) for e in pe)
+    if isinstance(pe, Ore2) or isinstance(pe, Alt2):
+        return all(isConsumed(e, memo) for e in pe)
+    if isinstance(pe, Many1) or isinstance(pe, Node) or isinstance(pe, Edge2) \
+            or isinstance(pe, Fold2) or isinstance(pe, Abs) or isinstance(pe, Action):
+        return isConsumed(pe.e, memo)
+    return False
+
+
+def isAlwaysSucceeded(pe, visited=None):
+    if isinstance(pe, Char):
+        return len(pe.text) == 0
+    if isinstance(pe, Many) or isinstance(pe, Option):
+        return True
+    if isinstance(pe, Seq2):
+        return all(isAlwaysSucceeded(e, visited) for e in pe)
+    if isinstance(pe, Ore2) or isinstance(pe, Alt2):
+        return any(isAlwaysSucceeded(e, visited) for e in pe)
+    if isinstance(pe, Ref):
+        visited = set() if visited is None else visited
+        if pe.name in visited or pe.name not in pe.peg:
+            return False
+        visited.add(pe.name)
+        return isAlwaysSucceeded(pe.deref(), visited)
+    if isinstance(pe, Action) and pe.func not in ('scope', 'lazy', 'symbol'):
+        return False
+    if isinstance(pe, Node) or isinstance(pe, Edge2) or isinstance(pe, Fold2) \
+            or isinstance(pe, Abs) or isinstance(pe, Action):
+        return isAlwaysSucceeded(pe.e, visited)
+    return False
+
+
+def deref(pe):
+    while isinstance(pe, Ref) and pe.name in pe.peg:
+        pe = pe.deref()
+    return pe
+
+
+def exprSize(pe):
+    return 1 + sum(exprSize(e) for e in pe) if len(pe) > 0 else 1
+
+
+def leading(pe):
+    # the leading elements of a sequence
+    return list(pe) if isinstance(pe, Seq2) else [pe]
+
+
+def leadingText(pe):
+    e = leading(pe)[0]
+    return e.text if isinstance(e, Char) else ''
+
+
+def leadingRefs(pe, refs, visited, memo):
+    # rules that may be called at the start position of pe
+    if isinstance(pe, Ref):
+        if pe.name not in visited and pe.name in pe.peg:
+            visited.add(pe.name)
+            refs.append(pe.name)
+            leadingRefs(pe.deref(), refs, visited, memo)
+    elif isinstance(pe, Seq2):
+        for e in pe:
+            leadingRefs(e, refs, visited, memo)
+            if isConsumed(e, memo):
+                break
+    elif isinstance(pe, Tuple) or isinstance(pe, Unary):
+        for e in pe:
+            leadingRefs(e, refs, visited, memo)
+    return refs
+
+
+def isCharSet(pe):
+    pe = deref(pe)
+    if isinstance(pe, Range) or (isinstance(pe, Char) and len(pe.text) == 1):
+        return True
+    return isinstance(pe, Ore2) and all(isCharSet(e) for e in pe)
+
+
+class Linter(object):
+    '''
+    Finds costly constructs in a loaded grammar. Each finding is
+    (cost, rule, message); a cost is a rough count of redundant steps,
+    weighted by how often the rule is referenced.
+    '''
+
+    def __init__(self, peg):
+        self.peg = peg
+        self.findings = []
+        self.consumed = {}
+        self.refcount = {}
+        for name in peg.N:
+            self.countRefs(peg[name])
+
+    def countRefs(self, pe):
+        if isinstance(pe, Ref):
+            self.refcount[pe.name] = self.refcount.get(pe.name, 0) + 1
+        for e in pe or ():
+            self.countRefs(e)
+
+    def ruleSize(self, name):
+        return exprSize(self.peg[name]) if name in self.peg else 1
+
+    def lint(self):
+        for name in self.peg.N:
+            self.name = name
+            self.weight = 1 + self.refcount.get(name, 0)
+            self.visit(self.peg[name])
+        return sorted(self.findings, key=lambda f: -f[0])
+
+    def report(self, cost, msg):
+        self.findings.append((cost * self.weight, self.name, msg))
+
+    def visit(self, pe):
+        if isinstance(pe, Ore2):
+            self.checkPrefix(pe)
+            self.checkRefs(pe)
+            self.checkShadowed(pe)
+        if isinstance(pe, Many) or isinstance(pe, Many1):
+            self.checkMany(pe)
+        for e in pe or ():
+            self.visit(e)
+
+    def checkPrefix(self, pe):
+        es = list(pe)
+        i = 0
+        while i < len(es):
+            prefix = leadingText(es[i])
+            j = i + 1
+            while j < len(es) and len(prefix) > 1:
+                text = leadingText(es[j])
+                n = 0
+                while n < min(len(prefix), len(text)) and prefix[n] == text[n]:
+                    n += 1
+                if n < 2:
+                    break
+                prefix = prefix[:n]
+                j += 1
+            if j - i > 1:
+                self.report(len(prefix) * (j - i - 1),
+                            f'{j - i} choices share the prefix {Char(prefix)!r}; factor it out')
+            i = j
+
+    def checkRefs(self, pe):
+        counts = {}
+        for e in pe:
+            for name in leadingRefs(e, [], set(), self.consumed):
+                counts[name] = counts.get(name, 0) + 1
+        names = [name for name, n in counts.items() if n > 1 and self.ruleSize(name) > 2]
+        for name in names:
+            # rules called from another repeated rule are reported with it
+            if any(counts[name] <= counts[c] and name in leadingRefs(self.peg[c], [], set(), self.consumed)
+                   for c in names if c != name):
+                continue
+            n = counts[name]
+            self.report(self.ruleSize(name) * (n - 1),
+                        f'{name} is tried by {n} choices at the same position; memoize or factor it')
+
+    def checkShadowed(self, pe):
+        es = list(pe)
+        for i, e in enumerate(es[:-1]):
+            if isAlwaysSucceeded(e):
+                self.report(10 * (len(es) - i - 1),
+                            f'{e!r} always succeeds; the choices after it are never tried')
+                return
+            for e2 in es[i+1:]:
+                if self.isShadowed(deref(e), e2):
+                    self.report(10, f'{e2!r} is shadowed by the earlier choice {e!r}')
+
+    def isShadowed(self, e, e2):
+        if repr(e) == repr(e2):
+            return True
+        text = leadingText(e2)
+        if isinstance(e, Char):
+            return len(e.text) > 0 and text.startswith(e.text)
+        if isinstance(e, Range) and len(text) > 0:
+            return text[0] in e.chars or any(a <= text[0] <= b for a, b in e.ranges)
+        return False
+
+    def checkMany(self, pe):
+        e = pe.e
+        if not isConsumed(e, self.consumed):
+            self.report(20, f'{pe!r} repeats an expression that can consume nothing')
+        es = leading(e)
+        if len(es) == 2 and isinstance(es[0], Not) and isinstance(es[1], Any) and isCharSet(es[0].e):
+            self.report(2, f'{pe!r} tests one character per iteration; use a character class')
+
+
+def lint(peg):
+    return Linter(peg).lint()
+
 def grammar_factory():
     def char1(x):
         return Char(x) if x != '' else EMPTY
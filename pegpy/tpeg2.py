@@ -2,6 +2,9 @@ import sys
 import os
 import errno
 import inspect
+import re
+import threading
+import time
 from collections import namedtuple
 from enum import Enum
 from pathlib import Path
@@ -332,6 +335,8 @@ class Option(Unary):
     def __repr__(self):
         return grouping(self.e, inUnary)+'?'
 
+    def minLen(self): return 0
+
 class Node(Unary):
     __slot__ = ['e', 'tag']
 
@@ -388,6 +393,9 @@ class Action(Unary):
     def __repr__(self):
         return f'@{self.func}{self.params}'
 
+    def minLen(self):
+        return self.e.minLen() if self.func in ('lazy', 'scope', 'symbol', 'def') else 0
+
 
 # CONSTANT
 EMPTY = Char('')
@@ -427,16 +435,64 @@ def inUnary(e):
 def ss(e): 
     return grouping(e, lambda e: isinstance(e, Ore) or isinstance(e, Alt))
 
+# Hash-consing
+#   structurally equal subexpressions of a loaded grammar are replaced by
+#   one shared node, so the generator compiles each of them once.
+
+
+def internTable():
+    # the constants stay canonical; code compares with them by identity
+    table = {}
+    for pe in [EMPTY, ANY, FAIL]:
+        intern(pe, table)
+    return table
+
+
+def intern(pe, table):
+    # children are interned first, so nodes are compared by the ids of
+    # their children and the table keeps those children alive
+    if isinstance(pe, Tuple):
+        pe.es = [intern(e, table) for e in pe.es]
+        key = (pe.__class__,) + tuple(map(id, pe.es))
+    elif isinstance(pe, Unary):
+        pe.e = intern(pe.e, table)
+        attrs = (getattr(pe, 'tag', None), getattr(pe, 'edge', None))
+        if isinstance(pe, Action):
+            attrs = (pe.func, repr(pe.params))
+        key = (pe.__class__, id(pe.e)) + attrs
+    elif isinstance(pe, Char):
+        key = (Char, pe.text)
+    elif isinstance(pe, Range):
+        key = (Range, pe.chars, pe.ranges)
+    elif isinstance(pe, Ref):
+        key = (Ref, pe.uname())
+    elif isinstance(pe, Any):
+        key = (Any,)
+    else:
+        return pe
+    return table.setdefault(key, pe)
+
+
+def internGrammar(peg):
+    table = internTable()
+    for name in peg.N:
+        peg[name] = intern(peg[name], table)
+    return peg
+
 # # Grammar
 
 GrammarId = 0
+GrammarLock = threading.RLock()
 
 class Grammar(dict):
     def __init__(self):
         global GrammarId
-        self.gid = str(GrammarId)
+        with GrammarLock:
+            self.gid = str(GrammarId)
+            GrammarId += 1
         self.N = []
-        GrammarId += 1
+        self.compiled = {}
+        self.lock = threading.RLock()
         super().__setitem__('@@example', [])
 
     def __repr__(self):
@@ -460,15 +516,82 @@ class Grammar(dict):
 
     def newRef(self, name):
         key = '@' + name
-        if key not in self:
-            super().__setitem__(key, Ref(self, name))
-        return self[key]
+        with self.lock:
+            if key not in self:
+                super().__setitem__(key, Ref(self, name))
+            return self[key]
 
     def start(self):
         if len(self.N) == 0:
             self['EMPTY'] = EMPTY
         return self.N[0]
 
+    def __reduce__(self):
+        return (loadGrammar, dumpGrammar(self))
+
+# Serialized Grammar
+#   rules are stored as nested tuples (a bare str is a Char), so a
+#   pickled grammar skips parsing the .tpeg file and TPEGLoader.
+#   Bump GRAMMAR_VERSION whenever the encoding changes.
+
+GRAMMAR_VERSION = 1
+
+def encode(pe, peg):
+    if isinstance(pe, Char):
+        return pe.text
+    if isinstance(pe, Ref):
+        return ('Ref', pe.name) if pe.peg is peg else ('Ref', pe.name, pe.peg)
+    if isinstance(pe, Range):
+        return ('Range', pe.chars, pe.ranges)
+    if isinstance(pe, Tuple):
+        return (pe.cname(),) + tuple(encode(e, peg) for e in pe)
+    if isinstance(pe, Node):
+        return ('Node', pe.tag, encode(pe.e, peg))
+    if isinstance(pe, Edge):
+        return ('Edge', pe.edge, encode(pe.e, peg))
+    if isinstance(pe, Fold):
+        return ('Fold', pe.edge, pe.tag, encode(pe.e, peg))
+    if isinstance(pe, Action):
+        return ('Action', pe.func, encode(pe.e, peg)) + tuple(encode(e, peg) for e in pe.params)
+    if isinstance(pe, Unary):
+        return (pe.cname(), encode(pe.e, peg))
+    return (pe.cname(),)
+
+DECODE = {
+    'Any': lambda peg, t: ANY,
+    'Ref': lambda peg, t: (t[2] if len(t) > 2 else peg).newRef(t[1]),
+    'Range': lambda peg, t: Range(t[1], t[2]),
+    'Node': lambda peg, t: Node(decode(t[2], peg), t[1]),
+    'Edge': lambda peg, t: Edge(t[1], decode(t[2], peg)),
+    'Fold': lambda peg, t: Fold(t[1], decode(t[3], peg), t[2]),
+    'Action': lambda peg, t: Action(decode(t[2], peg), t[1], tuple(decode(e, peg) for e in t[3:])),
+}
+for c in [Seq, Ore, Alt]:
+    DECODE[c.__name__] = lambda peg, t, c=c: c(*[decode(e, peg) for e in t[1:]])
+for c in [And, Not, Many, Many1, Option, Abs]:
+    DECODE[c.__name__] = lambda peg, t, c=c: c(decode(t[1], peg))
+
+def decode(t, peg):
+    if isinstance(t, str):
+        return Char(t) if len(t) > 0 else EMPTY
+    return DECODE[t[0]](peg, t)
+
+def dumpGrammar(peg):
+    rules = tuple((name, encode(peg[name], peg)) for name in peg.N)
+    examples = tuple((name, str(doc), doc.urn_) for name, doc in peg['@@example'])
+    return (GRAMMAR_VERSION, rules, examples)
+
+def loadGrammar(version, rules, examples):
+    if version != GRAMMAR_VERSION:
+        raise ValueError(f'grammar version {version} is not supported (expected {GRAMMAR_VERSION})')
+    peg = Grammar()
+    for name, t in rules:
+        peg[name] = decode(t, peg)
+    internGrammar(peg)
+    for name, doc, urn in examples:
+        peg['@@example'].append((name, ParseTree('Doc', doc, 0, len(doc), urn)))
+    return peg
+
 def TPEG(peg):
     peg['Start'] = pSeq3(pRef(peg,'__'),pRef(peg,'Source'),pRef(peg,'EOF'));
     peg['__'] = pMany(pOre2(pRange(' \t\r\n',[]),pRef(peg,'COMMENT')));
@@ -618,11 +741,78 @@ class Memo(object):
         self.result = False
 
 
+class ParseTimeout(Exception):
+    def __init__(self, reason, headpos):
+        super().__init__(f'{reason} exceeded at {headpos}')
+        self.reason = reason
+        self.headpos = headpos
+
+
+class Limits(object):
+    # rule calls are counted down to the next check; the clock is read
+    # once per INTERVAL calls
+    INTERVAL = 1024
+    UNLIMITED = 1 << 62
+
+    def __init__(self, budget=None, deadline=None):
+        self.budget = budget
+        self.deadline = None if deadline is None else time.monotonic() + deadline
+
+    def tick(self, headpos):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise ParseTimeout('deadline', headpos)
+        n = Limits.UNLIMITED if self.deadline is None else Limits.INTERVAL
+        if self.budget is not None:
+            if self.budget <= 0:
+                raise ParseTimeout('budget', headpos)
+            n = min(n, self.budget)
+            self.budget -= n
+        return n - 1
+
+
+class Watchdog(object):
+    # counts re-evaluations of (rule, position) pairs and the characters
+    # that backtracking discards; each rule is reported once per parse
+    def __init__(self, inputs, urn, threshold=64, logger=None):
+        self.inputs = inputs
+        self.urn = urn
+        self.threshold = threshold
+        self.logger = Watchdog.log if logger is None else logger
+        self.calls = {}
+        self.wasted = {}
+        self.reported = set()
+
+    @classmethod
+    def log(cls, type, pos, msg):
+        print(pos.showing(f'[{type}] {msg}'), file=sys.stderr)
+
+    def call(self, name, pos):
+        key = (name, pos)
+        n = self.calls.get(key, 0) + 1
+        self.calls[key] = n
+        if n == self.threshold and ('call', name) not in self.reported:
+            self.reported.add(('call', name))
+            self.report(pos, pos, f'{name} is evaluated {n} times at the same position')
+
+    def discard(self, name, spos, epos):
+        if epos <= spos:
+            return
+        n, s, e = self.wasted.get(name, (0, spos, epos))
+        n, s, e = n + epos - spos, min(s, spos), max(e, epos)
+        self.wasted[name] = (n, s, e)
+        if n >= self.threshold * max(len(self.inputs), 1) and ('discard', name) not in self.reported:
+            self.reported.add(('discard', name))
+            self.report(s, e, f'{name} backtracked over {n} characters')
+
+    def report(self, spos, epos, msg):
+        self.logger('warning', ParseTree('', self.inputs, spos, epos, self.urn), msg)
+
+
 class ParserContext:
     __slots__ = ['inputs', 'pos', 'epos',
-                 'headpos', 'ast', 'state', 'memo']
+                 'headpos', 'ast', 'state', 'memo', 'steps', 'limits', 'watch']
 
-    def __init__(self, inputs, spos, epos):
+    def __init__(self, inputs, spos, epos, limits=None):
         self.inputs = inputs
         self.pos = spos
         self.epos = epos
@@ -630,6 +820,12 @@ class ParserContext:
         self.ast = None
         self.state = None
         self.memo = [Memo() for x in range(1789)]
+        self.limits = limits
+        self.steps = Limits.UNLIMITED if limits is None else -1
+        self.watch = None
+
+    def tick(self):
+        self.steps = self.limits.tick(max(self.pos, self.headpos))
 
     def getstate(self, state, sid):
         while state is not None:
@@ -643,6 +839,9 @@ class ParserContext:
 
 def match_empty(px): return True
 
+# larger first sets are not worth checking before a match
+FIRSTCHARS = 256
+
 
 def match_any(px):
     if px.pos < px.epos:
@@ -669,12 +868,21 @@ def match_trie(px, d):
 
 
 class Generator(object):
-    def __init__(self):
+    def __init__(self, lazy=False, limits=False, watch=False):
+        self.lazy = lazy
+        self.limits = limits
+        self.watch = watch
         self.peg = None
         self.generated = {}
         self.generating_nonterminal = ''
+        self.rulename = ''
         self.cache = {'': match_empty}
+        self.shared = {}
+        self.firsts = {}
         self.sids = {}
+        self.memos = []
+        # compiling mutates the tables above; parsing only reads them
+        self.lock = threading.RLock()
 
     def getsid(self, name):
         if not name in self.sids:
@@ -695,30 +903,49 @@ class Generator(object):
         return ps
 
     def generate(self, peg, **option):
+        with self.lock:
+            return self.generateParser(peg, **option)
+
+    def generateParser(self, peg, **option):
         self.peg = peg
         name = option.get('start', peg.start())
         start = peg.newRef(name)
         # if 'memos' in option and not isinstance(option['memos'], list):
         memos = option.get('memos', peg.N)
-        ps = self.makelist(start, {}, [])
+        self.memos = memos
+        if self.lazy:
+            ps = []
+        else:
+            ps = self.makelist(start, {}, [])
 
         for ref in ps:
             assert isinstance(ref, Ref)
             uname = ref.uname()
             self.generating_nonterminal = uname
-            A = self.emit(ref.deref(), 0)
+            self.rulename = ref.name
+            A = self.rule(self.emit(ref.deref(), 0))
             self.generating_nonterminal = ''
             idx = memos.index(ref.name)
             # if idx != -1 and ref.peg == peg:
             #     A = self.memoize(idx, len(memos), A)
             self.generated[uname] = A
 
-        pf = self.generated[start.uname()]
+        pf = self.Ref(start, 0)
+        watchdog = int(option.get('watchdog', 0))
+        logger = option.get('logger', Watchdog.log)
 
-        def parse(inputs, urn='(unknown source)', pos=0, epos=None, conv=PTree2ParseTree):
+        def parse(inputs, urn='(unknown source)', pos=0, epos=None, conv=PTree2ParseTree,
+                  budget=None, deadline=None):
             if epos is None:
                 epos = len(inputs)
-            px = ParserContext(inputs, pos, epos)
+            limits = None if budget is None and deadline is None else Limits(budget, deadline)
+            if limits is not None and not self.limits:
+                # only the rules of a checking variant count steps
+                checked = generate(peg, **dict(option, limits=True))
+                return checked(inputs, urn, pos, epos, conv, budget, deadline)
+            px = ParserContext(inputs, pos, epos, limits)
+            if self.watch:
+                px.watch = Watchdog(inputs, urn, watchdog, logger)
             if not pf(px):
                 result = PTree(None, "err", px.headpos, px.headpos, None)
             else:
@@ -727,18 +954,60 @@ class Generator(object):
             return conv(result, urn, inputs)
         return parse
 
+    def rule(self, A):
+        if self.watch:
+            name = self.rulename
+            B = A
+
+            def watch_rule(px):
+                px.watch.call(name, px.pos)
+                return B(px)
+            A = watch_rule
+        if not self.limits:
+            return A
+
+        # rule boundaries count steps against budget= and deadline=
+        def match_rule(px):
+            px.steps -= 1
+            if px.steps < 0:
+                px.tick()
+            return A(px)
+        return match_rule
+
     def emit(self, pe: ParsingExpression, step: int):
         pe = inline(pe)
+        # a shared node is compiled once; watched functions know their rule
+        if id(pe) in self.shared and not self.watch:
+            return self.shared[id(pe)][1]
         if isinstance(pe, Action):
             cname = pe.func.capitalize()
         else:
             cname = pe.__class__.__name__
         if hasattr(self, cname):
             f = getattr(self, cname)
-            return f(pe, step)
+            pf = f(pe, step)
+            self.shared[id(pe)] = (pe, pf)
+            return pf
         print('@TODO(Generator)', cname, pe)
         return match_empty
 
+    def firstChars(self, pe):
+        # the characters that can start pe, if pe cannot match empty and
+        # there are not too many of them to keep in a set
+        cs, nullable = firstSet(pe, self.firsts)
+        if cs is None or nullable:
+            return None
+        chars = set(cs.chars)
+        r = cs.ranges
+        while len(r) > 1:
+            if ord(r[1]) - ord(r[0]) >= FIRSTCHARS:
+                return None
+            chars.update(map(chr, range(ord(r[0]), ord(r[1]) + 1)))
+            r = r[2:]
+        if len(chars) > FIRSTCHARS:
+            return None
+        return frozenset(chars)
+
     def memoize(self, mp, msize, A):
         def match_memo(px):
             key = (msize * px.pos) + mp
@@ -860,6 +1129,7 @@ class Generator(object):
 
     def Not(self, pe, step):
         pf = self.emit(pe.e, step)
+        pf = self.watched(pf, True)
 
         def match_not(px):
             pos = px.pos
@@ -876,6 +1146,7 @@ class Generator(object):
 
     def Many(self, pe, step):
         pf = self.emit(pe.e, step)
+        pf = self.guarded(self.watched(pf), pe.e)
 
         def match_many(px):
             pos = px.pos
@@ -891,13 +1162,14 @@ class Generator(object):
         return match_many
 
     def Many1(self, pe, step):
-        pf = self.emit(pe.e, step)
+        pf = self.watched(self.emit(pe.e, step))
+        pf2 = self.guarded(pf, pe.e)
 
         def match_many1(px):
             if pf(px):
                 pos = px.pos
                 ast = px.ast
-                while pf(px) and pos < px.pos:
+                while pf2(px) and pos < px.pos:
                     pos = px.pos
                     ast = px.ast
                 px.headpos = max(px.pos, px.headpos)
@@ -909,7 +1181,7 @@ class Generator(object):
         return match_many1
 
     def Option(self, pe, step):
-        pf = self.emit(pe.e, step)
+        pf = self.guarded(self.watched(self.emit(pe.e, step)), pe.e)
 
         def match_option(px):
             pos = px.pos
@@ -952,7 +1224,10 @@ class Generator(object):
             DEBUG('DIC', dic)
             return lambda px: match_trie(px, dic)
 
-        pfs = tuple(map(lambda e: self.emit(e, step), pe))
+        pfs = tuple(map(lambda e: self.watched(self.emit(e, step)), pe))
+        firsts = [self.firstChars(e) for e in pe]
+        if any(chars is not None for chars in firsts):
+            return self.dispatch(pfs, firsts)
 
         def match_ore(px):
             pos = px.pos
@@ -967,13 +1242,91 @@ class Generator(object):
 
         return match_ore
 
+    def dispatch(self, pfs, firsts):
+        # the next character selects the alternatives that can match it;
+        # the others would fail without reading it, only raising headpos
+        # if one of them was tried before the first selected one
+        selected = {}
+
+        def choices(c):
+            ns = tuple(n for n, chars in enumerate(firsts) if chars is None or c in chars)
+            if ns not in selected:
+                selected[ns] = (tuple(pfs[n] for n in ns), len(ns) == 0 or ns[0] > 0)
+            return selected[ns]
+        table = {c: choices(c) for chars in firsts if chars is not None for c in chars}
+        others = choices(None)
+
+        def match_dispatch(px):
+            pos = px.pos
+            ast = px.ast
+            ps, skipped = table.get(px.inputs[pos], others) if pos < px.epos else others
+            if skipped:
+                px.headpos = max(pos, px.headpos)
+            for pf in ps:
+                if pf(px):
+                    return True
+                px.headpos = max(px.pos, px.headpos)
+                px.pos = pos
+                px.ast = ast
+            return False
+
+        return match_dispatch
+
+    def guarded(self, pf, pe):
+        # fails before calling pf when the next character cannot start pe
+        chars = self.firstChars(pe)
+        if chars is None:
+            return pf
+
+        def match_first(px):
+            return px.pos < px.epos and px.inputs[px.pos] in chars and pf(px)
+        return match_first
+
+    def watched(self, pf, lookahead=False):
+        # reports characters consumed and then given up by backtracking
+        if not self.watch:
+            return pf
+        name = self.rulename
+
+        def watch_backtrack(px):
+            pos = px.pos
+            if pf(px):
+                if lookahead:
+                    px.watch.discard(name, pos, px.pos)
+                return True
+            px.watch.discard(name, pos, px.pos)
+            return False
+        return watch_backtrack
+
     def Ref(self, pe, step):
         uname = pe.uname()
         generated = self.generated
         if uname not in generated:
-            generated[uname] = lambda px: generated[uname](px)
+            if self.lazy:
+                generated[uname] = self.lazyRef(pe)
+            else:
+                generated[uname] = lambda px: generated[uname](px)
         return generated[uname]
 
+    def lazyRef(self, ref):
+        uname = ref.uname()
+        generated = self.generated
+
+        def compile_rule(px):
+            # the first call compiles the rule in place of this stub
+            pf = generated[uname]
+            if pf is compile_rule:
+                with self.lock:
+                    pf = generated[uname]
+                    if pf is compile_rule:
+                        self.generating_nonterminal = uname
+                        self.rulename = ref.name
+                        pf = self.rule(self.emit(ref.deref(), 0))
+                        self.generating_nonterminal = ''
+                        generated[uname] = pf
+            return pf(px)
+        return compile_rule
+
     # Tree Construction
 
     def Node(self, pe, step):
@@ -1054,9 +1407,8 @@ class Generator(object):
     #         px.memo[key] = [s]
 
     def Lazy(self, pe, step):  # @lazy(A)
-        name = pe.e.name
-        peg = self.peg
-        return peg.newRef(name).gen(**option) if name in peg else pe.e.gen(**option)
+        # a reference is already called through generated[uname]
+        return self.emit(pe.e, step)
 
     def Skip(self, pe, step):  # @skip()
         def skip(px):
@@ -1064,6 +1416,12 @@ class Generator(object):
             return True
         return skip
 
+    def Commit(self, pe, step):  # @commit()
+        # tpeg2 ignores @commit: rules are not memoized (see generateParser),
+        # backtracking state lives on the Python stack, and px.ast is the
+        # tree being built; the vm and cbase engines release their memos
+        return match_empty
+
     def Symbol(self, pe, step):  # @symbol(A)
         params = pe.params
         sid = self.getsid(str(params[0]))
@@ -1185,10 +1543,162 @@ class Generator(object):
             return cond
     '''
 
-generator = Generator()
+def generator(peg: Grammar, **options):
+    # rules are compiled once per grammar and option set; the parser for
+    # each start symbol is an entry point into the same functions
+    lazy = bool(options.get('lazy', False))
+    limits = bool(options.get('limits', False))
+    # --watchdog 0 from the command line arrives as '0'
+    watch = int(options.get('watchdog', 0)) > 0
+    key = ('tpeg2', repr(options.get('memos')), lazy)
+    key += (('limits',) if limits else ()) + (('watchdog',) if watch else ())
+    with peg.lock:
+        if key not in peg.compiled:
+            peg.compiled[key] = Generator(lazy, limits, watch)
+    return peg.compiled[key]
+
 
 def generate(peg: Grammar, **options):
-  return generator.generate(peg, **options)
+    return generator(peg, **options).generate(peg, **options)
+
+# Scan
+
+EMPTYSET = Range('', '')
+
+
+def unionSet(cs, cs2):
+    return None if cs is None or cs2 is None else mergeRange(cs, cs2)
+
+
+def firstSet(pe, memo=None):
+    '''
+    The characters that pe can consume or look at first, as a Range
+    (None if any character can), and whether pe can succeed without
+    consuming anything. Input that starts with none of them makes pe fail
+    before it reads anything, or succeed empty if it is nullable.
+    '''
+    memo = {} if memo is None else memo
+    if isinstance(pe, Char):
+        return (Range(pe.text[0], ''), False) if len(pe.text) > 0 else (EMPTYSET, True)
+    if isinstance(pe, Range):
+        return pe, False
+    if isinstance(pe, Ref):
+        uname = pe.uname()
+        if uname not in memo:
+            memo[uname] = (EMPTYSET, False)  # left recursion never matches
+            memo[uname] = firstSet(pe.deref(), memo)
+        return memo[uname]
+    if isinstance(pe, Seq):
+        cs = EMPTYSET
+        for e in pe:
+            cs2, nullable = firstSet(e, memo)
+            cs = unionSet(cs, cs2)
+            if not nullable:
+                return cs, False
+        return cs, True
+    if isinstance(pe, Ore) or isinstance(pe, Alt):
+        cs, nullable = EMPTYSET, False
+        for e in pe:
+            cs2, nullable2 = firstSet(e, memo)
+            cs, nullable = unionSet(cs, cs2), nullable or nullable2
+        return cs, nullable
+    if isinstance(pe, Many) or isinstance(pe, Option):
+        return firstSet(pe.e, memo)[0], True
+    if isinstance(pe, And) or isinstance(pe, Not):
+        return firstSet(pe.e, memo)[0], True
+    if isinstance(pe, Action):
+        if pe.func in ('lazy', 'scope', 'symbol', 'def'):
+            return firstSet(pe.e, memo)
+        if pe.func in ('exists', 'commit'):
+            return EMPTYSET, True
+        return None, False
+    if isinstance(pe, Unary):  # Many1, Node, Edge, Fold, Abs
+        return firstSet(pe.e, memo)
+    return None, False
+
+
+def charClass(cs):
+    # a regular expression for a Range, or None for the empty one
+    if len(cs.chars) == 0 and len(cs.ranges) < 2:
+        return None
+    r = cs.ranges
+    ranges = []
+    while len(r) > 1:
+        ranges.append(re.escape(r[0]) + '-' + re.escape(r[1]))
+        r = r[2:]
+    return '[' + ''.join(map(re.escape, cs.chars)) + ''.join(ranges) + ']'
+
+
+def finditer(peg, inputs, rules=None, urn='(unknown source)', pos=0, epos=None,
+             conv=PTree2ParseTree, **options):
+    '''
+    Yields the non-overlapping matches of rules (a name or a list of
+    names) from left to right, like re.finditer. Positions that no rule
+    can start at are skipped by one regular expression search; the rules
+    are tried in order and an untagged match is tagged with the rule name.
+    '''
+    rules = [peg.start()] if rules is None else [rules] if isinstance(rules, str) else rules
+    g = generator(peg, **options)
+    cs, memo = EMPTYSET, {}
+    with g.lock:
+        for name in rules:
+            g.generate(peg, **dict(options, start=name))
+            first, nullable = firstSet(peg.newRef(name), memo)
+            cs = None if nullable else unionSet(cs, first)
+        pfs = [(name, g.Ref(peg.newRef(name), 0)) for name in rules]
+    pattern = None if cs is None else charClass(cs)
+    prefilter = None if pattern is None else re.compile(pattern)
+    epos = len(inputs) if epos is None else epos
+    px = ParserContext(inputs, pos, epos)
+    while pos < epos:
+        if prefilter is not None:
+            m = prefilter.search(inputs, pos, epos)
+            if m is None:
+                return
+            pos = m.start()
+        for name, pf in pfs:
+            px.pos, px.headpos, px.ast, px.state = pos, pos, None, None
+            if pf(px) and px.pos > pos:
+                result = px.ast if px.ast is not None else PTree(None, name, pos, px.pos, None)
+                yield conv(result, urn, inputs)
+                pos = px.pos
+                break
+        else:
+            pos += 1
+
+# Parser
+
+class Parser(object):
+    '''
+    A parser that can be pickled. Generated parsers are closures, so only
+    the grammar and the options are stored and the rules are compiled
+    again in the process that loads it (lazily with lazy=True).
+    '''
+    OPTIONS = ('start', 'memos', 'lazy')
+
+    def __init__(self, peg, generator=None, **options):
+        self.peg = peg
+        self.generator = generate if generator is None else generator
+        self.options = {key: options[key] for key in Parser.OPTIONS if key in options}
+        self.parser = None
+
+    def __call__(self, inputs, urn='(unknown source)', pos=0, epos=None, **limits):
+        if self.parser is None:
+            self.parser = self.generator(self.peg, **self.options)
+        return self.parser(inputs, urn, pos, epos, **limits)
+
+    def finditer(self, inputs, rules=None, urn='(unknown source)', pos=0, epos=None):
+        options = {key: v for key, v in self.options.items() if key != 'start'}
+        rules = self.options.get('start') if rules is None else rules
+        return finditer(self.peg, inputs, rules, urn, pos, epos, **options)
+
+    def incremental(self, urn='(unknown source)'):
+        # tpeg2 cannot tell a failure from the end of the input seen so far
+        from pegpy import vm
+        return vm.generate(self.peg, start=self.options.get('start', self.peg.start())).incremental(urn)
+
+    def __reduce__(self):
+        return (Parser, (self.peg, self.generator), {'options': self.options, 'parser': None})
 
 # ParseTree
 
@@ -1330,6 +1840,7 @@ class TPEGLoader(object):
         for name in self.names:
             t = self.names[name]
             self.peg[name] = self.conv(t, 0)
+        internGrammar(self.peg)
 
     def example(self, name, doc):
         self.peg['@@example'].append((name, doc))
@@ -1576,11 +2087,12 @@ def grammar_factory():
         paths += os.environ.get('GRAMMAR', '').split(':')
         path = findpath(paths, urn)
         key = str(path)
-        if key in GrammarDB:
-            return GrammarDB[key]
-        peg = Grammar()
-        load_grammar(peg, path, **options)
-        GrammarDB[key] = peg
+        with GrammarLock:
+            if key in GrammarDB:
+                return GrammarDB[key]
+            peg = Grammar()
+            load_grammar(peg, path, **options)
+            GrammarDB[key] = peg
         return peg
 
     return grammar
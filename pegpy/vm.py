@@ -0,0 +1,617 @@
+import codecs
+import threading
+from pegpy.tpeg2 import Ref, Char, Range, Any, Ore, Alt, Action, PTree, ParseTree, State, Limits
+from pegpy.tpeg2 import inline, unique_range, minimum_range, splitPTree
+
+# Bytecode VM
+#   rules are compiled into one flat list of (op, a, b) instructions that
+#   a single loop runs. Choices, calls and tree captures are frames on an
+#   explicit stack, so deep nesting is bounded by memory instead of the
+#   recursion limit. The code is plain tuples; a Program pickles as is.
+#
+#   The VM follows tpeg2 closely (the same trees and error positions);
+#   headpos is raised at the same backtracking points.
+#
+#   With partial=True, epos is only the end of the input seen so far: an
+#   instruction that fails (or a lookahead that succeeds) because it ran
+#   into epos makes the result None, since more input could change it.
+
+CHAR, SET, ANY, SPAN, STAR, TRIE, NOTCHAR, NOTSET, NOTANY = range(9)
+CHOICE, COMMIT, LOOP, BACK, FAILTWICE, FAIL, CALL, RET, HALT = range(9, 18)
+OPEN, NODE, EDGE, FOLD, SAVE, RESTORE = range(18, 24)
+SYMBOL, SCOPE, UNSCOPE, EXISTS, MATCH, DEF, IN, SKIP = range(24, 32)
+MEMO, MEMOEND, FORGET = range(32, 35)
+
+OPNAMES = ['CHAR', 'SET', 'ANY', 'SPAN', 'STAR', 'TRIE', 'NOTCHAR', 'NOTSET', 'NOTANY',
+           'CHOICE', 'COMMIT', 'LOOP', 'BACK', 'FAILTWICE', 'FAIL', 'CALL', 'RET', 'HALT',
+           'OPEN', 'NODE', 'EDGE', 'FOLD', 'SAVE', 'RESTORE',
+           'SYMBOL', 'SCOPE', 'UNSCOPE', 'EXISTS', 'MATCH', 'DEF', 'IN', 'SKIP',
+           'MEMO', 'MEMOEND', 'FORGET']
+
+# stack frames: (BT, addr, pos, ast), (RETURN, addr), (CAPTURE, pos, ast),
+# (SCOPED, state) and (MEMOIZED, key, ast)
+BT, RETURN, CAPTURE, SCOPED, MEMOIZED = range(5)
+FAILED = (-1, None, None, None)
+
+
+def match_trie(inputs, pos, epos, d):
+    # returns the end position, or -1 - pos where it stopped
+    while isinstance(d, dict):
+        if pos >= epos or inputs[pos] not in d:
+            return -1 - pos
+        d = d[inputs[pos]]
+        pos += 1
+    if pos >= epos:
+        return -1 - pos
+    for s in d:
+        if inputs.startswith(s, pos):
+            return pos + len(s)
+    return -1 - pos
+
+
+def getstate(state, sid):
+    while state is not None:
+        if state.sid == sid:
+            return state
+        state = state.prev
+    return None
+
+
+def starved(op, a, b, pos, epos, state):
+    # whether a failed instruction needed input beyond epos
+    if op == CHAR or op == TRIE:
+        return pos + b > epos
+    if op == MATCH:
+        s = getstate(state, a)
+        return s is not None and pos + len(s.val) > epos
+    return (op == SET or op == ANY or op == IN) and pos >= epos
+
+
+def run(code, pc, inputs, pos, epos, limits=None, partial=False):
+    steps = Limits.UNLIMITED if limits is None else -1
+    hungry = False
+    stack = []
+    ast = None
+    state = None
+    headpos = pos
+    memo = {}
+    dicts = {}
+    while True:
+        op, a, b = code[pc]
+        pc += 1
+        if op == CHAR:
+            if inputs.startswith(a, pos):
+                pos += b
+                continue
+        elif op == CALL:
+            steps -= 1
+            if steps < 0:
+                steps = limits.tick(max(pos, headpos))
+            stack.append((RETURN, pc))
+            pc = a
+            continue
+        elif op == RET:
+            pc = stack.pop()[1]
+            continue
+        elif op == CHOICE:
+            stack.append((BT, a, pos, ast))
+            continue
+        elif op == COMMIT:
+            stack.pop()
+            pc = a
+            continue
+        elif op == SET:
+            if pos < epos:
+                shift = ord(inputs[pos]) - b
+                if shift >= 0 and (a >> shift) & 1:
+                    pos += 1
+                    continue
+        elif op == LOOP:
+            frame = stack[-1]
+            if pos > frame[2]:
+                stack[-1] = (BT, frame[1], pos, ast)
+                pc = a
+            else:
+                # an iteration without progress ends the loop
+                headpos = max(pos, headpos)
+                ast = frame[3]
+                stack.pop()
+            continue
+        elif op == SPAN:
+            while pos < epos:
+                shift = ord(inputs[pos]) - b
+                if shift < 0 or not (a >> shift) & 1:
+                    break
+                pos += 1
+            headpos = max(pos, headpos)
+            hungry = hungry or (partial and pos >= epos)
+            continue
+        elif op == ANY:
+            if pos < epos:
+                pos += 1
+                continue
+        elif op == NOTCHAR:
+            if not inputs.startswith(a, pos):
+                headpos = max(pos, headpos)
+                hungry = hungry or (partial and pos + len(a) > epos)
+                continue
+        elif op == NOTSET:
+            if pos < epos:
+                shift = ord(inputs[pos]) - b
+                if shift >= 0 and (a >> shift) & 1:
+                    op = FAIL
+            if op != FAIL:
+                headpos = max(pos, headpos)
+                hungry = hungry or (partial and pos >= epos)
+                continue
+        elif op == NOTANY:
+            if pos >= epos:
+                headpos = max(pos, headpos)
+                hungry = hungry or partial
+                continue
+        elif op == OPEN:
+            stack.append((CAPTURE, pos, ast))
+            ast = None
+            continue
+        elif op == NODE:
+            frame = stack.pop()
+            ast = PTree(frame[2], a, frame[1], pos, ast)
+            continue
+        elif op == EDGE:
+            frame = stack.pop()
+            ast = PTree(frame[2], a, frame[1], -pos, ast)
+            continue
+        elif op == FOLD:
+            prev, pt = splitPTree(ast)
+            stack.append((CAPTURE, pos, prev))
+            ast = pt if a == '' else PTree(None, a, 0, -pos, pt)
+            continue
+        elif op == STAR:
+            while inputs.startswith(a, pos):
+                pos += b
+            headpos = max(pos, headpos)
+            hungry = hungry or (partial and pos + b > epos)
+            continue
+        elif op == TRIE:
+            end = match_trie(inputs, pos, epos, a)
+            if end >= 0:
+                pos = end
+                continue
+            pos = -1 - end
+        elif op == FAILTWICE:
+            stack.pop()
+        elif op == BACK:
+            frame = stack.pop()
+            headpos = max(pos, headpos)
+            pos = frame[1]
+            continue
+        elif op == MEMO:
+            # a rule may read and define symbols, so the state is part of
+            # the key and the state it leaves is restored on a hit
+            key = (b, pos, state)
+            if key in memo:
+                end, result, prev, after = memo[key]
+                if end == -1:
+                    op = FAIL
+                elif prev is ast:
+                    pos = end
+                    ast = result
+                    state = after
+                    pc += 1
+                    continue
+            if op != FAIL:
+                steps -= 1
+                if steps < 0:
+                    steps = limits.tick(max(pos, headpos))
+                stack.append((MEMOIZED, key, ast))
+                stack.append((RETURN, pc))
+                pc = a
+                continue
+        elif op == MEMOEND:
+            frame = stack.pop()
+            memo[frame[1]] = (pos, ast, frame[2], state)
+            continue
+        elif op == SAVE:
+            stack.append((CAPTURE, pos, ast))
+            continue
+        elif op == RESTORE:
+            ast = stack.pop()[2]
+            continue
+        elif op == SYMBOL:
+            frame = stack.pop()
+            state = State(a, inputs[frame[1]:pos], state)
+            continue
+        elif op == SCOPE:
+            stack.append((SCOPED, state))
+            continue
+        elif op == UNSCOPE:
+            state = stack.pop()[1]
+            continue
+        elif op == EXISTS:
+            if getstate(state, a) is not None:
+                continue
+        elif op == MATCH:
+            s = getstate(state, a)
+            if s is not None and inputs.startswith(s.val, pos):
+                pos += len(s.val)
+                continue
+        elif op == DEF:
+            frame = stack.pop()
+            s = inputs[frame[1]:pos]
+            if len(s) > 0:
+                ss = dicts.setdefault(a, {}).setdefault(s[0], [])
+                i = 0
+                while i < len(ss) and len(ss[i]) >= len(s):
+                    i += 1
+                ss.insert(i, s)
+            continue
+        elif op == IN:
+            if a in dicts and pos < epos:
+                for s in dicts[a].get(inputs[pos], ()):
+                    if inputs.startswith(s, pos):
+                        pos += len(s)
+                        break
+                else:
+                    op = FAIL
+                if op != FAIL:
+                    continue
+        elif op == SKIP:
+            pos = min(headpos, epos)
+            continue
+        elif op == FORGET:
+            # nothing before pos will be parsed again
+            memo = {key: m for key, m in memo.items() if key[1] >= pos}
+            continue
+        elif op == HALT:
+            return None if hungry else True, pos, headpos, ast
+        # fails; backtracks to the last choice
+        if partial and not hungry:
+            hungry = starved(op, a, b, pos, epos, state)
+        while len(stack) > 0:
+            frame = stack.pop()
+            kind = frame[0]
+            if kind == BT:
+                headpos = max(pos, headpos)
+                _, pc, pos, ast = frame
+                break
+            if kind == SCOPED:
+                state = frame[1]
+            elif kind == MEMOIZED:
+                memo[frame[1]] = FAILED
+        else:
+            return None if hungry else False, pos, headpos, ast
+
+
+def toParseTree(pt, urn, inputs):
+    # PTree2ParseTree without recursion
+    def subtree(pt):
+        if pt.prev is not None:
+            return ParseTree('', inputs, pt.spos, pt.epos, urn), pt
+        return ParseTree(pt.tag, inputs, pt.spos, pt.epos, urn), pt.child
+
+    root, subnode = subtree(pt)
+    stack = [(root, subnode)]
+    while len(stack) > 0:
+        t, subnode = stack.pop()
+        while subnode is not None:
+            if subnode.isEdge():
+                if subnode.child is None:
+                    tt, sub = ParseTree('', inputs, subnode.spos, abs(subnode.epos), urn), None
+                else:
+                    tt, sub = subtree(subnode.child)
+                if subnode.tag == '':
+                    t.append(tt)
+                else:
+                    setattr(t, subnode.tag, tt)
+            else:
+                tt = ParseTree(subnode.tag, inputs, subnode.spos, abs(subnode.epos), urn)
+                sub = subnode.child
+                t.append(tt)
+            stack.append((tt, sub))
+            subnode = subnode.prev
+        t.reverse()
+    return root
+
+
+class Program(object):
+    def __init__(self, code, entry):
+        self.code = code
+        self.entry = entry
+
+    def __call__(self, inputs, urn='(unknown source)', pos=0, epos=None, budget=None, deadline=None):
+        if epos is None:
+            epos = len(inputs)
+        limits = None if budget is None and deadline is None else Limits(budget, deadline)
+        ok, end, headpos, ast = run(self.code, self.entry, inputs, pos, epos, limits)
+        if not ok:
+            result = PTree(None, 'err', headpos, headpos, None)
+        else:
+            result = ast if ast is not None else PTree(None, '', pos, end, None)
+        return toParseTree(result, urn, inputs)
+
+    def incremental(self, urn='(unknown source)'):
+        return Feeder(self, urn)
+
+    def dump(self, start=0, end=None):
+        for i, (op, a, b) in enumerate(self.code[start:end], start):
+            args = ' '.join(repr(x) for x in (a, b) if x is not None)
+            print(f'{i:>6} {OPNAMES[op]:<10} {args}')
+
+
+class Feeder(object):
+    '''
+    Parses a stream of top-level items (the start rule) pushed in chunks.
+    feed() returns the items that more input can no longer change and
+    keeps the rest of the text; the text of returned items is dropped, so
+    each chunk only parses the pending item again. Items are (offset, tree)
+    pairs: trees refer to the buffer they were parsed in, and offset is
+    the position of that buffer in the stream, so a tree starts at
+    offset + tree.spos_. A syntax error is returned as an 'err' tree and
+    ends the stream.
+    '''
+
+    def __init__(self, program, urn='(unknown source)'):
+        self.program = program
+        self.urn = urn
+        self.buffer = ''
+        self.offset = 0
+        self.decoder = None
+        self.failed = False
+        self.closed = False
+
+    def feed(self, chunk):
+        if self.closed:
+            raise ValueError('feed() after close()')
+        if isinstance(chunk, bytes):
+            if self.decoder is None:
+                self.decoder = codecs.getincrementaldecoder('utf-8')()
+            chunk = self.decoder.decode(chunk)
+        self.buffer += chunk
+        return self.items(True)
+
+    def close(self):
+        # the end of the buffer is now the end of the input
+        if self.closed:
+            return []
+        if self.decoder is not None:
+            self.buffer += self.decoder.decode(b'', True)
+        self.closed = True
+        return self.items(False)
+
+    def items(self, partial):
+        items = []
+        inputs, pos = self.buffer, 0
+        while not self.failed and pos < len(inputs):
+            p = self.program
+            ok, end, headpos, ast = run(p.code, p.entry, inputs, pos, len(inputs), None, partial)
+            if ok is None:
+                break
+            if ok and end > pos:
+                result = ast if ast is not None else PTree(None, '', pos, end, None)
+                pos = end
+            else:
+                # an empty item would never move on
+                result = PTree(None, 'err', headpos, headpos, None)
+                self.failed = True
+            items.append((self.offset, toParseTree(result, self.urn, inputs)))
+        self.buffer = inputs[pos:]
+        self.offset += pos
+        return items
+
+
+# Compiler
+
+class Compiler(object):
+    def __init__(self, memo=False):
+        self.memo = memo
+        self.code = []
+        self.rules = {}
+        self.mids = {}
+        self.sids = {}
+        self.pending = []
+        self.calls = []
+        self.lock = threading.RLock()
+
+    def program(self, peg, start):
+        with self.lock:
+            entry = len(self.code)
+            try:
+                self.call(peg.newRef(start))
+                self.op(HALT)
+                while len(self.pending) > 0:
+                    ref = self.pending.pop()
+                    self.rules[ref.uname()] = len(self.code)
+                    self.emit(ref.deref())
+                    self.op(RET)
+            except NotImplementedError:
+                # drops the partial code, so other start rules still compile
+                del self.code[entry:]
+                self.rules = {u: i for u, i in self.rules.items() if i < entry}
+                self.pending, self.calls = [], []
+                raise
+            for i in self.calls:
+                op, uname, b = self.code[i]
+                self.code[i] = (op, self.rules[uname], b)
+            self.calls = []
+            return Program(self.code, entry)
+
+    def op(self, op, a=None, b=None):
+        self.code.append((op, a, b))
+        return len(self.code) - 1
+
+    def label(self, i):
+        # points the jump at i to the next instruction
+        op, _, b = self.code[i]
+        self.code[i] = (op, len(self.code), b)
+
+    def getsid(self, name):
+        if not name in self.sids:
+            self.sids[name] = len(self.sids)
+        return self.sids[name]
+
+    def emit(self, pe):
+        pe = inline(pe)
+        if isinstance(pe, Action):
+            cname = pe.func.capitalize()
+        else:
+            cname = pe.__class__.__name__
+        if hasattr(self, cname):
+            getattr(self, cname)(pe)
+        else:
+            raise NotImplementedError(f'vm does not support {cname}: {pe}')
+
+    def Any(self, pe):
+        self.op(ANY)
+
+    def Char(self, pe):
+        if len(pe.text) > 0:
+            self.op(CHAR, pe.text, len(pe.text))
+
+    def Range(self, pe, op=SET):
+        offset = minimum_range(pe.chars, pe.ranges)
+        self.op(op, unique_range(pe.chars, pe.ranges) >> offset, offset)
+
+    def And(self, pe):
+        self.op(SAVE)
+        self.emit(pe.e)
+        self.op(BACK)
+
+    def Not(self, pe):
+        e = inline(pe.e)
+        if isinstance(e, Char) and len(e.text) > 0:
+            self.op(NOTCHAR, e.text)
+        elif isinstance(e, Range):
+            self.Range(e, NOTSET)
+        elif isinstance(e, Any):
+            self.op(NOTANY)
+        else:
+            choice = self.op(CHOICE)
+            self.emit(pe.e)
+            self.op(FAILTWICE)
+            self.label(choice)
+
+    def Many(self, pe):
+        e = inline(pe.e)
+        if isinstance(e, Char) and len(e.text) > 0:
+            self.op(STAR, e.text, len(e.text))
+        elif isinstance(e, Range):
+            self.Range(e, SPAN)
+        else:
+            choice = self.op(CHOICE)
+            self.emit(pe.e)
+            self.op(LOOP, choice + 1)
+            self.label(choice)
+
+    def Many1(self, pe):
+        self.emit(pe.e)
+        self.Many(pe)
+
+    def Option(self, pe):
+        choice = self.op(CHOICE)
+        self.emit(pe.e)
+        commit = self.op(COMMIT)
+        self.label(choice)
+        self.label(commit)
+
+    def Seq(self, pe):
+        for e in pe:
+            self.emit(e)
+
+    def Ore(self, pe):
+        if pe.isDict():
+            self.op(TRIE, pe.trieDict(), max(len(s) for s in pe.listDict()))
+            return
+        # the last choice also backtracks, so that headpos is raised as in tpeg2
+        commits = []
+        for e in pe:
+            choice = self.op(CHOICE)
+            self.emit(e)
+            commits.append(self.op(COMMIT))
+            self.label(choice)
+        self.op(FAIL)
+        for commit in commits:
+            self.label(commit)
+
+    def Alt(self, pe):
+        self.Ore(pe)
+
+    def Ref(self, pe):
+        self.call(pe)
+
+    def call(self, ref):
+        uname = ref.uname()
+        if uname not in self.rules and all(r.uname() != uname for r in self.pending):
+            self.pending.append(ref)
+        if self.memo:
+            mid = self.mids.setdefault(uname, len(self.mids))
+            self.calls.append(self.op(MEMO, uname, mid))
+            self.op(MEMOEND)
+        else:
+            self.calls.append(self.op(CALL, uname))
+
+    # Tree Construction
+
+    def Node(self, pe):
+        self.op(OPEN)
+        self.emit(pe.e)
+        self.op(NODE, pe.tag)
+
+    def Edge(self, pe):
+        self.op(OPEN)
+        self.emit(pe.e)
+        self.op(EDGE, pe.edge)
+
+    def Fold(self, pe):
+        self.op(FOLD, pe.edge)
+        self.emit(pe.e)
+        self.op(NODE, pe.tag)
+
+    def Abs(self, pe):
+        self.op(SAVE)
+        self.emit(pe.e)
+        self.op(RESTORE)
+
+    # Actions
+
+    def Lazy(self, pe):  # @lazy(A)
+        self.emit(pe.e)
+
+    def Skip(self, pe):  # @skip()
+        self.op(SKIP)
+
+    def Commit(self, pe):  # @commit()
+        self.op(FORGET)
+
+    def Symbol(self, pe):  # @symbol(A)
+        self.op(SAVE)
+        self.emit(pe.e)
+        self.op(SYMBOL, self.getsid(str(pe.params[0])))
+
+    def Scope(self, pe):  # @scope(e)
+        self.op(SCOPE)
+        self.emit(pe.e)
+        self.op(UNSCOPE)
+
+    def Exists(self, pe):  # @exists(A)
+        self.op(EXISTS, self.getsid(str(pe.params[0])))
+
+    def Match(self, pe):  # @match(A)
+        self.op(MATCH, self.getsid(str(pe.params[0])))
+
+    def Def(self, pe):  # @def(NAME)
+        self.op(SAVE)
+        self.emit(pe.e)
+        self.op(DEF, str(pe.params[0]))
+
+    def In(self, pe):  # @in(NAME)
+        self.op(IN, str(pe.params[0]))
+
+
+def generate(peg, **options):
+    # one program per grammar; each start symbol adds an entry point
+    memo = bool(options.get('memo', False))
+    key = ('vm', memo)
+    with peg.lock:
+        if key not in peg.compiled:
+            peg.compiled[key] = Compiler(memo)
+    return peg.compiled[key].program(peg, options.get('start', peg.start()))
@@ -1,5 +1,5 @@
 import unittest
-from pegpy.tpeg import STDLOG
+from pegpy.tpeg0 import STDLOG
 
 def exTest(self, grammar, combinator):
 
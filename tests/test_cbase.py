@@ -0,0 +1,63 @@
+import unittest
+import pegpy
+from pegpy.nez.cbase import cgenerate, call_p, Commit, ParserContext
+
+
+def examples(file):
+  peg = pegpy.grammar(file)
+  for name, doc in peg['@@example']:
+    if name in peg:
+      yield peg, name, doc.inputs_[doc.spos_:doc.epos_]
+
+
+class TestCBase(unittest.TestCase):
+
+  def test_same_trees(self):
+    for file in ['math.tpeg', 'json.tpeg', 'chibi.tpeg', 'symbol.tpeg']:
+      for peg, name, s in examples(file):
+        with self.subTest(file=file, name=name):
+          t = pegpy.generate(peg, start=name)(s)
+          t2 = cgenerate(peg, start=name)(s)
+          self.assertEqual(repr(t2), repr(t))
+
+  def test_memo(self):
+    peg = pegpy.grammar('math.tpeg')
+    s = '((((1+2)*3)+4)*5)'
+    t = cgenerate(peg, memo=False)(s)
+    self.assertEqual(repr(cgenerate(peg)(s)), repr(t))
+
+  def test_shared(self):
+    peg = pegpy.grammar('math.tpeg')
+    cgenerate(peg)
+    compiled = peg.compiled[('cbase', True)]
+    n = len(compiled['generated'])
+    t = cgenerate(peg, start='Int')('12')
+    self.assertEqual(repr(t), "[#Int '12']")
+    self.assertEqual(len(compiled['generated']), n)
+    pegpy.generate(peg)
+    n = len(peg.compiled)
+    pegpy.generate(peg, start='Int')
+    self.assertEqual(len(peg.compiled), n)
+
+  def test_commit(self):
+    peg = pegpy.grammar("File = { (Stmt @commit())* #File }\nStmt = { [a-z]+ ';' #Stmt } / { [a-z]+ '.' #End }\n")
+    s = 'abc;de.f;'
+    self.assertEqual(repr(cgenerate(peg)(s)), repr(pegpy.generate(peg)(s)))
+    px = ParserContext(s, 4, len(s), 2)
+    px.memos[0].update({0: None, 4: None, 7: None})
+    px.memos[1].update({3: None})
+    self.assertTrue(call_p(Commit(), px))
+    self.assertEqual([list(table) for table in px.memos], [[4, 7], []])
+
+  def test_error(self):
+    peg = pegpy.grammar('json.tpeg')
+    t = cgenerate(peg)('{"a": ]')
+    self.assertTrue(t.isSyntaxError())
+
+  def test_unsupported(self):
+    peg = pegpy.grammar("A = @unknown('a')\n")
+    with self.assertRaisesRegex(NotImplementedError, 'Unknown'):
+      cgenerate(peg)
+
+if __name__ == '__main__':
+  unittest.main()
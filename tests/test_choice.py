@@ -0,0 +1,49 @@
+import unittest
+from pegpy.tpeg import grammar, generate
+
+GRAMMAR = '\n'.join([
+  "Op = '<' / '<<' / '<=' / '=' / '==' / '>' / '>>' / '>=' / '!' / '!='",
+  "Stmt = 'if' S Name / 'in' S Name / 'int' S Name / 'for' S Name / Name S '=' S Name",
+  "Name = !KEYWORD [a-z] W*",
+  "KEYWORD = \"in\" / \"if\" / \"int\" / \"instanceof\"",
+  "\"in\" = 'in' !W",
+  "\"if\" = 'if' !W",
+  "\"int\" = 'int' !W S?",
+  "\"instanceof\" = 'instanceof' !W",
+  "W = [a-z0-9] / '\\\\u'",
+  "S = ' '",
+])
+
+
+class TestChoice(unittest.TestCase):
+
+  def parse(self, start, s):
+    t = generate(grammar(GRAMMAR), start=start)(s)
+    return t.tag, t.spos, t.epos
+
+  def test_first_match(self):
+    # the first literal in order wins, not the longest
+    self.assertEqual(self.parse('Op', '<<'), ('', 0, 1))
+    self.assertEqual(self.parse('Op', '=='), ('', 0, 1))
+    self.assertEqual(self.parse('Op', '!=')[2], 1)
+    self.assertEqual(self.parse('Op', '+')[0], 'err')
+
+  def test_keywords(self):
+    for s, end in [('index', 5), ('in', -1), ('int', -1), ('instance', 8), ('instanceof', -1),
+                   ('in\\u0041', 8), ('i', 1), ('x1', 2)]:
+      with self.subTest(s=s):
+        tag, spos, epos = self.parse('Name', s)
+        self.assertEqual(epos if tag != 'err' else -1, end)
+
+  def test_dispatch(self):
+    self.assertEqual(self.parse('Stmt', 'if x')[2], 4)
+    self.assertEqual(self.parse('Stmt', 'int x')[2], 5)
+    self.assertEqual(self.parse('Stmt', 'index = y')[2], 9)
+    self.assertEqual(self.parse('Stmt', 'for = y')[2], 7)
+    # error positions are those of trying every alternative
+    self.assertEqual(self.parse('Stmt', 'int int'), ('err', 7, 7))
+    self.assertEqual(self.parse('Stmt', 'if = y'), ('err', 3, 3))
+
+
+if __name__ == '__main__':
+  unittest.main()
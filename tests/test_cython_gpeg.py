@@ -1,7 +1,7 @@
 import unittest
 import tests
-from pegpy.gparser.cython_gpeg import cgpeg
-from pegpy.tpeg import grammar
+from pegpy.gparser.cython_gpeg import cgpeg, Amb
+from pegpy.tpeg0 import grammar
 from pathlib import Path
 
 class TestCythonGPEG(unittest.TestCase):
@@ -10,5 +10,36 @@ class TestCythonGPEG(unittest.TestCase):
     test_grammar = grammar('gpeg_grammar_test.gpeg')
     self.exTest(test_grammar, cgpeg)
 
+  def test_ops(self):
+    self.exTest(grammar('sample.gpeg'), cgpeg)
+    self.exTest(grammar('manybsep.gpeg'), cgpeg)
+    parser = cgpeg(grammar('nl.gpeg'))
+    t = parser('themansawthedogwiththetelescope')
+    # two readings of the whole sentence; one more ends after 'the dog'
+    self.assertEqual(t.count(), 2)
+    self.assertEqual(len(list(t.trees())), 2)
+    self.assertEqual(t.count(15), 1)
+    parser = cgpeg(grammar('math.tpeg'))
+    t = str(parser('1+2*3'))
+    self.assertTrue('left=[#Value [#Int 2]]op=[# *]right=' in t)
+
+  def test_sppf(self):
+    parser = cgpeg(grammar('manyb.gpeg'))
+    t = parser('bbb').child
+    while t.inner.epos != 3:
+      t = t.prev
+    self.assertTrue(isinstance(t.inner.child.inner.child, Amb))
+    sizes = [parser('b' * n).size() for n in (10, 20, 40)]
+    # a shared forest grows polynomially (cubic for manyb)
+    self.assertTrue(sizes[2] < sizes[1] * 10)
+
+  def test_count(self):
+    parser = cgpeg(grammar('manyb.gpeg'))
+    t = parser('bbbb')
+    trees = [str(x) for x in t.trees()]
+    self.assertEqual(t.count(), len(trees))
+    self.assertEqual(len(set(trees)), len(trees))
+    self.assertTrue(parser('b' * 60).count() > 10 ** 20)
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,48 @@
+import io
+import unittest
+import tempfile
+from pathlib import Path
+from contextlib import redirect_stdout
+from pegpy.tpeg import grammar, lint
+from pegpy.main import main
+
+GRAMMAR = '\n'.join([
+  "A = 'while' B / 'whilst' B / 'when' C",
+  "B = (S? [0-9]?)*",
+  "C = Word ';' / Word ','",
+  "Word = [a-z] [a-z]* [0-9]*",
+  "D = [a-z] / 'x' / 'y'",
+  "E = (!'\\n' .)*",
+  "S = ' '",
+])
+
+
+class TestLint(unittest.TestCase):
+
+  def test_findings(self):
+    findings = lint(grammar(GRAMMAR))
+    msgs = {(name, msg) for _, name, msg in findings}
+    self.assertIn(('A', "3 choices share the prefix 'wh'; factor it out"), msgs)
+    self.assertIn(('B', "(S? [0-9]?)* repeats an expression that can consume nothing"), msgs)
+    self.assertIn(('C', 'Word is tried by 2 choices at the same position; memoize or factor it'), msgs)
+    self.assertIn(('D', "'x' is shadowed by the earlier choice [a-z]"), msgs)
+    self.assertIn(('E', "(!'\\n' .)* tests one character per iteration; use a character class"), msgs)
+    self.assertEqual([f[0] for f in findings], sorted([f[0] for f in findings], reverse=True))
+
+  def test_clean(self):
+    self.assertEqual(lint(grammar('json.tpeg')), [])
+
+  def test_command(self):
+    with tempfile.TemporaryDirectory() as d:
+      path = Path(d) / 'bad.tpeg'
+      path.write_text("A = 'a' (\n")
+      out = io.StringIO()
+      with redirect_stdout(out), self.assertRaises(SystemExit) as e:
+        main(['pegpy', 'lint', '-g', str(path)])
+      self.assertEqual(e.exception.code, 1)
+      self.assertNotIn('findings', out.getvalue())
+    with redirect_stdout(io.StringIO()):
+      main(['pegpy', 'lint', '-g', 'json.tpeg'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+import re
+import pegpy
+import tempfile
+import importlib.util
+from pathlib import Path
+from pegpy.nezcc import nezcc, optimizeRules
+from pegpy.tpeg2 import Unary, Tuple
+
+
+def load(file, start):
+  peg = pegpy.grammar(file)
+  with tempfile.TemporaryDirectory() as d:
+    path = str(Path(d) / 'parser.py')
+    nezcc('parser.py', peg, start=start, output=path)
+    spec = importlib.util.spec_from_file_location('parser', path)
+    m = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(m)
+  return peg, m
+
+
+def kinds(pe):
+  ks = {pe.__class__.__name__}
+  if isinstance(pe, (Unary, Tuple)):
+    for e in pe:
+      ks |= kinds(e)
+  return ks
+
+
+class TestNezCC(unittest.TestCase):
+
+  def test_python(self):
+    for file in ['math.tpeg', 'json.tpeg', 'chibi.tpeg', 'puppy.tpeg']:
+      peg = pegpy.grammar(file)
+      for name in {name for name, _ in peg['@@example'] if name in peg}:
+        _, m = load(file, name)
+        for name2, doc in peg['@@example']:
+          if name2 == name:
+            with self.subTest(file=file, name=name):
+              s = doc.inputs_[doc.spos_:doc.epos_]
+              t = pegpy.generate(peg, start=name)(s)
+              self.assertEqual(repr(m.generate(name)(s)), repr(t))
+
+  def test_optimize(self):
+    peg = pegpy.grammar('json.tpeg')
+    g, ns, es, memo = optimizeRules(peg, 'File', {})
+    self.assertIsNot(g, peg)
+    self.assertNotIn('S', ns)
+    self.assertIn('File', memo.memos)
+    for kind in ['Complement', 'Trie']:
+      self.assertIn(kind, set().union(*[kinds(pe) for pe in es.values()]))
+    _, ns2, _, memo = optimizeRules(peg, 'File', {'optimize': '0'})
+    self.assertIsNone(memo)
+    self.assertIn('S', ns2)
+
+  def generate(self, template, file):
+    peg = pegpy.grammar(file)
+    with tempfile.TemporaryDirectory() as d:
+      path = str(Path(d) / template)
+      nezcc(template, peg, output=path)
+      code = Path(path).read_text()
+    _, ns, _, _ = optimizeRules(peg, peg.start(), {})
+    runtime = (Path(pegpy.__file__).parent / 'nezcc' / template).read_text()
+    return ns, code, runtime
+
+  def test_typescript(self):
+    ns, code, runtime = self.generate('parser.ts', 'json.tpeg')
+    # every rule left after inlining is emitted
+    self.assertEqual(len(code.split('\n    peg[')), len(ns) + 1)
+    for name in ns:
+      self.assertIn(f'peg["{name}"] = ', code)
+    for name in ['pMemo', 'pDict', 'pComplement']:
+      self.assertIn(f'{name}(', code)
+    # every combinator the rules call is in the runtime
+    for name in set(re.findall(r'\b(p[A-Z]\w*)\(', code)):
+      self.assertIn(f'const {name} = ', runtime)
+    self.assertIn('example("Value", ', code)
+
+  def test_java(self):
+    ns, code, runtime = self.generate('parser.java', 'json.tpeg')
+    self.assertIn('peg.put("File", pMemo(', code)
+    self.assertIn('new String[] {"09"}', code)
+    for name in set(re.findall(r'\b(p[A-Z]\w*)\(', code)):
+      self.assertIn(f' ParseFunc {name}(', runtime)
+
+  def test_error(self):
+    _, m = load('json.tpeg', None)
+    self.assertTrue(m.parse('{"a": ]').isSyntaxError())
+
+  def test_unsupported(self):
+    peg = pegpy.grammar("A = @unknown('a')\n")
+    with self.assertRaisesRegex(NotImplementedError, 'unknown'):
+      nezcc('parser.py', peg, output='/dev/null')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import pegpy
+from pegpy.optimizer import PassManager, optimize, Negate, MakeTrie
+from pegpy.main import parse_options, load_grammar
+
+
+class TestOptimizer(unittest.TestCase):
+
+  def test_same_trees(self):
+    for file in ['math.tpeg', 'json.tpeg', 'chibi.tpeg', 'puppy.tpeg']:
+      peg = pegpy.grammar(file)
+      peg2 = optimize(peg)
+      for name, doc in peg['@@example']:
+        if name in peg:
+          with self.subTest(file=file, name=name):
+            s = doc.inputs_[doc.spos_:doc.epos_]
+            t = pegpy.generate(peg, start=name)(s)
+            t2 = pegpy.generate(peg2, start=name)(s)
+            self.assertEqual(repr(t2), repr(t))
+
+  def test_stats(self):
+    peg = pegpy.grammar('json.tpeg')
+    pm = PassManager()
+    peg2 = pm.run(peg)
+    stats = {name: rewrites for name, rewrites, *_ in pm.stats}
+    self.assertEqual(list(stats), ['inline', 'flatten', 'merge', 'factor', 'unreachable'])
+    self.assertGreater(stats['inline'], 0)
+    self.assertLess(len(peg2.N), len(peg.N))
+    self.assertNotEqual(peg2.gid, peg.gid)
+
+  def test_factor(self):
+    peg = pegpy.grammar("A = 'ab' B / 'ac' B / 'a'\nB = [0-9]+ / A\n")
+    peg2 = optimize(peg)
+    self.assertEqual(repr(peg2['A']), "'a' ('b' B / 'c' B)?")
+    for s in ['ab1', 'ac2', 'a', 'abab3', 'x']:
+      with self.subTest(s=s):
+        self.assertEqual(repr(pegpy.generate(peg2)(s)), repr(pegpy.generate(peg)(s)))
+
+  def test_lazy(self):
+    # @lazy keeps its rule name, so the optimized grammar still generates
+    peg = pegpy.grammar("A = 'a' @lazy(B) 'x'\nB = 'b' 'c'\n")
+    peg2 = optimize(peg)
+    self.assertEqual(peg2['A'].es[1].e.__class__.__name__, 'Ref')
+    self.assertEqual(repr(pegpy.generate(peg2)('abcx')), repr(pegpy.generate(peg)('abcx')))
+    pegpy.generate(optimize(pegpy.grammar('origami.tpeg')))
+
+  def test_codegen_passes(self):
+    peg = pegpy.grammar("A = '\"' (!'\"' .)* '\"' / B\nB = 'if' / 'in' / 'for'\n")
+    pm = PassManager([Negate(), MakeTrie()])
+    peg2 = pm.run(peg)
+    self.assertEqual([rewrites for _, rewrites, *_ in pm.stats], [1, 1])
+    self.assertEqual(peg2['A'].es[0].es[1].e.__class__.__name__, 'Complement')
+    self.assertEqual(peg2['B'].__class__.__name__, 'Trie')
+
+  def test_command(self):
+    options = parse_options(['-g', 'json.tpeg', '-O', '1'])
+    peg = load_grammar(options)
+    self.assertLess(len(peg.N), len(pegpy.grammar('json.tpeg').N))
+    peg = load_grammar(parse_options(['-g', 'json.tpeg', '-O', '0']))
+    self.assertEqual(len(peg.N), len(pegpy.grammar('json.tpeg').N))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import tempfile
+from pathlib import Path
+import pegpy
+from pegpy.parallel import parse_parallel, parse_files, parseChunk, flatten, unflatten
+
+ITEMS = "Item = { 'begin' (!'end' .)* 'end' #Item } [ \\n]*\n"
+
+
+class TestParallel(unittest.TestCase):
+
+  def parse(self, text, **options):
+    with tempfile.TemporaryDirectory() as d:
+      path = Path(d) / 'items.txt'
+      path.write_text(text)
+      return parse_parallel(str(path), ITEMS, 'Item', **options)
+
+  def test_items(self):
+    text = ''.join(f'begin\n{i}\u3042\nend\n' for i in range(100))
+    t = self.parse(text, jobs=2)
+    t2 = parseChunk(ITEMS, 'Item', text)
+    self.assertEqual(len(t), 100)
+    self.assertEqual(repr(t[-1]), "[#Item 'begin\\n99\u3042\\nend']")
+    self.assertEqual([(c.spos_, c.epos_) for c in t], [(c.spos_, c.epos_) for c in t2])
+    self.assertEqual(str(t[42]), text[t[42].spos_:t[42].epos_])
+
+  def test_cut_inside_item(self):
+    # a cut after the first line of a paragraph leaves two pieces that
+    # both parse as paragraphs
+    paras = "Para = { (!'\\n\\n' .)+ #Para } '\\n'*\n"
+    text = ''.join(f'line{i}\nmore{i}\n\n' for i in range(50))
+    with tempfile.TemporaryDirectory() as d:
+      path = Path(d) / 'paras.txt'
+      path.write_text(text)
+      t = parse_parallel(str(path), paras, 'Para', jobs=2)
+    self.assertEqual(len(t), 50)
+    t2 = parseChunk(paras, 'Para', text)
+    self.assertEqual([(c.spos_, c.epos_) for c in t], [(c.spos_, c.epos_) for c in t2])
+
+  def test_error(self):
+    text = ''.join(f'begin\n{i}\nend\n' for i in range(20)) + 'begin\n'
+    t = self.parse(text, jobs=2)
+    self.assertTrue(t.isSyntaxError())
+    # an early error is reported at once, not after merging every chunk
+    text = 'begin\n0\nend\nbogus\n' + ''.join(f'begin\n{i}\nend\n' for i in range(200))
+    t = self.parse(text, jobs=2)
+    self.assertEqual((t.tag_, t.spos_), ('err', text.index('bogus')))
+
+  def test_spans(self):
+    peg = pegpy.grammar('json.tpeg')
+    for name, doc in peg['@@example']:
+      t = pegpy.generate(peg, start=name)(doc.inputs_, doc.urn_, doc.spos_, doc.epos_)
+      t2 = unflatten(flatten(t), doc.inputs_, 0, doc.urn_)
+      self.assertEqual(repr(t2), repr(t))
+
+  def test_files(self):
+    with tempfile.TemporaryDirectory() as d:
+      paths = []
+      for i, s in enumerate(['[1, 2]', '{"a": "\u3042\u3044"}', '{"a": ]']):
+        paths.append(Path(d) / f'{i}.json')
+        paths[-1].write_text(s)
+      ts = parse_files(paths, 'json.tpeg', jobs=2)
+      peg = pegpy.grammar('json.tpeg')
+      for path, t in zip(paths, ts):
+        self.assertEqual(repr(t), repr(pegpy.generate(peg)(path.read_text(), str(path))))
+      self.assertTrue(ts[2].isSyntaxError())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+import pickle
+import pegpy
+from concurrent.futures import ThreadPoolExecutor
+from pegpy.optimizer import copyGrammar
+from pegpy.tpeg2 import dumpGrammar, loadGrammar, ParseTimeout, firstSet, Generator, match_empty
+from pegpy.tpeg2 import generator, finditer, charClass, EMPTYSET
+from pegpy.main import parse_options
+
+
+def examples(file):
+  peg = pegpy.grammar(file)
+  for name, doc in peg['@@example']:
+    if name in peg:
+      yield peg, name, doc.inputs_[doc.spos_:doc.epos_]
+
+
+class TestTPEG2(unittest.TestCase):
+
+  def test_lazy(self):
+    for file in ['math.tpeg', 'json.tpeg', 'js.tpeg']:
+      for peg, name, s in examples(file):
+        with self.subTest(file=file, name=name):
+          t = pegpy.generate(peg, start=name)(s)
+          t2 = pegpy.generate(peg, start=name, lazy=True)(s)
+          self.assertEqual(repr(t2), repr(t))
+
+  def test_lazy_rules(self):
+    peg = pegpy.grammar('js.tpeg')
+    pegpy.generate(peg)
+    pegpy.generate(peg, lazy=True)('1')
+    eager = peg.compiled[('tpeg2', 'None', False)].generated
+    lazy = peg.compiled[('tpeg2', 'None', True)].generated
+    compiled = [f for f in lazy.values() if f.__name__ != 'compile_rule']
+    self.assertLess(len(compiled), len(eager))
+
+  def test_threads(self):
+    # a fresh copy, so all threads compile the rules at the same time
+    peg = copyGrammar(pegpy.grammar('js.tpeg'))
+    cases = [(name, s) for _, name, s in examples('js.tpeg')]
+    expected = [repr(pegpy.generate(pegpy.grammar('js.tpeg'), start=name)(s)) for name, s in cases]
+
+    def work(lazy):
+      return [repr(pegpy.generate(peg, start=name, lazy=lazy)(s)) for name, s in cases]
+    with ThreadPoolExecutor(8) as pool:
+      for ts in pool.map(work, [True, False] * 4):
+        self.assertEqual(ts, expected)
+
+  def test_pickle(self):
+    for file in ['math.tpeg', 'json.tpeg', 'js.tpeg']:
+      peg = pegpy.grammar(file)
+      peg2 = pickle.loads(pickle.dumps(peg))
+      self.assertEqual(repr(peg2), repr(peg))
+      self.assertEqual([name for name, _ in peg2['@@example']], [name for name, _ in peg['@@example']])
+      for _, name, s in examples(file):
+        with self.subTest(file=file, name=name):
+          parser = pickle.loads(pickle.dumps(pegpy.Parser(peg, start=name, lazy=True)))
+          self.assertEqual(repr(parser(s)), repr(pegpy.generate(peg, start=name)(s)))
+
+  def test_pickle_version(self):
+    version, rules, examples = dumpGrammar(pegpy.grammar('math.tpeg'))
+    with self.assertRaises(ValueError):
+      loadGrammar(version + 1, rules, examples)
+
+  def test_budget(self):
+    parser = pegpy.generate(pegpy.grammar('json.tpeg'))
+    s = '[' + ', '.join(['1'] * 100) + ']'
+    self.assertEqual(repr(parser(s, budget=10000)), repr(parser(s)))
+    with self.assertRaises(ParseTimeout) as cm:
+      parser(s, budget=50)
+    self.assertEqual(cm.exception.reason, 'budget')
+    self.assertGreater(cm.exception.headpos, 0)
+
+  def test_deadline(self):
+    # exponential backtracking without memoization
+    peg = pegpy.grammar("A = 'a' A 'b' / 'a' A 'c' / 'a'")
+    with self.assertRaises(ParseTimeout) as cm:
+      pegpy.generate(peg)('a' * 40, deadline=0.05)
+    self.assertEqual(cm.exception.reason, 'deadline')
+
+  def test_watchdog(self):
+    peg = pegpy.grammar("A = 'a' A 'b' / 'a' A 'c' / 'a'")
+    logs = []
+    parser = pegpy.generate(peg, watchdog=16, logger=lambda type, pos, msg: logs.append((pos.spos_, msg)))
+    self.assertEqual(repr(parser('a' * 12 + 'c')), repr(pegpy.generate(peg)('a' * 12 + 'c')))
+    self.assertIn((12, 'A is evaluated 16 times at the same position'), logs)
+    self.assertTrue(any(msg.startswith('A backtracked over') for _, msg in logs))
+    logs.clear()
+    pegpy.generate(pegpy.grammar('json.tpeg'), watchdog=16, logger=lambda *x: logs.append(x))('[1, {"a": 2}]')
+    self.assertEqual(logs, [])
+    # --watchdog 0 turns the watchdog off
+    options = parse_options(['--watchdog', '0'])
+    self.assertIs(generator(peg, **options), generator(peg))
+    self.assertIsNot(generator(peg, watchdog='16'), generator(peg))
+    # the threshold is used as given; 1 reports the first evaluation
+    logs.clear()
+    pegpy.generate(peg, watchdog='1', logger=lambda type, pos, msg: logs.append(msg))('a')
+    self.assertIn('A is evaluated 1 times at the same position', logs)
+
+  def test_finditer(self):
+    parser = pegpy.Parser(pegpy.grammar('json.tpeg'))
+    s = 'x = {"a": [1, 2]}; y = 3.5; z = []'
+    ts = list(parser.finditer(s, 'Object'))
+    self.assertEqual([(t.tag_, t.spos_) for t in ts], [('Object', 4)])
+    ts = list(parser.finditer(s, ['Object', 'Array', 'Number']))
+    self.assertEqual([(t.tag_, str(t)) for t in ts], [('Object', '{"a": [1, 2]}'), ('Float', '3.5'), ('List', '[]')])
+    peg = pegpy.grammar("W = [a-z]+ / 'A'")
+    self.assertEqual([str(t) for t in pegpy.Parser(peg).finditer('Ab, cd!')], ['A', 'b', 'cd'])
+    # an empty first set means no prefilter, not the pattern '[]'
+    self.assertIsNone(charClass(EMPTYSET))
+    self.assertEqual(list(finditer(peg, 'Ab', [])), [])
+
+  def test_first_sets(self):
+    peg = pegpy.grammar('js.tpeg')
+    cs, nullable = firstSet(peg.newRef('W'), {})
+    self.assertIn('_', cs.chars)
+    self.assertFalse(nullable)
+    self.assertEqual(firstSet(peg.newRef('__'), {})[1], True)
+    self.assertEqual(pegpy.grammar("A = 'ab'? 'c'")['A'].minLen(), 1)
+    # skipped alternatives must not move the error position
+    t = pegpy.generate(peg, start='FunctionDeclaration')('functionfunc(){}')
+    self.assertEqual((t.tag_, t.spos_), ('err', 0))
+
+  def test_intern(self):
+    peg = pegpy.grammar("A = [a-z]+ 'x' / 'y'\nB = [a-z]+ 'x' / 'z'")
+    self.assertIs(peg['A'].es[0], peg['B'].es[0])
+    peg2 = pickle.loads(pickle.dumps(peg))
+    self.assertIs(peg2['A'].es[0], peg2['B'].es[0])
+    self.assertEqual(repr(pegpy.generate(peg, start='B')('abx')), repr(pegpy.generate(peg2, start='B')('abx')))
+
+  def test_commit(self):
+    # tpeg2 has no memo to drop; @commit only has to parse
+    self.assertIs(Generator().Commit(None, 0), match_empty)
+    peg = pegpy.grammar("File = { (Stmt @commit())* #File }\nStmt = { [a-z]+ ';' #Stmt }\n")
+    t = pegpy.generate(peg)('ab;cd;')
+    self.assertEqual(repr(t), "[#File\n  [#Stmt 'ab;']\n  [#Stmt 'cd;']]")
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+import pickle
+import pegpy
+from pegpy import vm
+from pegpy.tpeg2 import ParseTimeout
+
+
+def examples(file):
+  peg = pegpy.grammar(file)
+  for name, doc in peg['@@example']:
+    if name in peg:
+      yield peg, name, doc.inputs_[doc.spos_:doc.epos_]
+
+
+class TestVM(unittest.TestCase):
+
+  def test_examples(self):
+    for file in ['math.tpeg', 'json.tpeg', 'js.tpeg', 'puppy.tpeg']:
+      for peg, name, s in examples(file):
+        for memo in [False, True]:
+          with self.subTest(file=file, name=name, memo=memo):
+            t = pegpy.generate(peg, start=name)(s)
+            t2 = vm.generate(peg, start=name, memo=memo)(s)
+            self.assertEqual(repr(t2), repr(t))
+
+  def test_errors(self):
+    peg = pegpy.grammar('json.tpeg')
+    for s in ['[1, 2', '{"a": }', '[1, 2]]', 'nul']:
+      with self.subTest(s=s):
+        t = pegpy.generate(peg)(s)
+        t2 = vm.generate(peg)(s)
+        self.assertEqual((t2.tag_, t2.spos_), (t.tag_, t.spos_))
+
+  def test_nested(self):
+    peg = pegpy.grammar('json.tpeg')
+    t = vm.generate(peg)('[' * 10000 + ']' * 10000)
+    depth = 0
+    while len(t) > 0:
+      t = t[0]
+      depth += 1
+    self.assertEqual(depth, 9999)
+
+  def test_pickle(self):
+    peg = pegpy.grammar('math.tpeg')
+    parser = pickle.loads(pickle.dumps(vm.generate(peg)))
+    self.assertEqual(repr(parser('1+2*3')), repr(pegpy.generate(peg)('1+2*3')))
+
+  def test_limits(self):
+    parser = vm.generate(pegpy.grammar('json.tpeg'))
+    s = '[' + ', '.join(['1'] * 100) + ']'
+    self.assertEqual(repr(parser(s, budget=10000)), repr(parser(s)))
+    with self.assertRaises(ParseTimeout) as cm:
+      parser(s, budget=50)
+    self.assertEqual(cm.exception.reason, 'budget')
+    peg = pegpy.grammar("A = 'a' A 'b' / 'a' A 'c' / 'a'")
+    with self.assertRaises(ParseTimeout) as cm:
+      vm.generate(peg)('a' * 40, deadline=0.05)
+    self.assertEqual(cm.exception.reason, 'deadline')
+
+  def test_memo_state(self):
+    # M is called at the same position with and without the symbol D
+    peg = pegpy.grammar("File = @scope(@symbol(D) M '!') / D M\nM = { @match(D) #Same } / { . #Other }\nD = [0-9]\n")
+    for s in ['11', '11!', '12']:
+      with self.subTest(s=s):
+        self.assertEqual(repr(vm.generate(peg, memo=True)(s)), repr(pegpy.generate(peg)(s)))
+
+  def test_unsupported(self):
+    peg = pegpy.grammar("A = @unknown('a')\nB = 'b'\n")
+    with self.assertRaisesRegex(NotImplementedError, 'Unknown'):
+      vm.generate(peg)
+    self.assertEqual(repr(vm.generate(peg, start='B')('b')), repr(pegpy.generate(peg, start='B')('b')))
+
+  def test_incremental(self):
+    peg = pegpy.grammar("Item = ({ [0-9]+ #Num } / { '[' (!']' .)* ']' #List }) ' '*")
+    s = '12 [a b] 345 [] 6'
+    whole = pegpy.Parser(peg).incremental()
+    expected = [(offset + t.spos_, repr(t)) for offset, t in whole.feed(s) + whole.close()]
+    self.assertEqual(len(expected), 5)
+    feeder = pegpy.Parser(peg).incremental()
+    items = []
+    for c in s:
+      items.extend(feeder.feed(c.encode('utf-8')))
+      self.assertLessEqual(len(feeder.buffer), 6)
+    self.assertEqual(len(items), 4)
+    items.extend(feeder.close())
+    self.assertEqual([(offset + t.spos_, repr(t)) for offset, t in items], expected)
+    # positions in the stream, not in the buffer an item was parsed in
+    self.assertEqual([pos for pos, _ in expected], [0, 3, 9, 13, 16])
+    feeder = pegpy.Parser(peg).incremental()
+    (offset, t), = feeder.feed('1 [a')
+    self.assertEqual((offset, repr(t)), (0, "[#Num '1']"))
+    self.assertEqual(feeder.feed(' x '), [])
+    (offset, t), = feeder.close()
+    self.assertEqual((t.tag_, offset + t.spos_), ('err', 7))
+    self.assertEqual(feeder.offset, 2)
+    # a back-reference split across two feeds waits for the rest
+    peg = pegpy.grammar("Pair = { @scope(@symbol(W) ':' @match(W)) #Pair } ' '*\nW = [a-z]+\n")
+    feeder = pegpy.Parser(peg).incremental()
+    self.assertEqual(feeder.feed('abc:ab'), [])
+    items = feeder.feed('c ') + feeder.close()
+    self.assertEqual([repr(t) for _, t in items], ["[#Pair 'abc:abc']"])
+
+if __name__ == '__main__':
+  unittest.main()